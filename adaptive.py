@@ -0,0 +1,104 @@
+"""
+Adaptive concurrency limits (`ADAPTIVE_CONCURRENCY=true`).
+
+An `AdaptiveLimiter` watches the latency and failures of the work running under a `Lane`
+(an execution lane or the backend call limit) and moves the lane's limit with AIMD:
+
+- every `ADAPTIVE_INTERVAL` seconds with at least `ADAPTIVE_MIN_SAMPLES` samples, the
+  window's mean latency is compared with a no-load baseline, the lowest recent window mean.
+  Like is compared with like, and a mean does not jump the way a percentile does when it
+  sits between the modes of a bimodal backend;
+- if the failure rate exceeds `ADAPTIVE_ERROR_THRESHOLD` or the mean exceeds
+  `ADAPTIVE_LATENCY_TOLERANCE` times the baseline, the limit is multiplied by
+  `ADAPTIVE_DECREASE_FACTOR`;
+- otherwise, if the lane was saturated (work queued behind the limit), the limit grows by
+  `ADAPTIVE_INCREASE_STEP`.
+
+The baseline only drifts upwards while the lane is not saturated, so latency added by
+raising the limit is never absorbed into it. When the latency stays high at
+`ADAPTIVE_MIN_LIMIT`, the backend has become slower rather than busier: the baseline is
+relearned from the current window and the limit can grow again.
+
+Samples time only the work done while holding a slot: the time spent in the lane's own
+queue, and in the queue of a nested lane (a text query waiting for the backend lane), is
+left out, so one lane's backlog does not throttle another. Failures are reported by the
+work itself (`lanes.mark_failed`) or by an exception.
+
+Limits stay within `ADAPTIVE_MIN_LIMIT`..`ADAPTIVE_MAX_LIMIT`. Limit changes are logged, the
+current limits are exported as `telegram_bot_lane_limit` and every decision is counted in
+`telegram_bot_adaptive_decisions_total`.
+"""
+import os
+import time
+
+from logger import logger
+from metrics import ADAPTIVE_DECISIONS
+
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() == "true"
+ADAPTIVE_INTERVAL = float(os.getenv("ADAPTIVE_INTERVAL", "5"))
+ADAPTIVE_MIN_SAMPLES = int(os.getenv("ADAPTIVE_MIN_SAMPLES", "20"))
+ADAPTIVE_MIN_LIMIT = int(os.getenv("ADAPTIVE_MIN_LIMIT", "4"))
+ADAPTIVE_MAX_LIMIT = int(os.getenv("ADAPTIVE_MAX_LIMIT", "1024"))
+ADAPTIVE_LATENCY_TOLERANCE = float(os.getenv("ADAPTIVE_LATENCY_TOLERANCE", "2.0"))
+ADAPTIVE_ERROR_THRESHOLD = float(os.getenv("ADAPTIVE_ERROR_THRESHOLD", "0.05"))
+ADAPTIVE_DECREASE_FACTOR = float(os.getenv("ADAPTIVE_DECREASE_FACTOR", "0.8"))
+ADAPTIVE_INCREASE_STEP = int(os.getenv("ADAPTIVE_INCREASE_STEP", "4"))
+# How fast the no-load baseline may drift upwards per unsaturated interval, so it follows a
+# backend that has genuinely become slower.
+BASELINE_DRIFT = 0.05
+
+
+class AdaptiveLimiter:
+    """AIMD controller for the limit of one `Lane`."""
+
+    def __init__(self, lane, min_limit=ADAPTIVE_MIN_LIMIT, max_limit=ADAPTIVE_MAX_LIMIT):
+        self.lane = lane
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.baseline = None
+        self._samples = []
+        self._saturated = False
+        self._next_decision = time.monotonic() + ADAPTIVE_INTERVAL
+
+    def observe(self, duration: float, failed=False):
+        """Record one finished unit of work and adjust the limit when the interval is over."""
+        self._samples.append((duration, failed))
+        if self.lane.queued:
+            self._saturated = True
+        if time.monotonic() >= self._next_decision:
+            self._decide()
+
+    def _decide(self):
+        self._next_decision = time.monotonic() + ADAPTIVE_INTERVAL
+        if len(self._samples) < ADAPTIVE_MIN_SAMPLES:
+            return
+        samples, self._samples = self._samples, []
+        saturated, self._saturated = self._saturated, False
+        latencies = sorted(duration for duration, _ in samples)
+        mean = sum(latencies) / len(latencies)
+        p90 = latencies[int(0.9 * (len(latencies) - 1))]
+        error_rate = sum(failed for _, failed in samples) / len(samples)
+        if self.baseline is None:
+            self.baseline = mean
+        else:
+            self.baseline = min(mean, self.baseline if saturated else self.baseline * (1 + BASELINE_DRIFT))
+
+        limit = self.lane.limit
+        slow = mean > self.baseline * ADAPTIVE_LATENCY_TOLERANCE
+        if slow and limit <= self.min_limit and error_rate <= ADAPTIVE_ERROR_THRESHOLD:
+            # Shedding load did not help: this is the backend's new no-load latency.
+            action, self.baseline = "rebaseline", mean
+        elif error_rate > ADAPTIVE_ERROR_THRESHOLD or slow:
+            action, limit = "decrease", int(limit * ADAPTIVE_DECREASE_FACTOR)
+        elif saturated:
+            action, limit = "increase", limit + ADAPTIVE_INCREASE_STEP
+        else:
+            action = "hold"
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        ADAPTIVE_DECISIONS.labels(self.lane.name, action).inc()
+        if limit != self.lane.limit:
+            logger.info({"adaptive_limit": self.lane.name, "action": action, "limit": limit,
+                         "previous_limit": self.lane.limit, "mean_ms": round(mean * 1000, 1),
+                         "p90_ms": round(p90 * 1000, 1),
+                         "baseline_ms": round(self.baseline * 1000, 1), "error_rate": round(error_rate, 3)})
+            self.lane.set_limit(limit)
@@ -0,0 +1,56 @@
+"""
+Typed decoding of backend responses.
+
+Query responses are decoded with msgspec straight from the HTTP body bytes into the structs
+below, validating types on the way, instead of building a generic dict with `json` and
+indexing it unchecked. Fields the bot does not use are skipped. A body that is not valid
+JSON or does not match the schema raises `InvalidBackendResponse` (a `ValueError`) naming
+the offending field, e.g. "Expected `str`, got `null` - at `$.output.text`".
+
+    query  {"output": {"text": "<Markdown answer>", "audio": "<audio URL>" | "" | null}}
+    batch  {"responses": [{"status": 200, "body": <query response>}, ...]}
+"""
+from typing import List, Optional
+
+import msgspec
+
+
+class InvalidBackendResponse(ValueError):
+    """The backend answered with a body that does not match the expected schema."""
+
+
+class QueryOutput(msgspec.Struct):
+    text: str
+    audio: Optional[str] = None
+
+
+class QueryResponse(msgspec.Struct):
+    output: QueryOutput
+
+
+class BatchItem(msgspec.Struct):
+    status: int = 200
+    # Decoded per item, so one malformed answer only fails its own caller.
+    body: msgspec.Raw = msgspec.Raw(b"null")
+
+
+class BatchResponse(msgspec.Struct):
+    responses: List[BatchItem]
+
+
+_query_decoder = msgspec.json.Decoder(QueryResponse)
+_batch_decoder = msgspec.json.Decoder(BatchResponse)
+
+
+def decode_query_response(content: bytes) -> QueryResponse:
+    try:
+        return _query_decoder.decode(content)
+    except msgspec.DecodeError as e:
+        raise InvalidBackendResponse(f"Invalid query response: {e}") from None
+
+
+def decode_batch_response(content: bytes) -> BatchResponse:
+    try:
+        return _batch_decoder.decode(content)
+    except msgspec.DecodeError as e:
+        raise InvalidBackendResponse(f"Invalid batch response: {e}") from None
@@ -0,0 +1,139 @@
+"""
+Client-side load balancing across backend replicas.
+
+`STORY_API_BASE_URL` and `ACTIVITY_API_BASE_URL` (and the per-bot URLs of `tenants.py`)
+accept a comma-separated list of replica base URLs. Each query goes to one replica picked
+by power-of-two-choices: two healthy replicas are drawn at random and the one with fewer
+outstanding requests wins, weighted by slow-start.
+
+- Passive health ejection: after `BACKEND_EJECT_FAILURES` consecutive failures (connection
+  errors, timeouts, 5xx) a replica is left out for `BACKEND_EJECT_SECONDS`, doubling on
+  every consecutive ejection up to `BACKEND_EJECT_MAX_SECONDS`. At most
+  `BACKEND_MAX_EJECTED_PERCENT` of a pool is ever ejected at once.
+- Slow-start: a replica returning from ejection ramps up from 10% to full weight over
+  `BACKEND_SLOW_START_SECONDS`, so it is not flooded again while it recovers.
+
+Pools are shared by URL list, so bots using the same replicas see each other's load.
+
+Every backend request (queries, batches, generated audio) goes through `backend_client`, one
+shared `httpx.AsyncClient`, so waiting on the backend costs no thread and concurrency is
+bounded only by the backend lane and the execution lanes. Requests are bounded by
+`BACKEND_CONNECT_TIMEOUT` (default 5) and `BACKEND_READ_TIMEOUT` (default 30) seconds, so
+a hung replica surfaces as a timeout: it counts towards ejection and the query can be
+deferred (`deferred.py`).
+"""
+import os
+import random
+import time
+
+import httpx
+
+from logger import logger
+from metrics import BACKEND_EJECTIONS, BACKEND_OUTSTANDING
+
+BACKEND_EJECT_FAILURES = int(os.getenv("BACKEND_EJECT_FAILURES", "5"))
+BACKEND_EJECT_SECONDS = float(os.getenv("BACKEND_EJECT_SECONDS", "30"))
+BACKEND_EJECT_MAX_SECONDS = float(os.getenv("BACKEND_EJECT_MAX_SECONDS", "300"))
+BACKEND_MAX_EJECTED_PERCENT = float(os.getenv("BACKEND_MAX_EJECTED_PERCENT", "50"))
+BACKEND_SLOW_START_SECONDS = float(os.getenv("BACKEND_SLOW_START_SECONDS", "30"))
+BACKEND_CONNECT_TIMEOUT = float(os.getenv("BACKEND_CONNECT_TIMEOUT", "5"))
+BACKEND_READ_TIMEOUT = float(os.getenv("BACKEND_READ_TIMEOUT", "30"))
+BACKEND_KEEPALIVE_CONNECTIONS = int(os.getenv("BACKEND_KEEPALIVE_CONNECTIONS", "256"))
+MIN_SLOW_START_WEIGHT = 0.1
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        # Replicas present at startup are assumed warm.
+        self.warming_since = None
+        BACKEND_OUTSTANDING.labels(url).set_function(lambda: self.outstanding)
+
+    def weight(self, now: float) -> float:
+        if self.warming_since is None or BACKEND_SLOW_START_SECONDS <= 0:
+            return 1.0
+        ramp = (now - self.warming_since) / BACKEND_SLOW_START_SECONDS
+        if ramp >= 1:
+            self.warming_since = None
+            return 1.0
+        return max(MIN_SLOW_START_WEIGHT, ramp)
+
+    def score(self, now: float) -> float:
+        return (self.outstanding + 1) / self.weight(now)
+
+
+class BackendPool:
+    """The replicas of one backend and the balancing state kept about them."""
+
+    def __init__(self, urls):
+        self.replicas = [Replica(url.rstrip("/")) for url in urls]
+
+    def acquire(self) -> Replica:
+        """Pick a replica for one request; pair every call with `release`."""
+        now = time.monotonic()
+        candidates = [replica for replica in self.replicas if replica.ejected_until <= now] or self.replicas
+        for replica in candidates:
+            if 0 < replica.ejected_until <= now:
+                # Back from ejection: ramp up again instead of taking a full share at once.
+                replica.ejected_until = 0.0
+                replica.warming_since = now
+        if len(candidates) == 1:
+            chosen = candidates[0]
+        else:
+            first, second = random.sample(candidates, 2)
+            chosen = first if first.score(now) <= second.score(now) else second
+        chosen.outstanding += 1
+        return chosen
+
+    def release(self, replica: Replica, failed=False):
+        self.release_batch(replica, 1, failed)
+
+    def release_batch(self, replica: Replica, count: int, failed=False):
+        """Finish `count` queries sent to `replica` in one request, which counts as one outcome."""
+        replica.outstanding -= count
+        if not failed:
+            replica.consecutive_failures = 0
+            replica.ejections = 0
+            return
+        replica.consecutive_failures += 1
+        if replica.consecutive_failures >= BACKEND_EJECT_FAILURES and self._can_eject():
+            duration = min(BACKEND_EJECT_SECONDS * 2 ** replica.ejections, BACKEND_EJECT_MAX_SECONDS)
+            replica.ejected_until = time.monotonic() + duration
+            replica.ejections += 1
+            replica.consecutive_failures = 0
+            BACKEND_EJECTIONS.labels(replica.url).inc()
+            logger.warning({"backend_ejected": replica.url, "seconds": duration})
+
+    def _can_eject(self) -> bool:
+        now = time.monotonic()
+        ejected = sum(replica.ejected_until > now for replica in self.replicas)
+        return (ejected + 1) * 100 <= BACKEND_MAX_EJECTED_PERCENT * len(self.replicas)
+
+
+def is_replica_failure(error: Exception) -> bool:
+    """Connection errors, timeouts and 5xx count against a replica; 4xx are the request's fault."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+# The lanes bound concurrency; the pool only keeps connections warm.
+backend_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(BACKEND_READ_TIMEOUT, connect=BACKEND_CONNECT_TIMEOUT),
+    limits=httpx.Limits(max_connections=None, max_keepalive_connections=BACKEND_KEEPALIVE_CONNECTIONS),
+)
+
+
+_pools = {}
+
+
+def backend_pool(base_urls: str) -> BackendPool:
+    """Return the shared pool for a comma-separated list of replica base URLs."""
+    urls = tuple(url.strip() for url in base_urls.split(",") if url.strip()) or ("",)
+    if urls not in _pools:
+        _pools[urls] = BackendPool(urls)
+    return _pools[urls]
@@ -0,0 +1,123 @@
+"""
+Optional micro-batching of backend queries (`BACKEND_BATCHING=true`).
+
+Queries for the same endpoint and language are held for at most `BACKEND_BATCH_MAX_WAIT_MS`
+or until `BACKEND_BATCH_MAX_SIZE` have been gathered, then sent in one POST to the
+endpoint's batch route (`{endpoint}{BACKEND_BATCH_PATH}`, e.g. `/v1/query/batch`):
+
+    request   {"requests": [{"headers": {...}, "body": <query body>}, ...]}
+    response  {"responses": [{"status": 200, "body": <query response>}, ...]}
+
+Responses are matched to callers by position. A failed batch fails every query in it; a
+failed item only fails its own caller. For replica health (`backends.py`) a batch is one
+outcome: a failed batch, or one with a 5xx item, counts as a single failure of its replica.
+"""
+import asyncio
+import os
+import time
+
+import httpx
+
+from backend_schema import decode_batch_response, decode_query_response
+from backends import backend_client, is_replica_failure
+from logger import logger
+from metrics import observe_backend_call
+
+BACKEND_BATCHING = os.getenv("BACKEND_BATCHING", "false").lower() == "true"
+BACKEND_BATCH_MAX_WAIT_MS = float(os.getenv("BACKEND_BATCH_MAX_WAIT_MS", "20"))
+BACKEND_BATCH_MAX_SIZE = int(os.getenv("BACKEND_BATCH_MAX_SIZE", "16"))
+BACKEND_BATCH_PATH = os.getenv("BACKEND_BATCH_PATH", "/batch")
+
+
+class QueryBatcher:
+    """Groups concurrent backend queries per (endpoint, language) into batch requests."""
+
+    def __init__(self, max_wait_ms=BACKEND_BATCH_MAX_WAIT_MS, max_size=BACKEND_BATCH_MAX_SIZE,
+                 batch_path=BACKEND_BATCH_PATH):
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_size = max_size
+        self.batch_path = batch_path
+        self._batches = {}
+        self._timers = {}
+        self._in_flight = set()
+
+    async def submit(self, pool, replica, url: str, language: str, body: dict, headers: dict) -> dict:
+        """
+        Queue one query to `replica` of `pool` and wait for its own response body. The
+        replica is released once the batch is done, so callers must not release it.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (url, language)
+        batch = self._batches.setdefault(key, [])
+        batch.append((headers, body, future, (pool, replica)))
+        if len(batch) >= self.max_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._batches.pop(key, None)
+        if batch:
+            task = asyncio.ensure_future(self._send(key[0], batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, url: str, batch):
+        failed = False
+        try:
+            failed = await self._deliver(url, batch)
+        finally:
+            self._release(batch, failed)
+
+    @staticmethod
+    def _release(batch, failed):
+        counts = {}
+        for *_, (pool, replica) in batch:
+            counts[pool, replica] = counts.get((pool, replica), 0) + 1
+        for (pool, replica), count in counts.items():
+            pool.release_batch(replica, count, failed)
+
+    async def _deliver(self, url: str, batch) -> bool:
+        """Send one batch and resolve its callers; True when it counts against the replica."""
+        payload = {"requests": [{"headers": headers, "body": body} for headers, body, *_ in batch]}
+        start_time = time.perf_counter()
+        try:
+            try:
+                response = await backend_client.post(url + self.batch_path, json=payload)
+            except httpx.HTTPError as e:
+                observe_backend_call(url + self.batch_path, type(e).__name__, time.perf_counter() - start_time)
+                raise
+            observe_backend_call(url + self.batch_path, response.status_code, time.perf_counter() - start_time)
+            response.raise_for_status()
+            results = decode_batch_response(response.content).responses
+            if len(results) != len(batch):
+                raise ValueError(f"Batch of {len(batch)} queries got {len(results)} responses")
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error(f"Error in batched backend call to {url}: {e}", exc_info=True)
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return is_replica_failure(e)
+        for (_, _, future, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if result.status >= 400:
+                # Carry the status, so 4xx items are not counted against the replica (backends.py).
+                item_response = httpx.Response(result.status, request=response.request)
+                future.set_exception(httpx.HTTPStatusError(
+                    f"{result.status} error for batched query to {url}", request=response.request,
+                    response=item_response))
+                continue
+            try:
+                future.set_result(decode_query_response(result.body))
+            except ValueError as e:
+                future.set_exception(e)
+        return any(result.status >= 500 for result in results)
+
+
+query_batcher = QueryBatcher() if BACKEND_BATCHING else None
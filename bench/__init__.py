@@ -0,0 +1 @@
+"""Load-test and benchmark tooling for the Telegram bot."""
@@ -0,0 +1,363 @@
+"""
+End-to-end load test for the webhook service.
+
+Starts local stand-ins for the Telegram Bot API, the story/activity backends, the telemetry
+endpoint and (unless `--redis-url` is given) Redis, launches `telegram_webhook.py` against
+them and POSTs synthetic Telegram updates to its `/telegram` route at a fixed arrival rate.
+
+An update counts as answered when the stand-in Bot API receives its last expected call:
+the feedback prompt for text queries, `sendVoice` for voice queries, the bot selection
+keyboard for `lang_*` callbacks and `editMessageText` for feedback callbacks.
+
+Usage:
+    python -m bench.loadtest --rate 50 --duration 60 --mix text=0.7,voice=0.2,callback=0.1 \
+        --backend-latency lognormal:800:0.5
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse
+
+import httpx
+import uvicorn
+
+from bench.stubs import RedisStub, create_stub_app, parse_latency
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:LOADTEST"
+FIRST_CHAT_ID = 500000000
+LANGUAGES = ["en", "hi", "bn", "ta", "te", "mr"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))]
+
+
+def rss_kb(pid: int) -> int:
+    """Resident set size of a process in KiB, read from /proc (0 where unavailable)."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for item in spec.split(","):
+        kind, weight = item.split("=")
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - {"text", "voice", "callback"}
+    if unknown:
+        raise ValueError(f"Unknown update kinds in mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+class UpdateFactory:
+    """Builds synthetic Telegram update payloads, one fresh chat per update."""
+
+    def __init__(self):
+        self.update_ids = itertools.count(1)
+        self.chat_ids = itertools.count(FIRST_CHAT_ID)
+
+    @staticmethod
+    def _user(chat_id):
+        return {"id": chat_id, "is_bot": False, "first_name": "Load", "language_code": random.choice(LANGUAGES)}
+
+    def _message(self, chat_id, **fields):
+        return {"message_id": random.randint(1, 10 ** 6), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private", "first_name": "Load"},
+                "from": self._user(chat_id), **fields}
+
+    def build(self, kind: str):
+        """Return `(chat_id, subkind, payload)` for an update of the given kind."""
+        chat_id = next(self.chat_ids)
+        update_id = next(self.update_ids)
+        if kind == "text":
+            words = random.randint(3, 25)
+            text = " ".join(random.choice(["crop", "scheme", "pest", "wheat", "rain", "soil", "price"])
+                            for _ in range(words))
+            return chat_id, "text", {"update_id": update_id, "message": self._message(chat_id, text=text + "?")}
+        if kind == "voice":
+            voice = {"file_id": f"voice{update_id}", "file_unique_id": f"uvoice{update_id}",
+                     "duration": random.randint(2, 30), "mime_type": "audio/ogg"}
+            return chat_id, "voice", {"update_id": update_id, "message": self._message(chat_id, voice=voice)}
+        if random.random() < 0.5:
+            subkind, data = "language", f"lang_{random.choice(LANGUAGES)}"
+        else:
+            subkind, data = "feedback", f"message-{random.choice(['liked', 'disliked'])}__{update_id}"
+        callback_query = {"id": f"cb{update_id}", "from": self._user(chat_id), "chat_instance": "loadtest",
+                          "data": data, "message": self._message(chat_id, text="Please provide your feedback")}
+        return chat_id, subkind, {"update_id": update_id, "callback_query": callback_query}
+
+
+class Tracker:
+    """Correlates stand-in Bot API calls with pending updates to measure end-to-end latency."""
+
+    def __init__(self):
+        self.pending = {}
+        self.failed_chats = set()
+        self.latencies = {}
+        self.telegram_calls = 0
+
+    def start(self, chat_id: int, subkind: str):
+        self.pending[chat_id] = (subkind, time.perf_counter(), [0])
+
+    def on_backend_call(self, consumer_id, failed: bool):
+        if failed and consumer_id:
+            self.failed_chats.add(int(consumer_id))
+
+    def on_telegram_call(self, method: str, params: dict):
+        self.telegram_calls += 1
+        chat_id = params.get("chat_id")
+        if chat_id is None:
+            return
+        entry = self.pending.get(int(chat_id))
+        if entry is None:
+            return
+        subkind, started, sent_messages = entry
+        markup = params.get("reply_markup", "")
+        if method == "sendMessage":
+            sent_messages[0] += 1
+        done = (
+            (subkind == "text" and method == "sendMessage" and "message-liked" in markup)
+            or (subkind == "voice" and method == "sendVoice")
+            or (subkind in ("text", "voice") and method == "sendMessage" and sent_messages[0] == 2
+                and int(chat_id) in self.failed_chats)
+            or (subkind == "language" and method == "sendMessage" and "botname_" in markup)
+            or (subkind == "feedback" and method == "editMessageText")
+        )
+        if done:
+            del self.pending[int(chat_id)]
+            self.latencies.setdefault(subkind, []).append(time.perf_counter() - started)
+
+
+async def wait_for_health(url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"Bot process exited with status {process.returncode}")
+            try:
+                if (await client.get(f"{url}/healthcheck")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"Bot at {url} did not become healthy within {timeout}s")
+
+
+def bot_environment(stub_url: str, bot_port: int, redis_url: str, extra_env: dict) -> dict:
+    redis_location = urlparse(redis_url)
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_BOT_NAME": "loadtest",
+        "TELEGRAM_BASE_URL": f"http://127.0.0.1:{bot_port}",
+        "TELEGRAM_API_BASE_URL": f"{stub_url}/bot",
+        "TELEGRAM_API_FILE_URL": f"{stub_url}/file/bot",
+        "STORY_API_BASE_URL": stub_url,
+        "ACTIVITY_API_BASE_URL": stub_url,
+        "TELEMETRY_ENDPOINT_URL": stub_url,
+        "REDIS_HOST": redis_location.hostname,
+        "REDIS_PORT": str(redis_location.port or 6379),
+        "WEBHOOK_PORT": str(bot_port),
+        "SUPPORTED_LANGUAGES": ",".join(LANGUAGES),
+        "LOG_LEVEL": env.get("LOADTEST_BOT_LOG_LEVEL", "WARNING"),
+    })
+    env.update(extra_env)
+    return env
+
+
+async def generate_load(bot_url: str, tracker: Tracker, mix: dict, rate: float, duration: float,
+                        max_in_flight: int):
+    """Open-loop Poisson arrivals at `rate` updates/s; returns (sent, http_errors, ack latencies)."""
+    factory = UpdateFactory()
+    kinds, weights = zip(*mix.items())
+    in_flight = asyncio.Semaphore(max_in_flight)
+    ack_latencies, http_errors, tasks = [], [0], []
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+
+    async with httpx.AsyncClient(base_url=bot_url, limits=limits, timeout=30.0) as client:
+        async def post(chat_id, subkind, payload):
+            async with in_flight:
+                tracker.start(chat_id, subkind)
+                started = time.perf_counter()
+                try:
+                    response = await client.post("/telegram", json=payload)
+                    response.raise_for_status()
+                    ack_latencies.append(time.perf_counter() - started)
+                except httpx.HTTPError:
+                    http_errors[0] += 1
+                    tracker.pending.pop(chat_id, None)
+
+        deadline = time.perf_counter() + duration
+        next_arrival = time.perf_counter()
+        while next_arrival < deadline:
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind = random.choices(kinds, weights)[0]
+            tasks.append(asyncio.create_task(post(*factory.build(kind))))
+            next_arrival += random.expovariate(rate)
+        await asyncio.gather(*tasks)
+    return len(tasks), http_errors[0], ack_latencies
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"updates sent        {report['sent']}",
+        f"updates answered    {report['answered']}  (unanswered {report['unanswered']}, http errors {report['http_errors']})",
+        f"throughput          {report['throughput']:.1f} answered/s over {report['elapsed']:.1f}s",
+        f"webhook ack         p50 {report['ack_ms']['p50']:.1f} ms  p95 {report['ack_ms']['p95']:.1f} ms  "
+        f"p99 {report['ack_ms']['p99']:.1f} ms",
+        "end-to-end latency (ms)",
+    ]
+    for kind, stats in report["e2e_ms"].items():
+        lines.append(f"  {kind:<16}  n={stats['count']:<6} p50 {stats['p50']:8.1f}  p95 {stats['p95']:8.1f}  "
+                     f"p99 {stats['p99']:8.1f}")
+    lines.append("peak RSS (MiB)")
+    for name, kib in report["peak_rss_kb"].items():
+        lines.append(f"  {name:<16}  {kib / 1024:.1f}")
+    return "\n".join(lines)
+
+
+async def run(args) -> dict:
+    tracker = Tracker()
+    stub_port = free_port()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    stub_app = create_stub_app(
+        backend_latency=parse_latency(args.backend_latency),
+        telegram_latency=parse_latency(args.telegram_latency),
+        backend_error_rate=args.backend_error_rate,
+        on_telegram_call=tracker.on_telegram_call,
+        on_backend_call=tracker.on_backend_call,
+        public_url=stub_url,
+    )
+    stub_server = uvicorn.Server(uvicorn.Config(app=stub_app, host="127.0.0.1", port=stub_port,
+                                                log_level="warning", access_log=False))
+    stub_task = asyncio.create_task(stub_server.serve())
+
+    redis_stub = None
+    redis_url = args.redis_url
+    if redis_url is None:
+        redis_stub = RedisStub()
+        redis_url = f"redis://127.0.0.1:{await redis_stub.start()}"
+
+    process = None
+    bot_url = args.bot_url
+    if bot_url is None:
+        bot_port = free_port()
+        bot_url = f"http://127.0.0.1:{bot_port}"
+        extra_env = dict(item.split("=", 1) for item in args.bot_env)
+        process = subprocess.Popen([sys.executable, args.entrypoint], cwd=REPO_ROOT,
+                                   env=bot_environment(stub_url, bot_port, redis_url, extra_env))
+    else:
+        print(f"Using running bot at {bot_url}; point it at the stand-ins with "
+              f"TELEGRAM_API_BASE_URL={stub_url}/bot STORY_API_BASE_URL={stub_url} "
+              f"ACTIVITY_API_BASE_URL={stub_url} TELEMETRY_ENDPOINT_URL={stub_url} "
+              f"REDIS_HOST/REDIS_PORT from {redis_url}")
+
+    peak_rss = {}
+
+    async def sample_rss():
+        while True:
+            pids = {"harness": os.getpid()}
+            if process is not None:
+                pids["bot"] = process.pid
+            for name, pid in pids.items():
+                peak_rss[name] = max(peak_rss.get(name, 0), rss_kb(pid))
+            await asyncio.sleep(0.5)
+
+    rss_task = asyncio.create_task(sample_rss())
+    try:
+        await wait_for_health(bot_url, process)
+        started = time.perf_counter()
+        sent, http_errors, ack_latencies = await generate_load(
+            bot_url, tracker, parse_mix(args.mix), args.rate, args.duration, args.max_in_flight)
+        drain_deadline = time.monotonic() + args.drain_timeout
+        while tracker.pending and time.monotonic() < drain_deadline:
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - started
+    finally:
+        rss_task.cancel()
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        stub_server.should_exit = True
+        await stub_task
+        if redis_stub is not None:
+            await redis_stub.stop()
+
+    answered = sum(len(values) for values in tracker.latencies.values())
+    all_latencies = [value for values in tracker.latencies.values() for value in values]
+    e2e = {kind: values for kind, values in sorted(tracker.latencies.items())}
+    e2e["all"] = all_latencies
+    return {
+        "sent": sent,
+        "answered": answered,
+        "unanswered": len(tracker.pending),
+        "http_errors": http_errors,
+        "elapsed": elapsed,
+        "throughput": answered / elapsed if elapsed else 0.0,
+        "telegram_calls": tracker.telegram_calls,
+        "ack_ms": {f"p{p}": percentile(ack_latencies, p) * 1000 for p in (50, 95, 99)},
+        "e2e_ms": {kind: {"count": len(values), **{f"p{p}": percentile(values, p) * 1000 for p in (50, 95, 99)}}
+                   for kind, values in e2e.items()},
+        "peak_rss_kb": peak_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=20.0, help="updates per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load")
+    parser.add_argument("--mix", default="text=0.7,voice=0.2,callback=0.1",
+                        help="relative weights of text, voice and callback updates")
+    parser.add_argument("--backend-latency", default="lognormal:800:0.5",
+                        help="story/activity backend latency distribution (see bench.stubs.parse_latency)")
+    parser.add_argument("--telegram-latency", default="lognormal:40:0.3",
+                        help="Telegram Bot API latency distribution")
+    parser.add_argument("--backend-error-rate", type=float, default=0.0)
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="cap on concurrent webhook POSTs")
+    parser.add_argument("--drain-timeout", type=float, default=60.0,
+                        help="seconds to wait for outstanding answers after the load stops")
+    parser.add_argument("--entrypoint", default="telegram_webhook.py", help="bot script to launch")
+    parser.add_argument("--bot-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the launched bot, repeatable")
+    parser.add_argument("--bot-url", help="target an already running bot instead of launching one")
+    parser.add_argument("--redis-url", help="use this Redis instead of the in-memory stand-in")
+    parser.add_argument("--json", dest="json_path", help="also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(format_report(report))
+    if args.json_path:
+        with open(args.json_path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
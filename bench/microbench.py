@@ -0,0 +1,333 @@
+"""
+Micro-benchmarks for the CPU cost of handling one update.
+
+Each benchmark times one hot-path step with Redis and the network replaced by in-memory
+stand-ins, so only CPU time is measured. Every benchmark is sampled `--repeat` times, in
+rounds over all benchmarks, and each sample is divided by the time of a fixed calibration
+loop run right before and after it. That cancels the speed changes of the machine itself
+(CPU steal, frequency scaling) between and during runs. The relative timings are
+summarised as the median with a 95% confidence interval.
+
+Baselines in `bench/baselines.json` are kept per machine (CPU model, architecture and
+Python version): the pure-Python calibration loop cannot carry timings of steps running in
+C, such as msgspec decoding, over to a different CPU. The first run on a machine records
+its baseline.
+
+Usage:
+    python -m bench.microbench                     # compare with the stored baselines
+    python -m bench.microbench --update-baseline   # record new baselines
+    python -m bench.microbench -k dispatch         # only benchmarks whose name contains "dispatch"
+
+The comparison exits with status 1 when a benchmark's median is more than `--tolerance`
+(default 30%) slower than its baseline and its confidence interval lies entirely above the
+baseline's, so noise alone does not fail the check.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import timeit
+from types import SimpleNamespace
+
+for _name, _value in {
+    "TELEGRAM_BOT_NAME": "microbench",
+    "TELEGRAM_BOT_TOKEN": "123456:MICROBENCH",
+    "TELEGRAM_BASE_URL": "http://127.0.0.1",
+    "STORY_API_BASE_URL": "http://127.0.0.1",
+    "ACTIVITY_API_BASE_URL": "http://127.0.0.1",
+    "LOG_LEVEL": "WARNING",
+    "TELEMETRY_LOG_ENABLED": "false",
+    "SUPPORTED_LANGUAGES": "en,bn,gu,hi,kn,ml,mr,or,pa,ta,te",
+}.items():
+    os.environ.setdefault(_name, _value)
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import bot_core as bot  # noqa: E402
+from backend_schema import decode_query_response  # noqa: E402
+from delivery import prepare_markdown_messages  # noqa: E402
+from telemetry_logger import TelemetryLogger  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+CHAT = {"id": 500000001, "type": "private", "first_name": "Bench"}
+USER = {"id": 500000001, "is_bot": False, "first_name": "Bench", "language_code": "hi"}
+SAMPLE_UPDATES = {
+    "text": {"update_id": 1, "message": {
+        "message_id": 11, "date": 1700000000, "chat": CHAT, "from": USER,
+        "text": "Which government schemes support drip irrigation for small farmers?"}},
+    "voice": {"update_id": 2, "message": {
+        "message_id": 12, "date": 1700000000, "chat": CHAT, "from": USER,
+        "voice": {"file_id": "AwACAgUAAxkBAAIB", "file_unique_id": "AgADwQ", "duration": 7,
+                  "mime_type": "audio/ogg", "file_size": 24576}}},
+    "command": {"update_id": 3, "message": {
+        "message_id": 13, "date": 1700000000, "chat": CHAT, "from": USER, "text": "/select_language",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 16}]}},
+    "feedback": {"update_id": 4, "callback_query": {
+        "id": "4", "from": USER, "chat_instance": "bench", "data": "message-liked__11",
+        "message": {"message_id": 14, "date": 1700000000, "chat": CHAT, "text": "Please provide your feedback"}}},
+    "feedback_reply": {"update_id": 5, "callback_query": {
+        "id": "5", "from": USER, "chat_instance": "bench", "data": "replymessage_liked",
+        "message": {"message_id": 15, "date": 1700000000, "chat": CHAT, "text": "Please provide your feedback"}}},
+}
+SHORT_ANSWER = "*Drip irrigation* is supported under PM-KSY.\n\nApply at your nearest _Krishi Vigyan Kendra."
+LONG_ANSWER = "\n\n".join(f"*Step {i}*: " + "Prepare the field and check soil_moisture daily. " * 12 for i in range(40))
+
+
+class InMemoryRedis:
+    """Stands in for the Redis client so session lookups cost no I/O."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, *keys):
+        return [self.data.get(key) for key in keys]
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = str(value).encode("utf-8")
+
+    def hsetnx(self, key, field, value):
+        self.data.setdefault(key, {}).setdefault(field, str(value).encode("utf-8"))
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def register_script(self, script):
+        """Only the session store's script runs here, emulated like `session_store.STORE_PROFILE_LUA`."""
+        def store_profile(keys, args):
+            field, language, bot, _, fill = args
+            current = int(self.hget(keys[0], field) or 0)
+            if language < 0 or (fill and current >= 16):
+                language = current // 16
+            if bot < 0 or (fill and current % 16):
+                bot = current % 16
+            self.hset(keys[0], field, language * 16 + bot)
+            return current
+        return store_profile
+
+    def pipeline(self, transaction=True):
+        return InMemoryPipeline(self)
+
+
+class InMemoryPipeline:
+    """Queues calls on an `InMemoryRedis` and runs them on `execute`, like a Redis pipeline."""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        return lambda *args: self.calls.append((method, args))
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [method(*args) for method, args in calls]
+
+
+class OfflineRequest(BaseRequest):
+    """Answers `getMe` locally so the bot can be initialised without network access."""
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        bot_user = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "microbench_bot"}
+        return 200, json.dumps({"ok": True, "result": bot_user}).encode("utf-8")
+
+
+def calibration():
+    """A fixed pure-Python workload timed next to every sample to factor out machine speed."""
+    total = 0
+    for i in range(1000):
+        total += len(str(i)) * (i % 7)
+    return total
+
+
+def machine_key() -> str:
+    """Identify the hardware and interpreter a baseline was recorded on."""
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            cpu = next((line.split(":", 1)[1].strip() for line in cpuinfo if line.startswith("model name")), cpu)
+    except OSError:
+        pass
+    return f"{cpu or 'unknown cpu'} / {platform.machine()} / {platform.python_implementation()} {platform.python_version()}"
+
+
+def build_benchmarks():
+    application = (
+        Application.builder().token(os.environ["TELEGRAM_BOT_TOKEN"]).updater(None).request(OfflineRequest()).build()
+    )
+    bot.register_handlers(application)
+    handlers = application.handlers[0]
+    tg_bot = application.bot
+    asyncio.run(tg_bot.initialize())
+    updates = {kind: Update.de_json(payload, tg_bot) for kind, payload in SAMPLE_UPDATES.items()}
+
+    tenant = next(iter(bot.TENANTS.values()))
+    session_store = bot.session_stores[tenant.bot_id]
+    session_store.redis = InMemoryRedis()
+    session_store.set_language(CHAT["id"], "hi")
+    session_store.set_bot(CHAT["id"], "parent")
+    context = SimpleNamespace(tenant=tenant, session_store=session_store)
+    telemetry = TelemetryLogger(url="http://127.0.0.1")
+    interact_input = {"x-source": "telegram", "x-request-id": "11", "x-device-id": "d500000001",
+                      "x-consumer-id": "500000001", "subtype": "message-liked", "edataId": "story"}
+    log_input = {**interact_input, "method": "POST", "url": "/v1/query", "status_code": 200, "duration": 812,
+                 "body": {"input": {"language": "hi", "text": "query"}, "output": {"format": "text"}}}
+
+    backend_body = json.dumps({"output": {"text": LONG_ANSWER, "audio": ""}}).encode("utf-8")
+
+    def dispatch(update):
+        for handler in handlers:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                return handler
+        return None
+
+    benchmarks = {}
+    for kind, payload in SAMPLE_UPDATES.items():
+        benchmarks[f"de_json_{kind}"] = lambda payload=payload: Update.de_json(payload, tg_bot)
+    for kind, update in updates.items():
+        benchmarks[f"dispatch_{kind}"] = lambda update=update: dispatch(update)
+    benchmarks.update({
+        "get_message": lambda: bot.getMessage(updates["text"], context, tenant.catalog["LANGUAGE_SELCTION"], "hi"),
+        "create_language_keyboard": lambda: bot.create_language_keyboard(tenant.supported_languages),
+        "build_query_request_text": lambda: bot.build_query_request(
+            "Which schemes support drip irrigation?", None, "hi", "parent"),
+        "build_query_request_voice": lambda: bot.build_query_request(
+            None, "https://api.telegram.org/file/bot123/voice/file_1.oga", "hi", "story"),
+        "prepare_interect_event": lambda: telemetry.prepare_interect_event(interact_input),
+        "prepare_log_event": lambda: telemetry.prepare_log_event(log_input, message="query answered"),
+        "prepare_answer_short": lambda: prepare_markdown_messages(SHORT_ANSWER),
+        "prepare_answer_long": lambda: prepare_markdown_messages(LONG_ANSWER),
+        "decode_query_response": lambda: decode_query_response(backend_body),
+    })
+    return benchmarks
+
+
+def median_interval(samples) -> tuple:
+    """Distribution-free ~95% confidence interval of the median, from order statistics."""
+    ordered = sorted(samples)
+    n = len(ordered)
+    # The k-th smallest and k-th largest samples bracket the median with probability
+    # 1 - 2 * P(Binomial(n, 1/2) < k); take the largest k keeping that at 95% or more.
+    k, below = 0, 0.0
+    while k < n // 2:
+        below += math.comb(n, k) / 2 ** n
+        if 2 * below > 0.05:
+            break
+        k += 1
+    k = max(k, 1)
+    return ordered[k - 1], ordered[n - k]
+
+
+def calls_per_sample(func, min_time: float) -> int:
+    number, elapsed = timeit.Timer(func).autorange()
+    return max(1, int(number * min_time / max(elapsed, 1e-9)))
+
+
+def run(selected, repeat: int, min_time: float) -> dict:
+    benchmarks = {name: func for name, func in build_benchmarks().items()
+                  if not selected or any(pattern in name for pattern in selected)}
+    timers = {name: (timeit.Timer(func), calls_per_sample(func, min_time)) for name, func in benchmarks.items()}
+    calibration_timer = timeit.Timer(calibration)
+    calibration_number = calls_per_sample(calibration, min_time / 4)
+
+    def calibration_us():
+        return calibration_timer.timeit(calibration_number) / calibration_number * 1e6
+
+    samples = {name: [] for name in benchmarks}
+    for _ in range(repeat):
+        for name, (timer, number) in timers.items():
+            before = calibration_us()
+            per_call_us = timer.timeit(number) / number * 1e6
+            reference = (before + calibration_us()) / 2
+            samples[name].append((per_call_us, per_call_us / reference))
+    results = {}
+    for name, values in samples.items():
+        relative = [ratio for _, ratio in values]
+        low, high = median_interval(relative)
+        results[name] = {"us": round(statistics.median(per_call_us for per_call_us, _ in values), 3),
+                         "relative": round(statistics.median(relative), 5),
+                         "relative_low": round(low, 5), "relative_high": round(high, 5)}
+    return results
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """Print a comparison table and return the names of regressed benchmarks."""
+    regressions = []
+    print(f"{'benchmark':<30} {'us/op':>10} {'baseline':>10} {'change':>8} {'95% CI':>17}")
+    for name, result in current.items():
+        expected = baseline.get(name)
+        if expected is None:
+            print(f"{name:<30} {result['us']:>10.2f} {'-':>10} {'new':>8}")
+            continue
+        change = result["relative"] / expected["relative"] - 1
+        interval = (f"{result['relative_low'] / expected['relative'] - 1:+.0%}.."
+                    f"{result['relative_high'] / expected['relative'] - 1:+.0%}")
+        marker = ""
+        # Both intervals must be apart as well, so a noisy run does not count as a regression.
+        if change > tolerance and result["relative_low"] > expected["relative_high"]:
+            regressions.append(name)
+            marker = "  REGRESSION"
+        print(f"{name:<30} {result['us']:>10.2f} {expected['us']:>10.2f} {change:>+8.1%} {interval:>17}{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="selected", action="append", default=[],
+                        help="only run benchmarks whose name contains this string, repeatable")
+    parser.add_argument("--repeat", type=int, default=15, help="samples per benchmark")
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds per sample")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed relative slowdown")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    current = run(args.selected, args.repeat, args.min_time)
+    machine = machine_key()
+    stored = {"machines": {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            stored = json.load(baseline_file)
+    baseline = stored["machines"].get(machine)
+    if args.update_baseline or baseline is None:
+        stored["machines"].setdefault(machine, {}).update(current)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(stored, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        for name, result in sorted(current.items()):
+            print(f"{name:<30} {result['us']:>10.2f} us/op")
+        print(f"Baseline for {machine} written to {args.baseline}")
+        return
+
+    regressions = compare(current, baseline, args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
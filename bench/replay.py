@@ -0,0 +1,86 @@
+"""
+Time-scaled replay of captured webhook traffic.
+
+Re-drives a capture written by `capture.py` (`CAPTURE_FILE`) against a test instance,
+posting each update to the `/telegram/{bot_id}` route of the bot it was captured for
+(`/telegram` for captures without bot ids) and preserving the recorded inter-arrival gaps
+divided by `--speed`, or as fast as `--max-in-flight` allows with `--speed max`.
+
+Captured file ids are pseudonymized, so point the test instance at the stand-ins of
+`bench.loadtest` (or any Bot API stand-in) rather than at the real Telegram API.
+
+Usage:
+    python -m bench.replay capture.jsonl.gz --url http://127.0.0.1:8000 --speed 10
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from bench.loadtest import percentile
+from capture import read_capture
+
+
+async def replay(records, url: str, speed, max_in_flight: int) -> dict:
+    in_flight = asyncio.Semaphore(max_in_flight)
+    ack_latencies, lateness, errors, tasks = [], [], [0], []
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30.0) as client:
+        async def post(bot_id, body):
+            async with in_flight:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(f"/telegram/{bot_id}" if bot_id else "/telegram", json=body)
+                    response.raise_for_status()
+                    ack_latencies.append(time.perf_counter() - started)
+                except httpx.HTTPError:
+                    errors[0] += 1
+
+        first_arrival = None
+        replay_start = time.perf_counter()
+        for arrival, bot_id, body in records:
+            if speed is not None:
+                if first_arrival is None:
+                    first_arrival = arrival
+                due = replay_start + (arrival - first_arrival) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    lateness.append(-delay)
+            tasks.append(asyncio.create_task(post(bot_id, body)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - replay_start
+
+    return {
+        "sent": len(tasks),
+        "errors": errors[0],
+        "elapsed": elapsed,
+        "rate": len(tasks) / elapsed if elapsed else 0.0,
+        "ack_ms": {f"p{p}": percentile(ack_latencies, p) * 1000 for p in (50, 95, 99)},
+        "behind_schedule_ms": {f"p{p}": percentile(lateness, p) * 1000 for p in (50, 99)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="capture file written with CAPTURE_FILE")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="base URL of the test instance")
+    parser.add_argument("--speed", default="1", help="time scale factor, e.g. 1, 10, or 'max'")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="cap on concurrent webhook POSTs")
+    args = parser.parse_args()
+
+    speed = None if args.speed == "max" else float(args.speed)
+    report = asyncio.run(replay(read_capture(args.capture), args.url, speed, args.max_in_flight))
+    print(f"updates sent        {report['sent']}  (errors {report['errors']})")
+    print(f"replay rate         {report['rate']:.1f} updates/s over {report['elapsed']:.1f}s")
+    print(f"webhook ack         p50 {report['ack_ms']['p50']:.1f} ms  p95 {report['ack_ms']['p95']:.1f} ms  "
+          f"p99 {report['ack_ms']['p99']:.1f} ms")
+    print(f"behind schedule     p50 {report['behind_schedule_ms']['p50']:.1f} ms  "
+          f"p99 {report['behind_schedule_ms']['p99']:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
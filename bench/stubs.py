@@ -0,0 +1,540 @@
+"""
+Local stand-ins for the services the bot talks to, used by the load-test harness.
+
+- `create_stub_app` serves the Telegram Bot API (`/bot<token>/<method>`), the story and
+  activity backends (`/v1/query_rstory`, `/v1/query`), generated audio (`/audio/...`) and
+  the telemetry endpoint (`/v1/telemetry`) from one Starlette app.
+- `RedisStub` is a minimal in-memory RESP server that understands the commands the bot
+  sends, for laptops without a local `redis-server`.
+"""
+import asyncio
+import email.parser
+import fnmatch
+import hashlib
+import itertools
+import json
+import math
+import random
+import time
+from urllib.parse import parse_qs
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from deferred import CLAIM_LUA
+from ratelimit import TOKEN_BUCKET_LUA
+from session_store import STORE_PROFILE_LUA
+
+STUB_BOT_USER = {"id": 1000001, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+SAMPLE_AUDIO = b"OggS" + bytes(16 * 1024)
+
+
+def parse_latency(spec: str):
+    """
+    Parse a latency distribution spec into a function returning a delay in seconds.
+
+    Supported specs (values in milliseconds): `fixed:200`, `uniform:100:400` and
+    `lognormal:250:0.5` (median and sigma), e.g. for LLM backends with a long tail.
+    """
+    kind, *args = spec.split(":")
+    values = [float(arg) for arg in args]
+    if kind == "fixed":
+        return lambda: values[0] / 1000.0
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1]) / 1000.0
+    if kind == "lognormal":
+        median_ms, sigma = values
+        mu = math.log(median_ms)
+        return lambda: random.lognormvariate(mu, sigma) / 1000.0
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+async def read_params(request: Request) -> dict:
+    """Decode Bot API parameters sent either form-encoded or as multipart (file uploads)."""
+    body = await request.body()
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        params = {}
+        for part in message.walk():
+            name = part.get_param("name", header="content-disposition")
+            if name and not part.get_filename():
+                params[name] = part.get_payload(decode=True).decode("utf-8")
+        return params
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    return {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+
+
+def create_stub_app(backend_latency, telegram_latency, backend_error_rate=0.0, on_telegram_call=None,
+                    on_backend_call=None, public_url=""):
+    """
+    Build the stand-in service app.
+
+    `on_telegram_call(method, params)` and `on_backend_call(consumer_id, failed)` let the
+    harness observe what the bot sent, e.g. to detect when an update has been fully answered.
+    """
+    message_ids = itertools.count(1)
+
+    def message(chat_id, **fields):
+        return {"message_id": next(message_ids), "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, **fields}
+
+    async def bot_api(request: Request) -> Response:
+        method = request.path_params["method"]
+        params = await read_params(request)
+        await asyncio.sleep(telegram_latency())
+        if method == "getMe":
+            result = STUB_BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            result = message(params.get("chat_id", 0), text=params.get("text", ""))
+        elif method == "sendVoice":
+            result = message(params.get("chat_id", 0),
+                             voice={"file_id": "out", "file_unique_id": "out", "duration": 1})
+        elif method == "getUpdates":
+            # Updates are only ever pushed through the webhook; hold the long poll briefly.
+            await asyncio.sleep(min(float(params.get("timeout", 0)), 1.0))
+            result = []
+        elif method == "getFile":
+            file_id = params.get("file_id", "")
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": 4096,
+                      "file_path": f"voice/{file_id}.oga"}
+        else:
+            result = True
+        if on_telegram_call is not None:
+            on_telegram_call(method, params)
+        return JSONResponse({"ok": True, "result": result})
+
+    def answer(body, consumer_id):
+        failed = random.random() < backend_error_rate
+        if on_backend_call is not None:
+            on_backend_call(consumer_id, failed)
+        if failed:
+            return 500, {"detail": "stub backend error"}
+        audio = f"{public_url}/audio/answer.ogg" if body["output"]["format"] == "audio" else ""
+        return 200, {"output": {"text": "This is a *stub* answer.\n\nSecond paragraph.", "audio": audio}}
+
+    async def backend_query(request: Request) -> Response:
+        body = json.loads(await request.body())
+        await asyncio.sleep(backend_latency())
+        status, result = answer(body, request.headers.get("x-consumer-id"))
+        return JSONResponse(result, status_code=status)
+
+    async def backend_batch(request: Request) -> Response:
+        # One inference pass per batch: the latency is drawn once, whatever the batch size.
+        items = json.loads(await request.body())["requests"]
+        await asyncio.sleep(backend_latency())
+        responses = []
+        for item in items:
+            status, result = answer(item["body"], item["headers"].get("x-consumer-id"))
+            responses.append({"status": status, "body": result})
+        return JSONResponse({"responses": responses})
+
+    async def audio(_: Request) -> Response:
+        return Response(SAMPLE_AUDIO, media_type="audio/ogg")
+
+    async def telemetry(_: Request) -> Response:
+        return JSONResponse({"status": "ok"})
+
+    return Starlette(routes=[
+        Route("/bot{token}/{method}", bot_api, methods=["GET", "POST"]),
+        Route("/v1/query_rstory", backend_query, methods=["POST"]),
+        Route("/v1/query", backend_query, methods=["POST"]),
+        Route("/v1/query_rstory/batch", backend_batch, methods=["POST"]),
+        Route("/v1/query/batch", backend_batch, methods=["POST"]),
+        Route("/audio/{name}", audio, methods=["GET"]),
+        Route("/v1/telemetry", telemetry, methods=["POST"]),
+    ])
+
+
+class RedisStubError(Exception):
+    """Sent to the client as a RESP error reply."""
+
+
+class StubStream:
+    """Entries and consumer groups of one stream; entry ids are `(milliseconds, sequence)` tuples."""
+
+    def __init__(self):
+        self.entries = {}
+        self.groups = {}
+        self.last_id = (0, 0)
+        self.added = asyncio.Event()
+
+    def next_id(self):
+        milliseconds = int(time.time() * 1000)
+        last_ms, last_seq = self.last_id
+        self.last_id = (last_ms, last_seq + 1) if milliseconds <= last_ms else (milliseconds, 0)
+        return self.last_id
+
+
+class StubSortedSet(dict):
+    """Members and their scores; ordering is applied when read."""
+
+
+class StreamsReply(list):
+    """`(key, entries)` pairs of an XREAD(GROUP) reply: a map in RESP3, an array of pairs in RESP2."""
+
+
+def parse_stream_id(entry_id: bytes):
+    milliseconds, _, sequence = entry_id.decode().partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+def encode_stream_id(entry_id) -> bytes:
+    return b"%d-%d" % entry_id
+
+
+class RedisStub:
+    """In-memory RESP server implementing the subset of Redis commands the bot uses."""
+
+    OK = object()
+
+    def __init__(self):
+        self.data = {}
+        self.server = None
+        # Lua scripts cannot run here; the bot's own scripts are emulated in Python.
+        self.scripts = {
+            hashlib.sha1(TOKEN_BUCKET_LUA.encode()).hexdigest().encode(): self.token_bucket,
+            hashlib.sha1(CLAIM_LUA.encode()).hexdigest().encode(): self.deferred_claim,
+            hashlib.sha1(STORE_PROFILE_LUA.encode()).hexdigest().encode(): self.store_profile,
+        }
+
+    async def start(self, host="127.0.0.1", port=0) -> int:
+        self.server = await asyncio.start_server(self._serve, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = {"protocol": 2}
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    break
+                reply = self._execute(command, connection)
+                if asyncio.iscoroutine(reply):
+                    reply = await reply
+                writer.write(reply)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    def _execute(self, args, connection) -> bytes:
+        name = args[0].decode().lower()
+        if name == "hello":
+            connection["protocol"] = int(args[1]) if len(args) > 1 else 2
+            return self._encode({b"server": b"redis", b"version": b"7.2.0", b"proto": connection["protocol"]},
+                                connection["protocol"])
+        handler = getattr(self, f"cmd_{name}", None)
+        if handler is None:
+            return f"-ERR unknown command '{name.upper()}'\r\n".encode()
+        if asyncio.iscoroutinefunction(handler):
+            return self._execute_blocking(handler, args, connection)
+        try:
+            return self._encode(handler(*args[1:]), connection["protocol"])
+        except RedisStubError as e:
+            return f"-{e}\r\n".encode()
+
+    async def _execute_blocking(self, handler, args, connection) -> bytes:
+        try:
+            return self._encode(await handler(*args[1:]), connection["protocol"])
+        except RedisStubError as e:
+            return f"-{e}\r\n".encode()
+
+    @classmethod
+    def _encode(cls, value, protocol) -> bytes:
+        if value is cls.OK:
+            return b"+OK\r\n"
+        if value is None:
+            return b"_\r\n" if protocol == 3 else b"$-1\r\n"
+        if isinstance(value, bool) or isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, bytes):
+            return b"$%d\r\n%s\r\n" % (len(value), value)
+        if isinstance(value, StreamsReply):
+            if protocol == 3:
+                return b"%%%d\r\n" % len(value) + b"".join(
+                    cls._encode(k, protocol) + cls._encode(v, protocol) for k, v in value)
+            value = [list(pair) for pair in value]
+        if isinstance(value, dict):
+            if protocol == 3:
+                return b"%%%d\r\n" % len(value) + b"".join(
+                    cls._encode(k, protocol) + cls._encode(v, protocol) for k, v in value.items())
+            value = [item for pair in value.items() for item in pair]
+        return b"*%d\r\n" % len(value) + b"".join(cls._encode(item, protocol) for item in value)
+
+    def cmd_ping(self, *_):
+        return b"PONG"
+
+    def cmd_select(self, *_):
+        return self.OK
+
+    def cmd_client(self, *_):
+        return self.OK
+
+    def cmd_get(self, key):
+        value = self.data.get(key)
+        return value if isinstance(value, bytes) else None
+
+    def cmd_set(self, key, value, *_):
+        self.data[key] = value
+        return self.OK
+
+    def cmd_del(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def cmd_exists(self, *keys):
+        return sum(key in self.data for key in keys)
+
+    def cmd_expire(self, key, *_):
+        return int(key in self.data)
+
+    def cmd_hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def cmd_hset(self, key, *pairs):
+        mapping = self.data.setdefault(key, {})
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in mapping
+            mapping[field] = value
+        return added
+
+    def cmd_hsetnx(self, key, field, value):
+        mapping = self.data.setdefault(key, {})
+        if field in mapping:
+            return 0
+        mapping[field] = value
+        return 1
+
+    def cmd_script(self, subcommand, *args):
+        if subcommand.upper() == b"LOAD":
+            sha = hashlib.sha1(args[0]).hexdigest().encode()
+            if sha not in self.scripts:
+                raise RedisStubError("ERR scripts other than the bot's own are not supported")
+            return sha
+        return [int(sha in self.scripts) for sha in args]
+
+    def cmd_evalsha(self, sha, numkeys, *args):
+        script = self.scripts.get(sha)
+        if script is None:
+            raise RedisStubError("NOSCRIPT No matching script. Please use EVAL.")
+        return script(args[:int(numkeys)], args[int(numkeys):])
+
+    def cmd_eval(self, source, numkeys, *args):
+        return self.cmd_evalsha(hashlib.sha1(source).hexdigest().encode(), numkeys, *args)
+
+    def token_bucket(self, keys, args):
+        """Python rendition of `ratelimit.TOKEN_BUCKET_LUA`."""
+        burst, rate, now, spent = (float(arg) for arg in args)
+        bucket = self.data.setdefault(keys[0], {})
+        if b"tokens" in bucket and b"ts" in bucket:
+            tokens, ts = float(bucket[b"tokens"]), float(bucket[b"ts"])
+        else:
+            tokens, ts = burst, now
+        if now > ts:
+            tokens, ts = min(burst, tokens + (now - ts) * rate), now
+        tokens = max(tokens - spent, -burst)
+        allowed = 0
+        if tokens >= 1:
+            tokens, allowed = tokens - 1, 1
+        bucket[b"tokens"], bucket[b"ts"] = repr(tokens).encode(), repr(ts).encode()
+        return [allowed, math.floor(tokens * 1000)]
+
+    def deferred_claim(self, keys, args):
+        """Python rendition of `deferred.CLAIM_LUA`."""
+        now, lease, count = (int(arg) for arg in args)
+        queue = self.data.get(keys[0], {})
+        due = sorted((score, job_id) for job_id, score in queue.items() if score <= now)[:count]
+        for _, job_id in due:
+            queue[job_id] = now + lease
+        return [job_id for _, job_id in due]
+
+    def store_profile(self, keys, args):
+        """Python rendition of `session_store.STORE_PROFILE_LUA`."""
+        field = args[0]
+        language, bot, _, fill = (int(arg) for arg in args[1:])
+        bucket = self.data.setdefault(keys[0], {})
+        current = int(bucket.get(field, 0))
+        if language < 0 or (fill and current >= 16):
+            language = current // 16
+        if bot < 0 or (fill and current % 16):
+            bot = current % 16
+        bucket[field] = str(language * 16 + bot).encode()
+        return current
+
+    def cmd_hdel(self, key, *fields):
+        mapping = self.data.get(key, {})
+        return sum(mapping.pop(field, None) is not None for field in fields)
+
+    def cmd_zadd(self, key, *pairs):
+        members = self.data.setdefault(key, StubSortedSet())
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in members
+            members[member] = float(score)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        queue = self.data.get(key, {})
+        return sum(queue.pop(member, None) is not None for member in members)
+
+    def cmd_sadd(self, key, *members):
+        members_set = self.data.setdefault(key, set())
+        added = len(set(members) - members_set)
+        members_set.update(members)
+        return added
+
+    def cmd_sismember(self, key, member):
+        return int(member in self.data.get(key, set()))
+
+    def _stream(self, key, create=False):
+        stream = self.data.get(key)
+        if stream is None and create:
+            stream = self.data[key] = StubStream()
+        return stream
+
+    def cmd_xadd(self, key, *args):
+        options = list(args)
+        maxlen = None
+        while options[0].upper() in (b"NOMKSTREAM", b"MAXLEN"):
+            if options.pop(0).upper() == b"MAXLEN":
+                if options[0] in (b"~", b"="):
+                    options.pop(0)
+                maxlen = int(options.pop(0))
+        options.pop(0)  # only auto-generated ids ("*") are supported
+        stream = self._stream(key, create=True)
+        entry_id = stream.next_id()
+        stream.entries[entry_id] = options
+        if maxlen is not None:
+            while len(stream.entries) > maxlen:
+                del stream.entries[next(iter(stream.entries))]
+        stream.added.set()
+        stream.added = asyncio.Event()
+        return encode_stream_id(entry_id)
+
+    def cmd_xlen(self, key):
+        stream = self._stream(key)
+        return len(stream.entries) if stream else 0
+
+    def cmd_xgroup(self, subcommand, key, group, start_id=b"$", *options):
+        if subcommand.upper() != b"CREATE":
+            raise RedisStubError(f"ERR XGROUP {subcommand.decode()} is not supported")
+        stream = self._stream(key, create=b"MKSTREAM" in (option.upper() for option in options))
+        if stream is None:
+            raise RedisStubError("ERR The XGROUP subcommand requires the key to exist.")
+        if group in stream.groups:
+            raise RedisStubError("BUSYGROUP Consumer Group name already exists")
+        stream.groups[group] = {"last": stream.last_id if start_id == b"$" else parse_stream_id(start_id),
+                                "pending": {}}
+        return self.OK
+
+    async def cmd_xreadgroup(self, *args):
+        options = {}
+        position = 0
+        while args[position].upper() != b"STREAMS":
+            option = args[position].upper()
+            if option == b"GROUP":
+                options["group"], options["consumer"] = args[position + 1], args[position + 2]
+                position += 3
+            elif option in (b"COUNT", b"BLOCK"):
+                options[option.decode().lower()] = int(args[position + 1])
+                position += 2
+            else:
+                position += 1
+        key, start_id = args[position + 1], args[position + 2]
+        count = options.get("count")
+        deadline = time.monotonic() + options["block"] / 1000 if options.get("block") else None
+        while True:
+            stream = self._stream(key)
+            if stream is None or options["group"] not in stream.groups:
+                raise RedisStubError("NOGROUP No such key or consumer group")
+            group = stream.groups[options["group"]]
+            if start_id != b">":
+                # Re-read this consumer's own pending entries after `start_id`.
+                after = parse_stream_id(start_id)
+                entries = [(entry_id, stream.entries[entry_id]) for entry_id, (owner, _) in sorted(group["pending"].items())
+                           if owner == options["consumer"] and entry_id > after and entry_id in stream.entries]
+                return StreamsReply([(key, [[encode_stream_id(entry_id), fields] for entry_id, fields in entries[:count]])])
+            entries = []
+            for entry_id, fields in stream.entries.items():
+                if entry_id > group["last"]:
+                    entries.append((entry_id, fields))
+                    if count and len(entries) >= count:
+                        break
+            if entries:
+                group["last"] = entries[-1][0]
+                for entry_id, _ in entries:
+                    group["pending"][entry_id] = (options["consumer"], time.monotonic())
+                return StreamsReply([(key, [[encode_stream_id(entry_id), fields] for entry_id, fields in entries])])
+            if "block" not in options:
+                return None
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                return None
+            try:
+                await asyncio.wait_for(stream.added.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+    def cmd_xack(self, key, group, *entry_ids):
+        stream = self._stream(key)
+        pending = stream.groups[group]["pending"] if stream and group in stream.groups else {}
+        return sum(pending.pop(parse_stream_id(entry_id), None) is not None for entry_id in entry_ids)
+
+    def cmd_xautoclaim(self, key, group, consumer, min_idle_ms, start_id, *options):
+        count = int(options[1]) if len(options) > 1 and options[0].upper() == b"COUNT" else 100
+        stream = self._stream(key)
+        pending = stream.groups[group]["pending"]
+        start, now = parse_stream_id(start_id), time.monotonic()
+        claimed, deleted, next_id = [], [], (0, 0)
+        for entry_id in sorted(pending):
+            if entry_id < start or now - pending[entry_id][1] < int(min_idle_ms) / 1000:
+                continue
+            if len(claimed) + len(deleted) >= count:
+                next_id = entry_id
+                break
+            if entry_id not in stream.entries:
+                del pending[entry_id]
+                deleted.append(encode_stream_id(entry_id))
+                continue
+            pending[entry_id] = (consumer, now)
+            claimed.append([encode_stream_id(entry_id), stream.entries[entry_id]])
+        return [encode_stream_id(next_id), claimed, deleted]
+
+    def cmd_hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def cmd_mget(self, *keys):
+        return [self.cmd_get(key) for key in keys]
+
+    def cmd_scan(self, cursor, *options):
+        # The whole keyspace is returned in one page; callers must still loop until cursor 0.
+        pattern = b"*"
+        for option, value in zip(options[::2], options[1::2]):
+            if option.lower() == b"match":
+                pattern = value
+        return [b"0", [key for key in self.data if fnmatch.fnmatchcase(key.decode(), pattern.decode())]]
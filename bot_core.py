@@ -0,0 +1,655 @@
+"""
+Handler core shared by the webhook (`telegram_webhook.py`) and polling
+(`telegram_bot_accelerator.py`) transports: configuration, the Redis-backed session store,
+the update handlers and the PTB application setup.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Union, TypedDict
+import httpx
+from redis.exceptions import RedisError
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyParameters
+from telegram import __version__ as TG_VER
+from telegram.error import BadRequest, Forbidden
+from telegram.ext import (
+    Application,
+    CallbackContext,
+    ContextTypes,
+    ExtBot,
+)
+from adaptive import ADAPTIVE_CONCURRENCY, AdaptiveLimiter
+from backend_schema import QueryOutput, QueryResponse, decode_query_response
+from backends import BackendPool, backend_client, is_replica_failure
+from batcher import query_batcher
+from config import LANGUAGES
+from deferred import DEFERRED_ANSWERS, DeferredAnswers
+from delivery import send_markdown
+from lanes import Lane, LaneUpdateProcessor, mark_failed
+from logger import logger
+from ratelimit import QUERY_RATE_LIMIT_PER_MINUTE, QueryRateLimiter
+from redis_clients import REDIS_MODE, create_redis_client, redis_host, redis_port
+from redis_persistence import RedisPersistence
+from router import UpdateRouter
+from session_store import SessionStore, create_session_store
+from tenants import BotTenant, load_tenants
+from metrics import (
+    UPDATE_QUEUE_DEPTH, TELEMETRY_BUFFER_SIZE, InstrumentedHTTPXRequest, observe_handler,
+    observe_backend_call,
+)
+from telemetry_logger import TelemetryLogger
+from tracing import span, trace_handler
+
+telemetryLogger = TelemetryLogger()
+
+# Define configuration constants
+DEFAULT_LANG = "en"
+# The bots served by this process, see tenants.py
+TENANTS = load_tenants()
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot")
+TELEGRAM_API_FILE_URL = os.getenv("TELEGRAM_API_FILE_URL", "https://api.telegram.org/file/bot")
+botName = ", ".join(tenant.name for tenant in TENANTS.values())
+pool_time_out = int(os.getenv('pool_timeout', '30'))
+connection_pool_size = int(os.getenv('connection_pool_size', '1024'))
+connect_time_out = int(os.getenv('connect_timeout', '300'))
+read_time_out = int(os.getenv('read_timeout', '15'))
+write_time_out = int(os.getenv('write_timeout', '10'))
+backend_concurrency = int(os.getenv('BACKEND_CONCURRENCY', '256'))
+user_data_persistence = os.getenv("USER_DATA_PERSISTENCE", "true").lower() == "true"
+user_data_cache_size = int(os.getenv("USER_DATA_CACHE_SIZE", "100000"))
+user_data_flush_interval = float(os.getenv("USER_DATA_FLUSH_INTERVAL", "5"))
+user_data_ttl = int(os.getenv("USER_DATA_TTL", "0")) or None
+
+
+print("----Redis host is :------",redis_host)
+print("----Redis port is :------",redis_port)
+print("----Redis mode is :------",REDIS_MODE)
+try:
+    from telegram import __version_info__
+except ImportError:
+    __version_info__ = (0, 0, 0, 0, 0)  # type: ignore[assignment]
+
+if __version_info__ < (20, 0, 0, "alpha", 1):
+    raise RuntimeError(
+        f"This example is not compatible with your current PTB version {TG_VER}. To view the "
+        f"{TG_VER} version of this example, "
+        f"visit https://docs.python-telegram-bot.org/en/v{TG_VER}/examples.html"
+    )
+
+# Connect to Redis
+redis_client = create_redis_client()
+# Used on the event loop by the handlers (profile loads, rate limits, deferred answers)
+async_redis_client = create_redis_client(use_asyncio=True)
+
+print("----Redis client is :------",redis_client)
+
+# Per-user language and bot selection, per bot, in Redis or SQLite (SESSION_BACKEND)
+session_stores = {
+    bot_id: create_session_store(redis_client, tenant.session_namespace, async_redis=async_redis_client)
+    for bot_id, tenant in TENANTS.items()
+}
+
+# Bounds concurrent backend queries; tuned at runtime when ADAPTIVE_CONCURRENCY is enabled
+backend_lane = Lane("backend", backend_concurrency)
+backend_limiter = AdaptiveLimiter(backend_lane) if ADAPTIVE_CONCURRENCY else None
+
+# Per-chat token buckets for queries, shared by all workers through Redis
+query_rate_limiter = QueryRateLimiter(async_redis_client) if QUERY_RATE_LIMIT_PER_MINUTE > 0 else None
+
+# Retry queue for queries the backend failed to answer, see deferred.py
+deferred_answers = DeferredAnswers(async_redis_client) if DEFERRED_ANSWERS else None
+
+
+@dataclass
+class WebhookUpdate:
+    """Simple dataclass to wrap a custom update type"""
+    user_id: int
+    payload: str
+
+
+class CustomContext(CallbackContext[ExtBot, dict, dict, dict]):
+    """
+    Custom CallbackContext class that makes `user_data` available for updates of type
+    `WebhookUpdate` and exposes the configuration of the bot the update was sent to.
+    """
+
+    @property
+    def tenant(self) -> BotTenant:
+        return self.application.bot_data["tenant"]
+
+    @property
+    def session_store(self) -> SessionStore:
+        return self.application.bot_data["session_store"]
+
+    @classmethod
+    def from_update(
+            cls,
+            update: object,
+            application: "Application",
+    ) -> "CustomContext":
+        if isinstance(update, WebhookUpdate):
+            return cls(application=application, user_id=update.user_id)
+        return super().from_update(update, application)
+
+
+class ApiError(TypedDict):
+    error: Union[str, httpx.HTTPError]
+
+
+async def get_user_profile(update: Update, context: CustomContext):
+    """Return the user's `(language, bot)` selection, with defaults, in a single Redis round trip."""
+    with span("profile_load"):
+        selected_lang, selected_bot = await context.session_store.load_profile(update.effective_chat.id)
+    return selected_lang or DEFAULT_LANG, selected_bot or context.tenant.default_bot
+
+
+async def get_user_langauge(update: Update, context: CustomContext) -> str:
+    return (await get_user_profile(update, context))[0]
+
+
+async def get_user_bot(update: Update, context: CustomContext) -> str:
+    return (await get_user_profile(update, context))[1]
+
+
+async def send_message_to_bot(chat_id, text, context: CustomContext, parse_mode="Markdown", ) -> None:
+    """Send a message  to bot"""
+    await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+
+
+async def start(update: Update, context: CustomContext) -> None:
+    """Send a message when the command /start is issued."""
+    user_name = update.message.chat.first_name
+    logger.info({"id": update.effective_chat.id, "username": user_name, "category": "logged_in", "label": "logged_in"})
+    await send_message_to_bot(update.effective_chat.id, context.tenant.welcome_message, context)
+    await language_handler(update, context)
+
+
+def create_language_keyboard(supported_languages):
+    """Creates an inline keyboard markup with buttons for supported languages."""
+    inline_keyboard_buttons = []
+    for language in LANGUAGES:
+        if language["code"] in supported_languages:
+            button = InlineKeyboardButton(
+                text=language["text"], callback_data=f"lang_{language['code']}"
+            )
+            inline_keyboard_buttons.append([button])
+    return inline_keyboard_buttons
+
+
+async def language_handler(update: Update, context: CustomContext):
+    inline_keyboard_buttons = create_language_keyboard(context.tenant.supported_languages)
+    reply_markup = InlineKeyboardMarkup(inline_keyboard_buttons)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="\nPlease select a Language to proceed", reply_markup=reply_markup)
+
+
+async def preferred_language_callback(update: Update, context: CustomContext):
+    callback_query = update.callback_query
+    preferred_language = context.args[0]
+    context.user_data['language'] = preferred_language
+    await context.session_store.save_language(update.effective_chat.id, preferred_language)
+    logger.info(
+        {"id": update.effective_chat.id, "username": update.effective_chat.first_name, "category": "language_selection",
+         "label": "engine_selection", "value": preferred_language})
+    await callback_query.answer()
+    await bot_handler(update, context, preferred_language)
+    # return query_handler
+
+
+async def bot_handler(update: Update, context: CustomContext, language=None):
+    language = language or await get_user_langauge(update, context)
+    button_labels = getMessage(update, context, context.tenant.catalog["BOT_NAME"], language)
+    inline_keyboard_buttons = [
+        [InlineKeyboardButton(button_labels[bot_name], callback_data=f'botname_{bot_name}')]
+        for bot_name in context.tenant.supported_bots
+    ]
+    reply_markup = InlineKeyboardMarkup(inline_keyboard_buttons)
+    text_message = getMessage(update, context, context.tenant.catalog["LANGUAGE_SELCTION"], language)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text_message, reply_markup=reply_markup, parse_mode="Markdown")
+
+
+async def preferred_bot_callback(update: Update, context: CustomContext):
+    callback_query = update.callback_query
+    preferred_bot = context.args[0]
+    context.user_data['botname'] = preferred_bot
+    _, language = await asyncio.gather(context.session_store.save_bot(update.effective_chat.id, preferred_bot),
+                                       get_user_langauge(update, context))
+    text_msg = getMessage(update, context, context.tenant.catalog["BOT_SELECTION"], language)[preferred_bot]
+    logger.info({"id": update.effective_chat.id, "username": update.effective_chat.first_name, "category": "bot_selection", "label": "bot_selection", "value": preferred_bot})
+    await callback_query.answer()
+    await context.bot.sendMessage(chat_id=update.effective_chat.id, text=text_msg, parse_mode="Markdown")
+
+
+async def help_command(update: Update, context: CustomContext) -> None:
+    """Send a message when the command /help is issued."""
+    await update.message.reply_text("Help!")
+
+
+def getMessage(update: Update, context: CustomContext, mapping, language):
+    """Pick the `language` entry of a message catalog; callers load the language beforehand."""
+    selectedLang = language
+    try:
+        return mapping[selectedLang]
+    except:
+        return mapping[DEFAULT_LANG]
+
+
+def build_query_request(query: str, voice_message_url: str, language: str, selected_bot: str) -> dict:
+    """Build the backend request body for a text or voice query."""
+    reqBody: dict
+    if voice_message_url is None:
+        reqBody = {
+            "input": {
+                "language": language,
+                "text": query
+            },
+            "output": {
+                'format': 'text'
+            }
+        }
+    else:
+        reqBody = {
+            "input": {
+                "language": language,
+                "audio": voice_message_url
+            },
+            "output": {
+                'format': 'audio'
+            }
+        }
+
+    if selected_bot != "story":
+        reqBody["input"]["audienceType"] = selected_bot
+    return reqBody
+
+
+async def get_query_response(query: str, voice_message_url: str, update: Update, context: CustomContext,
+                             profile=None) -> Union[QueryResponse, ApiError]:
+    voice_message_language, selected_bot = profile or await get_user_profile(update, context)
+    context.user_data['language'] = voice_message_language
+    context.user_data['botname'] = selected_bot
+    logger.info({"id": update.effective_chat.id, "username": update.effective_chat.first_name, "language_selected": voice_message_language, "bot_selected": selected_bot})
+    return await query_backend(context.tenant, selected_bot, voice_message_language, query, voice_message_url,
+                               update.message.from_user.id, update.message.message_id)
+
+
+async def query_backend(tenant: BotTenant, selected_bot: str, voice_message_language: str, query: str,
+                        voice_message_url: str, user_id: int, message_id: int) -> Union[QueryResponse, ApiError]:
+    """Ask the backend of `selected_bot` one question, within the backend concurrency limit."""
+    pool, path = tenant.backend_for(selected_bot)
+    try:
+        reqBody = build_query_request(query, voice_message_url, voice_message_language, selected_bot)
+        logger.info(f" API Request Body: {reqBody}")
+        headers = {
+            "x-source": "telegram",
+            "x-request-id": str(message_id),
+            "x-device-id": f"d{user_id}",
+            "x-consumer-id": str(user_id)
+        }
+        async with backend_lane:
+            start_time = time.perf_counter()
+            failed = True
+            try:
+                data = await call_backend(pool, path, voice_message_language, reqBody, headers)
+                failed = False
+                return data
+            finally:
+                if backend_limiter is not None:
+                    backend_limiter.observe(time.perf_counter() - start_time, failed)
+    except httpx.HTTPError as e:
+        return {'error': e}
+    except ValueError as e:
+        # Malformed body or schema mismatch, see backend_schema.py
+        return {'error': f'Invalid response received from API: {e}'}
+
+
+async def call_backend(pool: BackendPool, path: str, language: str, reqBody: dict, headers: dict) -> QueryResponse:
+    """Send one query to a replica of the backend picked by the pool's load balancing."""
+    replica = pool.acquire()
+    if query_batcher is not None:
+        # The batcher releases the replica, with one outcome per batch rather than per query.
+        with span("backend_call", url=replica.url + path, batched=True):
+            return await query_batcher.submit(pool, replica, replica.url + path, language, reqBody, headers)
+    failed = False
+    try:
+        return await post_query(replica.url + path, language, reqBody, headers)
+    except httpx.HTTPError as e:
+        failed = is_replica_failure(e)
+        raise
+    finally:
+        pool.release(replica, failed)
+
+
+async def post_query(url: str, language: str, reqBody: dict, headers: dict) -> QueryResponse:
+    """Send one query to the backend."""
+    start_time = time.perf_counter()
+    try:
+        with span("backend_call", url=url):
+            response = await backend_client.post(url, content=json.dumps(reqBody), headers=headers)
+    except httpx.HTTPError as e:
+        observe_backend_call(url, type(e).__name__, time.perf_counter() - start_time)
+        raise
+    observe_backend_call(url, response.status_code, time.perf_counter() - start_time)
+    response.raise_for_status()
+    return decode_query_response(response.content)
+
+
+async def response_handler(update: Update, context: CustomContext) -> None:
+    await query_handler(update, context)
+
+
+async def query_handler(update: Update, context: CustomContext):
+    voice_message = None
+    query = None
+    if update.message.text:
+        query = update.message.text
+        logger.info({"id": update.effective_chat.id, "username": update.effective_chat.first_name, "category": "query_handler", "label": "question", "value": query})
+    elif update.message.voice:
+        voice_message = update.message.voice
+
+    # Profile load and file resolution are independent of each other; the loading message
+    # only needs the profile and is sent while the file is resolved and the backend answers.
+    profile_task = asyncio.create_task(get_user_profile(update, context))
+    try:
+        allowed = query_rate_limiter is None or await query_rate_limiter.allow(
+            update.effective_chat.id, context.tenant.session_namespace)
+    except BaseException:
+        profile_task.cancel()
+        raise
+    if not allowed:
+        # Over the chat's query rate: reply without touching the backend.
+        profile = await profile_task
+        logger.info({"id": update.effective_chat.id, "category": "query_handler", "label": "rate_limited"})
+        await send_message_to_bot(update.effective_chat.id, getMessage(
+            update, context, context.tenant.catalog["RATE_LIMIT_MSG"], profile[0]), context)
+        return query_handler
+    voice_file_task = asyncio.create_task(resolve_file(voice_message)) if voice_message is not None else None
+    try:
+        profile = await profile_task
+    except BaseException:
+        # Nobody will await the file lookup now; cancel it rather than leak it.
+        if voice_file_task is not None:
+            voice_file_task.cancel()
+        raise
+    loading_message = asyncio.create_task(context.bot.send_message(
+        chat_id=update.effective_chat.id, text=getMessage(update, context, context.tenant.catalog["BOT_LODING_MSG"], profile[0])))
+    voice_message_url = None
+    try:
+        if voice_file_task is not None:
+            voice_message_url = (await voice_file_task).file_path
+            logger.info({"id": update.effective_chat.id, "username": update.effective_chat.first_name, "category": "query_handler", "label": "voice_question", "value": voice_message_url})
+        await handle_query_response(update, context, query, voice_message_url, profile, loading_message)
+    finally:
+        # Surface a failed loading message even if the query failed first.
+        await loading_message
+    return query_handler
+
+
+async def resolve_file(voice_message):
+    with span("get_file"):
+        return await voice_message.get_file()
+
+
+async def relay_audio(bot, chat_id: int, audio_output_url: str, **kwargs):
+    with span("audio_relay", url=audio_output_url):
+        audio_request = await backend_client.get(audio_output_url)
+        audio_data = audio_request.content
+        await bot.send_voice(chat_id=chat_id, voice=audio_data, **kwargs)
+
+
+async def handle_query_response(update: Update, context: CustomContext, query: str, voice_message_url: str,
+                                profile=None, loading_message=None):
+    response = await get_query_response(query, voice_message_url, update, context, profile)
+    if loading_message is not None:
+        # Replies must not overtake the loading message.
+        await loading_message
+    language = profile[0] if profile else await get_user_langauge(update, context)
+    if not isinstance(response, QueryResponse):
+        mark_failed()
+        error_msg = getMessage(update, context, context.tenant.catalog["API_ERROR_MSG"], language)
+        if await defer_query(update, context, query, voice_message_url, profile, response["error"]):
+            error_msg = getMessage(update, context, context.tenant.catalog["DEFERRED_ANSWER_MSG"], language)
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=error_msg)
+        info_msg = {"id": update.effective_chat.id, "username": update.effective_chat.first_name,
+                    "category": "handle_query_response", "label": "question_sent", "value": query}
+        logger.info(info_msg)
+        merged = dict()
+        merged.update(info_msg)
+        merged.update(response)
+        logger.error(merged)
+    else:
+        logger.info({"id": update.effective_chat.id, "username": update.effective_chat.first_name,
+                     "category": "handle_query_response", "label": "answer_received", "value": query})
+        await send_answer(context.bot, update.effective_chat.id, update.message.id, response.output)
+
+
+async def send_answer(bot, chat_id: int, message_id: int, output: QueryOutput, **kwargs):
+    """Send the backend's answer to the question `message_id`, with the feedback prompt."""
+    answer = output.text
+    keyboard = [
+        [InlineKeyboardButton("👍🏻", callback_data=f'message-liked__{message_id}'),
+         InlineKeyboardButton("👎🏻", callback_data=f'message-disliked__{message_id}')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_markdown(bot, chat_id, answer, **kwargs)
+    # The feedback prompt and the voice answer only depend on the text answer being sent.
+    follow_ups = [bot.send_message(chat_id=chat_id, text="Please provide your feedback", parse_mode="Markdown", reply_markup=reply_markup)]
+    if output.audio:
+        follow_ups.append(relay_audio(bot, chat_id, output.audio, **kwargs))
+    await asyncio.gather(*follow_ups)
+
+
+async def defer_query(update: Update, context: CustomContext, query: str, voice_message_url: str, profile,
+                      error) -> bool:
+    """Queue a query the backend failed to answer for a late reply; False if it is not deferred."""
+    if deferred_answers is None or isinstance(error, str) or not is_replica_failure(error):
+        return False
+    language, selected_bot = profile or await get_user_profile(update, context)
+    job_id = f"{context.tenant.bot_id}:{update.effective_chat.id}:{update.message.message_id}"
+    try:
+        await deferred_answers.defer(job_id, {
+            "bot_id": context.tenant.bot_id, "chat_id": update.effective_chat.id,
+            "user_id": update.message.from_user.id, "message_id": update.message.message_id,
+            "language": language, "bot": selected_bot, "query": query, "voice_url": voice_message_url,
+        })
+    except RedisError as e:
+        logger.error(f"Could not defer query {job_id}: {e}")
+        return False
+    return True
+
+
+async def answer_deferred_query(applications: dict, job: dict) -> bool:
+    """Retry a deferred query and reply to the original message; False if the backend failed again."""
+    application = applications.get(job["bot_id"])
+    if application is None:
+        return True
+    tenant = application.bot_data["tenant"]
+    response = await query_backend(tenant, job["bot"], job["language"], job["query"], job["voice_url"],
+                                   job["user_id"], job["message_id"])
+    if isinstance(response, QueryResponse):
+        reply = ReplyParameters(job["message_id"], allow_sending_without_reply=True)
+        try:
+            await send_answer(application.bot, job["chat_id"], job["message_id"], response.output,
+                              reply_parameters=reply)
+        except (Forbidden, BadRequest) as e:
+            # The chat is gone or blocked the bot; retrying will not help.
+            logger.warning(f"Could not deliver deferred answer to {job['chat_id']}: {e}")
+    elif isinstance(response["error"], str) or not is_replica_failure(response["error"]):
+        await give_up_deferred_query(applications, job)
+    else:
+        return False
+    return True
+
+
+async def give_up_deferred_query(applications: dict, job: dict) -> None:
+    """Tell the user, in reply to their question, that a deferred query will not be answered."""
+    application = applications.get(job["bot_id"])
+    if application is None:
+        return
+    error_msg = getMessage(None, None, application.bot_data["tenant"].catalog["API_ERROR_MSG"], job["language"])
+    reply = ReplyParameters(job["message_id"], allow_sending_without_reply=True)
+    try:
+        await application.bot.send_message(chat_id=job["chat_id"], text=error_msg, reply_parameters=reply)
+    except (Forbidden, BadRequest) as e:
+        logger.warning(f"Could not deliver deferred answer to {job['chat_id']}: {e}")
+
+
+async def drain_deferred_answers(applications: dict) -> None:
+    """Answer deferred queries as the backend recovers; returns at once unless `DEFERRED_ANSWERS` is set."""
+    if deferred_answers is not None:
+        await deferred_answers.drain(lambda job: answer_deferred_query(applications, job),
+                                     lambda job: give_up_deferred_query(applications, job))
+
+
+def parse_feedback_data(rest: str) -> list:
+    """`liked__11` (from `message-liked__11`) -> [`message-liked`, `11`]."""
+    vote, _, message_id = rest.partition("__")
+    return [f"message-{vote}", message_id]
+
+
+async def preferred_feedback_callback(update: Update, context: CustomContext) -> None:
+    """Parses the CallbackQuery and updates the message text."""
+    query = update.callback_query
+    queryData = context.args
+    selected_bot = await get_user_bot(update, context)
+    user_id = update.callback_query.from_user.id
+    eventData = {
+        "x-source": "telegram",
+        "x-request-id": str(queryData[1]),
+        "x-device-id": f"d{user_id}",
+        "x-consumer-id": str(user_id),
+        "subtype": queryData[0],
+        "edataId": selected_bot
+    }
+    interectEvent = telemetryLogger.prepare_interect_event(eventData)
+    telemetryLogger.add_event(interectEvent)
+    # # CallbackQueries need to be answered, even if no notification to the user is needed
+    # # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
+    await query.answer("Thanks for your feedback.")
+    # await query.delete_message()
+    thumpUpIcon = "👍" if queryData[0] == "message-liked" else "👍🏻"
+    thumpDownIcon = "👎" if queryData[0] == "message-disliked" else "👎🏻"
+    keyboard = [
+        [InlineKeyboardButton(thumpUpIcon, callback_data='replymessage_liked'),
+         InlineKeyboardButton(thumpDownIcon, callback_data='replymessage_disliked')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text("Please provide your feedback:", reply_markup=reply_markup)
+
+
+async def preferred_feedback_reply_callback(update: Update, context: CustomContext) -> None:
+    """Parses the CallbackQuery and updates the message text."""
+    query = update.callback_query
+    # # CallbackQueries need to be answered, even if no notification to the user is needed
+    # # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
+    await query.answer()
+
+
+def instrumented(callback, name=None):
+    """Wrap a handler callback with latency metrics and per-update tracing."""
+    return observe_handler(trace_handler(callback, name), name)
+
+
+def register_handlers(application: Application) -> None:
+    """
+    Register the bot's command, callback query and message routes.
+
+    All routes live in one `UpdateRouter` (`router.py`), which finds an update's callback
+    with a table lookup and passes the parsed callback data in `context.args`. The router
+    blocks so that the update's execution lane (`lanes.py`) stays occupied until the
+    callback has finished.
+    """
+    router = UpdateRouter(block=True)
+    router.command("start", instrumented(start))
+    router.command("help", instrumented(help_command))
+    router.command("select_language", instrumented(language_handler))
+    router.command("select_bot", instrumented(bot_handler))
+    router.callback_query("lang_", instrumented(preferred_language_callback))
+    router.callback_query("botname_", instrumented(preferred_bot_callback))
+    router.callback_query("message-", instrumented(preferred_feedback_callback), parse=parse_feedback_data)
+    router.callback_query("replymessage_", instrumented(preferred_feedback_reply_callback))
+    router.message(instrumented(response_handler, name="query_handler"))
+    application.add_handler(router)
+
+
+def build_application(tenant: BotTenant, request, update_processor, persistence_redis=None,
+                      get_updates_request=None) -> Application:
+    """
+    Build the PTB application of one bot.
+
+    Updates are fed into `application.update_queue` by the transport, so no `Updater` is
+    created here.
+    """
+    context_types = ContextTypes(context=CustomContext)
+    builder = Application.builder().token(tenant.token).base_url(TELEGRAM_API_BASE_URL).base_file_url(TELEGRAM_API_FILE_URL).updater(None).context_types(context_types).request(request).concurrent_updates(update_processor)
+    if get_updates_request is not None:
+        builder = builder.get_updates_request(get_updates_request)
+    persistence = None
+    if persistence_redis is not None:
+        key_prefix = f"ptb:{tenant.session_namespace}:user_data:" if tenant.session_namespace else "ptb:user_data:"
+        persistence = RedisPersistence(
+            persistence_redis, key_prefix=key_prefix, max_cached_users=user_data_cache_size,
+            update_interval=user_data_flush_interval, ttl=user_data_ttl
+        )
+        builder = builder.persistence(persistence)
+    application = builder.build()
+    if persistence is not None:
+        persistence.on_evict = application.drop_user_data
+    application.bot_data["tenant"] = tenant
+    application.bot_data["session_store"] = session_stores[tenant.bot_id]
+
+    # register handlers
+    register_handlers(application)
+    return application
+
+
+def build_applications(get_updates_request_factory=None) -> dict:
+    """
+    Build one PTB application per configured bot, keyed by bot id, for the webhook and
+    polling transports.
+
+    The bots share one Telegram connection pool, one set of execution lanes and one Redis
+    client; `get_updates_request_factory()` is called once per bot when polling.
+    """
+    request = InstrumentedHTTPXRequest(
+        connection_pool_size=connection_pool_size, pool_timeout=pool_time_out, connect_timeout=connect_time_out,
+        read_timeout=read_time_out, write_timeout=write_time_out
+    )
+    update_processor = LaneUpdateProcessor()
+    persistence_redis = create_redis_client(use_asyncio=True) if user_data_persistence else None
+    applications = {
+        bot_id: build_application(
+            tenant, request, update_processor, persistence_redis,
+            get_updates_request_factory() if get_updates_request_factory is not None else None,
+        )
+        for bot_id, tenant in TENANTS.items()
+    }
+    UPDATE_QUEUE_DEPTH.set_function(lambda: sum(app.update_queue.qsize() for app in applications.values()))
+    TELEMETRY_BUFFER_SIZE.set_function(lambda: len(telemetryLogger.events))
+    return applications
+
+
+@contextlib.asynccontextmanager
+async def run_applications(applications: dict, before_start=None):
+    """
+    Initialize and start every application for the duration of the block.
+
+    On exit every application is stopped before any of them is shut down: they share one
+    Telegram request object, and the first `Bot.shutdown()` closes its connection pool
+    under the bots that are still finishing their updates. `before_start(application)` runs
+    after initialization.
+    """
+    async with contextlib.AsyncExitStack() as shutdown_stack:
+        for application in applications.values():
+            await shutdown_stack.enter_async_context(application)
+        async with contextlib.AsyncExitStack() as stop_stack:
+            for application in applications.values():
+                if before_start is not None:
+                    await before_start(application)
+                await application.start()
+                stop_stack.push_async_callback(application.stop)
+            yield
+
+
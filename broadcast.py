@@ -0,0 +1,240 @@
+"""
+Rate-limited, resumable broadcast of an announcement to every user of a bot.
+
+Walks the session buckets of `session_store.py` with SCAN, groups the users of each batch
+by their stored language and sends each user the announcement in that language (falling
+back to `--default-language`) at no more than `--rate` messages per second. Telegram allows
+about 30 messages per second for bulk notifications; a `RetryAfter` from Telegram pauses
+all sends for the requested time.
+
+Progress is checkpointed in Redis per campaign, so an interrupted broadcast resumes with
+the same `--campaign` without resending:
+
+    broadcast:{campaign}         hash: SCAN cursor per node
+    broadcast:{campaign}:sent    set: chat ids already claimed for sending
+
+A user is claimed right before the message goes out, so a crash can at worst drop the
+few messages in flight at that moment, never send one twice.
+
+The announcement file is JSON mapping language codes to Markdown text:
+
+    {"en": "The scheme deadline is *31 March*.", "hi": "..."}
+
+Usage:
+    python broadcast.py announcement.json --campaign deadline-2026 [--bot-id farmpulse]
+        [--rate 25] [--batch-size 200] [--default-language en] [--dry-run]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+
+from delivery import send_markdown
+from redis_clients import ShardedRedis, create_redis_client
+from session_store import SESSION_BACKEND, SESSION_BUCKET_SIZE, unpack
+from tenants import load_tenants
+
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot")
+CHECKPOINT_TTL = 30 * 24 * 3600
+SEND_ATTEMPTS = 3
+_BUCKET = re.compile(rb"\{(-?\d+)\}$")
+
+
+def scan_nodes(redis_client):
+    """Return `(name, client)` for every node to SCAN; cursors are only meaningful per node."""
+    if isinstance(redis_client, ShardedRedis):
+        return list(redis_client.clients.items())
+    if hasattr(redis_client, "get_primaries"):
+        return [(node.name, node.redis_connection) for node in redis_client.get_primaries()]
+    return [("default", redis_client)]
+
+
+def bucket_pattern(namespace: str) -> str:
+    return f"session:{namespace}:{{*" if namespace else "session:{*"
+
+
+def read_buckets(client, keys):
+    """Return `{chat_id: language}` for every user stored in the given bucket keys."""
+    pipeline = client.pipeline(transaction=False)
+    for key in keys:
+        pipeline.hgetall(key)
+    users = {}
+    for key, bucket in zip(keys, pipeline.execute()):
+        match = _BUCKET.search(key)
+        if match is None:
+            continue
+        base = int(match.group(1)) * SESSION_BUCKET_SIZE
+        for field, packed in bucket.items():
+            users[base + int(field)] = unpack(packed)[0]
+    return users
+
+
+class Pacer:
+    """Spaces sends to at most `rate` per second and lets a `RetryAfter` pause all of them."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_send = time.monotonic()
+        self.paused_until = 0.0
+
+    async def wait(self):
+        while True:
+            now = time.monotonic()
+            ready = max(self.next_send, self.paused_until)
+            if ready <= now:
+                self.next_send = max(self.next_send + self.interval, now)
+                return
+            await asyncio.sleep(ready - now)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class Broadcast:
+    def __init__(self, redis_client, bot, messages, campaign, namespace="", rate=25.0,
+                 default_language="en", batch_size=200, dry_run=False):
+        self.redis = redis_client
+        self.bot = bot
+        self.messages = messages
+        self.namespace = namespace
+        self.default_language = default_language
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.pacer = Pacer(rate)
+        self.state_key = f"broadcast:{campaign}"
+        self.sent_key = f"broadcast:{campaign}:sent"
+        self.counts = {"scanned": 0, "sent": 0, "blocked": 0, "failed": 0, "skipped": 0, "resumed": 0}
+        self.started_at = time.monotonic()
+        self.last_report = 0.0
+
+    def message_for(self, language):
+        return self.messages.get(language) or self.messages.get(self.default_language)
+
+    async def run(self):
+        for node, client in scan_nodes(self.redis):
+            await self.run_node(node, client)
+        self.report(final=True)
+
+    async def run_node(self, node, client):
+        cursor_field = f"cursor:{node}"
+        cursor = self.redis.hget(self.state_key, cursor_field)
+        if cursor == b"done":
+            return
+        cursor = int(cursor or 0)
+        while True:
+            cursor, keys = client.scan(cursor, match=bucket_pattern(self.namespace), count=self.batch_size)
+            if keys:
+                await self.send_batch(read_buckets(client, keys))
+            if not self.dry_run:
+                # Only checkpoint a cursor once every user before it has been handled.
+                pipeline = self.redis.pipeline(transaction=False)
+                pipeline.hset(self.state_key, cursor_field, cursor or "done")
+                pipeline.expire(self.state_key, CHECKPOINT_TTL)
+                pipeline.execute()
+            if cursor == 0:
+                return
+
+    async def send_batch(self, users):
+        self.counts["scanned"] += len(users)
+        chat_ids = list(users)
+        pipeline = self.redis.pipeline(transaction=False)
+        for chat_id in chat_ids:
+            pipeline.sismember(self.sent_key, chat_id)
+        already_sent = pipeline.execute()
+        by_language = {}
+        for chat_id, sent in zip(chat_ids, already_sent):
+            if sent:
+                self.counts["resumed"] += 1
+            else:
+                by_language.setdefault(users[chat_id], []).append(chat_id)
+        tasks = []
+        for language, language_chat_ids in by_language.items():
+            text = self.message_for(language)
+            if text is None:
+                self.counts["skipped"] += len(language_chat_ids)
+                continue
+            for chat_id in language_chat_ids:
+                await self.pacer.wait()
+                tasks.append(asyncio.ensure_future(self.send(chat_id, text)))
+                self.report()
+        await asyncio.gather(*tasks)
+
+    async def send(self, chat_id, text):
+        if not self.dry_run:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.sadd(self.sent_key, chat_id)
+            pipeline.expire(self.sent_key, CHECKPOINT_TTL)
+            if not pipeline.execute()[0]:
+                self.counts["resumed"] += 1
+                return
+        outcome = "failed"
+        for attempt in range(SEND_ATTEMPTS):
+            if self.dry_run:
+                outcome = "sent"
+                break
+            try:
+                await send_markdown(self.bot, chat_id, text)
+                outcome = "sent"
+                break
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self.pacer.pause(retry_after)
+                await self.pacer.wait()
+            except (Forbidden, BadRequest):
+                # The user blocked the bot or the chat no longer exists; retrying will not help.
+                outcome = "blocked"
+                break
+            except TelegramError:
+                await asyncio.sleep(2 ** attempt)
+        self.counts[outcome] += 1
+
+    def report(self, final=False):
+        now = time.monotonic()
+        if not final and now - self.last_report < 5:
+            return
+        self.last_report = now
+        elapsed = now - self.started_at
+        handled = self.counts["sent"] + self.counts["blocked"] + self.counts["failed"]
+        summary = "  ".join(f"{name} {count}" for name, count in self.counts.items())
+        prefix = "done: " if final else ""
+        print(f"{prefix}{summary}  rate {handled / max(elapsed, 1e-9):.1f} msg/s  elapsed {elapsed:.0f}s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("messages", help="JSON file mapping language codes to the announcement text")
+    parser.add_argument("--campaign", required=True, help="checkpoint name; re-use it to resume")
+    parser.add_argument("--bot-id", help="bot to broadcast from (default: the first configured bot)")
+    parser.add_argument("--rate", type=float, default=25.0, help="messages per second (Telegram allows ~30)")
+    parser.add_argument("--batch-size", type=int, default=200, help="SCAN count, in session buckets")
+    parser.add_argument("--default-language", default="en", help="announcement language for other users")
+    parser.add_argument("--dry-run", action="store_true", help="count recipients without sending or checkpointing")
+    args = parser.parse_args()
+    if SESSION_BACKEND != "redis":
+        parser.error("broadcasts walk the Redis session buckets and need SESSION_BACKEND=redis")
+
+    with open(args.messages, encoding="utf-8") as messages_file:
+        messages = json.load(messages_file)
+    tenants = load_tenants()
+    tenant = tenants[args.bot_id] if args.bot_id else next(iter(tenants.values()))
+    bot = Bot(tenant.token, base_url=TELEGRAM_API_BASE_URL, request=HTTPXRequest(connection_pool_size=32))
+    broadcast = Broadcast(
+        create_redis_client(), bot, messages, args.campaign, namespace=tenant.session_namespace, rate=args.rate,
+        default_language=args.default_language, batch_size=args.batch_size, dry_run=args.dry_run,
+    )
+
+    async def run():
+        async with bot:
+            await broadcast.run()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
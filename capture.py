@@ -0,0 +1,139 @@
+"""
+Opt-in capture of incoming webhook traffic for later replay.
+
+When `CAPTURE_FILE` is set, every update body received on `/telegram` is anonymized and
+appended to that file together with its arrival time and the id of the bot it was sent to
+(the `/telegram/{bot_id}` route), so multi-bot traffic replays to the same bots. Records are JSON lines written in
+gzip members, one member per flushed batch, so the file is compact, append-only and can
+be read back with `gzip.open` even after a crash (only the unflushed batch is lost).
+
+Anonymization replaces user and chat ids with keyed pseudonyms (stable within a capture,
+so per-user sequences survive), drops names, usernames, phone numbers and locations,
+pseudonymizes file ids and masks message text while keeping its length, whitespace and
+bot commands. Language codes, callback data, voice durations and timestamps are kept.
+"""
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import queue
+import re
+import threading
+import time
+
+from logger import logger
+
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "")
+CAPTURE_SALT = os.getenv("CAPTURE_SALT", "")
+CAPTURE_FLUSH_RECORDS = int(os.getenv("CAPTURE_FLUSH_RECORDS", "200"))
+CAPTURE_FLUSH_SECONDS = float(os.getenv("CAPTURE_FLUSH_SECONDS", "5"))
+
+ID_FIELDS = {"id", "user_id", "sender_chat_id", "user_chat_id"}
+ID_PARENTS = {"from", "chat", "user", "sender_chat", "sender_user", "forward_from", "forward_from_chat",
+              "new_chat_member", "old_chat_member"}
+DROPPED_FIELDS = {"first_name", "last_name", "username", "title", "bio", "phone_number", "contact", "location",
+                  "venue", "photo", "vcard"}
+FILE_ID_FIELDS = {"file_id", "file_unique_id"}
+MASKED_TEXT_FIELDS = {"text", "caption"}
+_NON_SPACE = re.compile(r"\S")
+
+
+class Anonymizer:
+    """Rewrites an update dict so it carries no personal data but keeps its shape."""
+
+    def __init__(self, salt: str):
+        # Without a configured salt a random one is used, so pseudonyms cannot be reversed
+        # by hashing known ids but are still stable for the lifetime of the process.
+        self.key = (salt or os.urandom(16).hex()).encode("utf-8")
+
+    def _digest(self, value) -> str:
+        return hmac.new(self.key, str(value).encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def pseudonym_id(self, value: int) -> int:
+        # Hash the magnitude so a private chat keeps the same pseudonym as its user.
+        pseudonym = int(self._digest(abs(value))[:12], 16)
+        return -pseudonym if value < 0 else pseudonym
+
+    @staticmethod
+    def mask_text(text: str) -> str:
+        if text.startswith("/"):
+            command, _, rest = text.partition(" ")
+            return command + (" " + _NON_SPACE.sub("x", rest) if rest else "")
+        return _NON_SPACE.sub("x", text)
+
+    def anonymize(self, value, parent=None):
+        if isinstance(value, list):
+            return [self.anonymize(item, parent) for item in value]
+        if not isinstance(value, dict):
+            return value
+        result = {}
+        for key, item in value.items():
+            if key in DROPPED_FIELDS:
+                continue
+            if key in ID_FIELDS and isinstance(item, int) and (parent in ID_PARENTS or key != "id"):
+                result[key] = self.pseudonym_id(item)
+            elif key in FILE_ID_FIELDS and isinstance(item, str):
+                result[key] = self._digest(item)[:24]
+            elif key in MASKED_TEXT_FIELDS and isinstance(item, str):
+                result[key] = self.mask_text(item)
+            else:
+                result[key] = self.anonymize(item, key)
+        return result
+
+
+class TrafficRecorder:
+    """Buffers anonymized updates and appends them to the capture file from a daemon thread."""
+
+    def __init__(self, path=CAPTURE_FILE, salt=CAPTURE_SALT):
+        self.path = path
+        self.anonymizer = Anonymizer(salt)
+        self.queue = queue.Queue(maxsize=100000)
+        self.thread = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+        self.thread.start()
+        logger.info(f"Capturing webhook traffic to {path}")
+
+    def record(self, body: dict, received_at: float, bot_id: str):
+        """Queue one update body; anonymization and I/O happen off the event loop."""
+        try:
+            self.queue.put_nowait((received_at, bot_id, body))
+        except queue.Full:
+            logger.warning("Traffic capture queue is full, dropping update")
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + CAPTURE_FLUSH_SECONDS
+        while True:
+            try:
+                received_at, bot_id, body = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                record = {"t": round(received_at, 4), "b": bot_id, "u": self.anonymizer.anonymize(body)}
+                batch.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+            except queue.Empty:
+                pass
+            if len(batch) >= CAPTURE_FLUSH_RECORDS or (batch and time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + CAPTURE_FLUSH_SECONDS
+
+    def _flush(self, batch):
+        try:
+            with gzip.open(self.path, "ab") as capture_file:
+                capture_file.write(("\n".join(batch) + "\n").encode("utf-8"))
+        except OSError as e:
+            logger.error(f"Error writing traffic capture: {e}", exc_info=True)
+
+
+def read_capture(path: str):
+    """
+    Yield `(arrival_time, bot_id, update_body)` from a capture file in recorded order; the
+    bot id is None in captures recorded before it was stored.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as capture_file:
+        for line in capture_file:
+            if line.strip():
+                record = json.loads(line)
+                yield record["t"], record.get("b"), record["u"]
+
+
+recorder = TrafficRecorder() if CAPTURE_FILE else None
@@ -467,6 +467,34 @@ API_ERROR_MSG = {
     "te": "ఏదో ఇబ్బంది సంభవించింది, దయచేసి కొంత సమయం తర్వాత ప్రయత్నించండి"
 }
 
+RATE_LIMIT_MSG = {
+    "en": "You are sending questions too quickly. Please wait a minute and try again.",
+    "hi": "आप बहुत जल्दी-जल्दी प्रश्न भेज रहे हैं। कृपया एक मिनट रुककर फिर से प्रयास करें।",
+    "bn": "আপনি খুব দ্রুত প্রশ্ন পাঠাচ্ছেন। অনুগ্রহ করে এক মিনিট অপেক্ষা করে আবার চেষ্টা করুন।",
+    "gu": "તમે ખૂબ ઝડપથી પ્રશ્નો મોકલી રહ્યા છો. કૃપા કરીને એક મિનિટ રાહ જોઈને ફરી પ્રયાસ કરો.",
+    "kn": "ನೀವು ತುಂಬಾ ವೇಗವಾಗಿ ಪ್ರಶ್ನೆಗಳನ್ನು ಕಳುಹಿಸುತ್ತಿದ್ದೀರಿ. ದಯವಿಟ್ಟು ಒಂದು ನಿಮಿಷ ಕಾಯ್ದು ಮತ್ತೆ ಪ್ರಯತ್ನಿಸಿ.",
+    "ml": "നിങ്ങൾ വളരെ വേഗത്തിൽ ചോദ്യങ്ങൾ അയയ്ക്കുന്നു. ദയവായി ഒരു മിനിറ്റ് കാത്തിരുന്ന് വീണ്ടും ശ്രമിക്കുക.",
+    "mr": "तुम्ही खूप पटापट प्रश्न पाठवत आहात. कृपया एक मिनिट थांबून पुन्हा प्रयत्न करा.",
+    "or": "ଆପଣ ବହୁତ ଶୀଘ୍ର ପ୍ରଶ୍ନ ପଠାଉଛନ୍ତି। ଦୟାକରି ଏକ ମିନିଟ୍ ଅପେକ୍ଷା କରି ପୁଣି ଚେଷ୍ଟା କରନ୍ତୁ।",
+    "pa": "ਤੁਸੀਂ ਬਹੁਤ ਤੇਜ਼ੀ ਨਾਲ ਸਵਾਲ ਭੇਜ ਰਹੇ ਹੋ। ਕਿਰਪਾ ਕਰਕੇ ਇੱਕ ਮਿੰਟ ਉਡੀਕ ਕਰਕੇ ਦੁਬਾਰਾ ਕੋਸ਼ਿਸ਼ ਕਰੋ।",
+    "ta": "நீங்கள் மிக வேகமாக கேள்விகளை அனுப்புகிறீர்கள். தயவுசெய்து ஒரு நிமிடம் காத்திருந்து மீண்டும் முயற்சிக்கவும்.",
+    "te": "మీరు చాలా వేగంగా ప్రశ్నలు పంపుతున్నారు. దయచేసి ఒక నిమిషం ఆగి మళ్లీ ప్రయత్నించండి."
+}
+
+DEFERRED_ANSWER_MSG = {
+    "en": "We could not get your answer right now. We will reply to your question here as soon as we can, there is no need to ask again.",
+    "hi": "अभी हम आपका उत्तर प्राप्त नहीं कर सके। हम जल्द से जल्द यहीं आपके प्रश्न का उत्तर देंगे, दोबारा पूछने की आवश्यकता नहीं है।",
+    "bn": "এই মুহূর্তে আমরা আপনার উত্তর পেতে পারিনি। যত তাড়াতাড়ি সম্ভব আমরা এখানেই আপনার প্রশ্নের উত্তর দেব, আবার জিজ্ঞাসা করার প্রয়োজন নেই।",
+    "gu": "અત્યારે અમે તમારો જવાબ મેળવી શક્યા નથી. અમે શક્ય તેટલી જલ્દી અહીં જ તમારા પ્રશ્નનો જવાબ આપીશું, ફરી પૂછવાની જરૂર નથી.",
+    "kn": "ಈಗ ನಿಮ್ಮ ಉತ್ತರವನ್ನು ಪಡೆಯಲು ಸಾಧ್ಯವಾಗಲಿಲ್ಲ. ಸಾಧ್ಯವಾದಷ್ಟು ಬೇಗ ಇಲ್ಲಿಯೇ ನಿಮ್ಮ ಪ್ರಶ್ನೆಗೆ ಉತ್ತರಿಸುತ್ತೇವೆ, ಮತ್ತೆ ಕೇಳುವ ಅಗತ್ಯವಿಲ್ಲ.",
+    "ml": "ഇപ്പോൾ നിങ്ങളുടെ ഉത്തരം ലഭ്യമാക്കാൻ കഴിഞ്ഞില്ല. കഴിയുന്നത്ര വേഗം ഇവിടെത്തന്നെ നിങ്ങളുടെ ചോദ്യത്തിന് മറുപടി നൽകും, വീണ്ടും ചോദിക്കേണ്ടതില്ല.",
+    "mr": "आत्ता आम्हाला तुमचे उत्तर मिळू शकले नाही. शक्य तितक्या लवकर आम्ही इथेच तुमच्या प्रश्नाचे उत्तर देऊ, पुन्हा विचारण्याची गरज नाही.",
+    "or": "ବର୍ତ୍ତମାନ ଆମେ ଆପଣଙ୍କ ଉତ୍ତର ପାଇପାରିଲୁ ନାହିଁ। ଯଥାଶୀଘ୍ର ଆମେ ଏଠାରେ ଆପଣଙ୍କ ପ୍ରଶ୍ନର ଉତ୍ତର ଦେବୁ, ପୁଣି ପଚାରିବାର ଆବଶ୍ୟକତା ନାହିଁ।",
+    "pa": "ਇਸ ਵੇਲੇ ਅਸੀਂ ਤੁਹਾਡਾ ਜਵਾਬ ਪ੍ਰਾਪਤ ਨਹੀਂ ਕਰ ਸਕੇ। ਅਸੀਂ ਜਿੰਨੀ ਜਲਦੀ ਹੋ ਸਕੇ ਇੱਥੇ ਹੀ ਤੁਹਾਡੇ ਸਵਾਲ ਦਾ ਜਵਾਬ ਦੇਵਾਂਗੇ, ਦੁਬਾਰਾ ਪੁੱਛਣ ਦੀ ਲੋੜ ਨਹੀਂ।",
+    "ta": "இப்போது உங்கள் பதிலைப் பெற முடியவில்லை. முடிந்தவரை விரைவில் இங்கேயே உங்கள் கேள்விக்குப் பதிலளிப்போம், மீண்டும் கேட்க வேண்டியதில்லை.",
+    "te": "ప్రస్తుతం మీ సమాధానం పొందలేకపోయాము. వీలైనంత త్వరగా ఇక్కడే మీ ప్రశ్నకు సమాధానం ఇస్తాము, మళ్లీ అడగాల్సిన అవసరం లేదు."
+}
+
 LANGUAGES = [
     {"text": "English", "code": "en", "index": 1},
     {"text": "বাংলা", "code": "bn", "index": 2},
@@ -479,4 +507,7 @@ LANGUAGES = [
     {"text": "ਪੰਜਾਬੀ", "code": "pa", "index": 9},
     {"text": "தமிழ்", "code": "ta", "index": 10},
     {"text": "తెలుగు", "code": "te", "index": 11}
-]
\ No newline at end of file
+]
+
+# Stable codes used in the compact session layout; only ever append.
+BOT_CODES = {"story": 1, "teacher": 2, "parent": 3}
\ No newline at end of file
@@ -0,0 +1,147 @@
+"""
+Deferred answers during backend outages (`DEFERRED_ANSWERS=true`, off by default).
+
+When a query fails because the backend is down or overloaded (connection errors,
+timeouts, 5xx), the user is told the answer will follow and the query is put in a durable
+retry queue in Redis instead of being dropped. Every worker drains the queue: it claims
+due queries, asks the backend again and sends the answer as a reply to the original
+message.
+
+- The drain is paced to `DEFERRED_DRAIN_RATE` queries per second per worker, so a
+  recovering backend is not hit by the whole backlog at once.
+- When a retried query fails again, it is rescheduled `DEFERRED_RETRY_SECONDS` later
+  (default 30) and the worker pauses draining for as long, so an outage costs one failed
+  backend call per worker per interval rather than one per queued query.
+- Queries older than `DEFERRED_MAX_AGE_SECONDS` (default 3600) are given up: the user gets
+  the error message as a reply to the question, as without deferral.
+- A claimed query is leased for `DEFERRED_LEASE_SECONDS` (default 120); if its worker
+  dies, it becomes due again and another worker answers it. Delivery is at least once.
+
+    queue    DEFERRED_QUEUE_KEY (default deferred:{answers}), sorted set of job ids by due time (ms)
+    jobs     <queue>:jobs, hash of job id -> JSON job
+"""
+import asyncio
+import json
+import os
+import time
+
+from redis.exceptions import RedisError
+
+from logger import logger
+from metrics import DEFERRED_QUERIES
+from redis_clients import ShardedRedis
+
+DEFERRED_ANSWERS = os.getenv("DEFERRED_ANSWERS", "false").lower() == "true"
+DEFERRED_QUEUE_KEY = os.getenv("DEFERRED_QUEUE_KEY", "deferred:{answers}")
+DEFERRED_DRAIN_RATE = float(os.getenv("DEFERRED_DRAIN_RATE", "2"))
+DEFERRED_RETRY_SECONDS = float(os.getenv("DEFERRED_RETRY_SECONDS", "30"))
+DEFERRED_MAX_AGE_SECONDS = float(os.getenv("DEFERRED_MAX_AGE_SECONDS", "3600"))
+DEFERRED_LEASE_SECONDS = float(os.getenv("DEFERRED_LEASE_SECONDS", "120"))
+IDLE_POLL_SECONDS = 1.0
+
+# KEYS[1] queue; ARGV: now in ms, lease in ms, count. Leases up to `count` due job ids by
+# moving their due time to the end of the lease, and returns them.
+CLAIM_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+local lease_end = tonumber(ARGV[1]) + tonumber(ARGV[2])
+for _, job_id in ipairs(due) do
+  redis.call('ZADD', KEYS[1], lease_end, job_id)
+end
+return due
+"""
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class DeferredAnswers:
+    """The retry queue of queries the backend failed to answer."""
+
+    def __init__(self, redis_client, key=DEFERRED_QUEUE_KEY, drain_rate=DEFERRED_DRAIN_RATE,
+                 retry_seconds=DEFERRED_RETRY_SECONDS, max_age_seconds=DEFERRED_MAX_AGE_SECONDS,
+                 lease_seconds=DEFERRED_LEASE_SECONDS):
+        # Route both keys to the node owning the queue so they are always read together.
+        self.redis = redis_client.client_for(key) if isinstance(redis_client, ShardedRedis) else redis_client
+        self.key = key
+        self.jobs_key = f"{key}:jobs"
+        self.drain_rate = drain_rate
+        self.retry_ms = int(retry_seconds * 1000)
+        self.max_age_ms = int(max_age_seconds * 1000)
+        self.lease_ms = int(lease_seconds * 1000)
+        self._claim = self.redis.register_script(CLAIM_LUA)
+
+    async def defer(self, job_id: str, job: dict) -> None:
+        """Queue `job` for its first retry; raises RedisError if it could not be stored."""
+        job = {**job, "deferred_at": now_ms()}
+        # The payload goes first, so a claimed id always has one.
+        await self.redis.hset(self.jobs_key, job_id, json.dumps(job))
+        await self.redis.zadd(self.key, {job_id: job["deferred_at"] + self.retry_ms})
+        DEFERRED_QUERIES.labels("deferred").inc()
+
+    async def drain(self, answer, give_up) -> None:
+        """
+        Retry due jobs until cancelled. `answer(job)` returns True once the job is done with
+        (answered, or failed for good) and False when the backend is still failing;
+        `give_up(job)` notifies the user of a job that expired before it could be answered.
+        """
+        interval = 1.0 / self.drain_rate
+        batch = max(1, int(self.drain_rate))
+        while True:
+            try:
+                job_ids = await self._claim(keys=[self.key], args=[now_ms(), self.lease_ms, batch])
+            except RedisError as e:
+                logger.warning(f"Deferred answer queue unavailable: {e}")
+                await asyncio.sleep(IDLE_POLL_SECONDS)
+                continue
+            if not job_ids:
+                await asyncio.sleep(IDLE_POLL_SECONDS)
+                continue
+            for index, job_id in enumerate(job_ids):
+                if not await self._retry(job_id, answer, give_up):
+                    # The backend has not recovered: hand the rest back and wait before trying again.
+                    await self._reschedule(job_ids[index + 1:])
+                    await asyncio.sleep(self.retry_ms / 1000)
+                    break
+                await asyncio.sleep(interval)
+
+    async def _retry(self, job_id, answer, give_up) -> bool:
+        """Retry one job; False when the backend failed it again."""
+        payload = await self.redis.hget(self.jobs_key, job_id)
+        job = json.loads(payload) if payload is not None else None
+        if job is None:
+            await self._remove(job_id)
+            return True
+        if now_ms() - job["deferred_at"] > self.max_age_ms:
+            logger.warning({"deferred_answer_expired": job_id.decode() if isinstance(job_id, bytes) else job_id})
+            try:
+                await give_up(job)
+            except Exception as e:
+                # Keep the job, so the user is still told once Telegram can be reached.
+                logger.error(f"Could not notify expired deferred answer {job_id!r}: {e}")
+                await self._reschedule([job_id])
+                return True
+            DEFERRED_QUERIES.labels("expired").inc()
+            await self._remove(job_id)
+            return True
+        try:
+            done = await answer(job)
+        except Exception as e:
+            logger.error(f"Deferred answer {job_id!r} failed: {e}")
+            done = False
+        if not done:
+            DEFERRED_QUERIES.labels("retried").inc()
+            await self._reschedule([job_id])
+            return False
+        DEFERRED_QUERIES.labels("answered").inc()
+        await self._remove(job_id)
+        return True
+
+    async def _reschedule(self, job_ids) -> None:
+        if job_ids:
+            due = now_ms() + self.retry_ms
+            await self.redis.zadd(self.key, {job_id: due for job_id in job_ids})
+
+    async def _remove(self, job_id) -> None:
+        await self.redis.zrem(self.key, job_id)
+        await self.redis.hdel(self.jobs_key, job_id)
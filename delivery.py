@@ -0,0 +1,133 @@
+"""
+Delivery of backend answers as Telegram Markdown messages.
+
+Answers are prepared locally before anything is sent, so Telegram never rejects them:
+
+- Markdown (legacy `parse_mode="Markdown"`) is checked the way Telegram parses it, and any
+  entity marker that would not be closed (`*`, `_`, `` ` ``, ```` ``` ````, `[`) is escaped, so
+  the message renders instead of failing with "can't parse entities".
+- Answers longer than `TELEGRAM_MESSAGE_LIMIT` (UTF-16 code units, like Telegram counts)
+  are split at paragraph boundaries, falling back to line and then word boundaries.
+
+If Telegram still rejects a part, it is re-sent as plain text.
+"""
+import re
+
+from telegram.error import BadRequest
+
+from logger import logger
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+_SPECIAL = re.compile(r"[\\\[*_`]")
+_LINK = re.compile(r"\[[^\]\n]*\]\([^)\s]*\)")
+_SEPARATORS = ("\n\n", "\n", " ")
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def escape_unbalanced_markdown(text: str) -> str:
+    """Escape every Markdown entity marker that Telegram would fail to match."""
+    result = []
+    position = 0
+    while position < len(text):
+        special = _SPECIAL.search(text, position)
+        if special is None:
+            result.append(text[position:])
+            break
+        result.append(text[position:special.start()])
+        position = special.start()
+        char = text[position]
+        if char == "\\":
+            result.append(text[position:position + 2])
+            position += 2
+        elif char == "[":
+            link = _LINK.match(text, position)
+            if link:
+                result.append(link.group())
+                position = link.end()
+            else:
+                result.append("\\[")
+                position += 1
+        else:
+            marker = "```" if text.startswith("```", position) else char
+            end = text.find(marker, position + len(marker))
+            if end == -1:
+                result.append("\\" + char)
+                position += 1
+            else:
+                # Entities do not nest in legacy Markdown: everything up to the closing
+                # marker is taken literally.
+                result.append(text[position:end + len(marker)])
+                position = end + len(marker)
+    return "".join(result)
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT):
+    """Split `text` into parts of at most `limit` UTF-16 units at the coarsest boundary possible."""
+    limit = max(1, limit)
+    if utf16_length(text) <= limit:
+        return [text]
+    for separator in _SEPARATORS:
+        pieces = text.split(separator)
+        if len(pieces) == 1:
+            continue
+        parts, current, current_length = [], [], 0
+        for piece in pieces:
+            piece_length = utf16_length(piece)
+            joined_length = current_length + len(separator) + piece_length if current else piece_length
+            if current and joined_length > limit:
+                parts.append(separator.join(current))
+                current, joined_length = [], piece_length
+            current.append(piece)
+            current_length = joined_length
+        parts.append(separator.join(current))
+        # Pieces that are still too long are split at the next finer boundary.
+        return [part for chunk in parts for part in split_message(chunk, limit)]
+    # A single word longer than the limit: cut it, keeping surrogate pairs intact.
+    cut = limit
+    while cut > 1 and utf16_length(text[:cut]) > limit:
+        cut -= 1
+    # A single character wider than the limit (a surrogate pair at limit 1) still goes out whole.
+    rest = text[cut:]
+    return [text[:cut]] + (split_message(rest, limit) if rest else [])
+
+
+def prepare_markdown_messages(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT, split_limit: int = None):
+    """Return `(markdown, plain)` pairs, one per message to send.
+
+    `split_limit` is the length the plain text is split at, tightened below `limit` when
+    escaping makes a part longer.
+    """
+    split_limit = limit if split_limit is None else split_limit
+    messages = []
+    for part in split_message(text, split_limit):
+        markdown = escape_unbalanced_markdown(part)
+        markdown_length = utf16_length(markdown)
+        if markdown_length > limit and split_limit > 1:
+            # Escaping pushed the part over the limit; split it tighter by the escape ratio,
+            # always by at least one unit so the recursion ends.
+            tighter = max(1, min(split_limit - 1, split_limit * limit // markdown_length))
+            messages.extend(prepare_markdown_messages(part, limit, tighter))
+        elif part.strip():
+            messages.append((markdown, part))
+    return messages
+
+
+async def send_markdown(bot, chat_id, text: str, reply_markup=None, **kwargs):
+    """Send `text` as one or more Markdown messages; `reply_markup` goes on the last one."""
+    messages = prepare_markdown_messages(text)
+    sent = None
+    for index, (markdown, plain) in enumerate(messages):
+        markup = reply_markup if index == len(messages) - 1 else None
+        try:
+            sent = await bot.send_message(chat_id=chat_id, text=markdown, parse_mode="Markdown",
+                                          reply_markup=markup, **kwargs)
+        except BadRequest as e:
+            if "parse entities" not in str(e).lower():
+                raise
+            logger.warning(f"Markdown rejected by Telegram, sending as plain text: {e}")
+            sent = await bot.send_message(chat_id=chat_id, text=plain, reply_markup=markup, **kwargs)
+    return sent
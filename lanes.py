@@ -0,0 +1,167 @@
+"""
+Separate execution lanes for cheap and expensive updates, and the `Lane` limiter they are
+built on (also used to bound concurrent backend calls).
+
+Every update is classified into a lane (`text`, `voice` or `callback`) and only runs once a
+slot in that lane is free, so a burst of slow voice queries queues up in the voice lane
+instead of occupying the slots that quick text answers and button presses need.
+
+- `LANE_TEXT_CONCURRENCY` (default 128): text queries.
+- `LANE_VOICE_CONCURRENCY` (default 32): voice queries (`get_file`, audio output, `send_voice`).
+- `LANE_CALLBACK_CONCURRENCY` (default 64): commands and language/bot/feedback buttons.
+- `LANE_MAX_PENDING` (default 4096): updates admitted across all lanes, running or queued.
+  Beyond that, updates wait in `application.update_queue`.
+
+Handlers must be registered with `block=True` so a lane slot covers the whole handler run.
+With `ADAPTIVE_CONCURRENCY=true` each lane's limit is tuned at runtime (`adaptive.py`); a
+handler that fails without raising (PTB hands exceptions to error handlers, not to the
+lane) reports it with `mark_failed()`.
+"""
+import asyncio
+import contextvars
+import os
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from adaptive import ADAPTIVE_CONCURRENCY, AdaptiveLimiter
+from metrics import LANE_IN_FLIGHT, LANE_LIMIT, LANE_QUEUED, LANE_WAIT
+
+LANE_LIMITS = {
+    "text": int(os.getenv("LANE_TEXT_CONCURRENCY", "128")),
+    "voice": int(os.getenv("LANE_VOICE_CONCURRENCY", "32")),
+    "callback": int(os.getenv("LANE_CALLBACK_CONCURRENCY", "64")),
+}
+LANE_MAX_PENDING = int(os.getenv("LANE_MAX_PENDING", "4096"))
+
+
+class _Work:
+    """What the adaptive controller learns about the update running in a lane slot."""
+
+    __slots__ = ("nested_wait", "failed")
+
+    def __init__(self):
+        self.nested_wait = 0.0
+        self.failed = False
+
+
+_current_work = contextvars.ContextVar("lane_work", default=None)
+
+
+def mark_failed() -> None:
+    """Count the update running in the current lane slot as failed."""
+    work = _current_work.get()
+    if work is not None:
+        work.failed = True
+
+
+def lane_for(update: object) -> str:
+    """Pick the lane an update runs in."""
+    if isinstance(update, Update) and update.message is not None:
+        if update.message.voice is not None:
+            return "voice"
+        if update.message.text and not update.message.text.startswith("/"):
+            return "text"
+    return "callback"
+
+
+class Lane:
+    """A FIFO concurrency limiter whose limit can be changed while it is in use."""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self._waiters = deque()
+        LANE_LIMIT.labels(name).set(limit)
+        LANE_IN_FLIGHT.labels(name).set_function(lambda: self.active)
+        LANE_QUEUED.labels(name).set_function(lambda: self.queued)
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def set_limit(self, limit: int):
+        self.limit = max(1, limit)
+        LANE_LIMIT.labels(self.name).set(self.limit)
+        self._wake()
+
+    async def acquire(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        queued_at = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just before the cancellation.
+                self.release()
+            else:
+                self._waiters.remove(future)
+            raise
+        work = _current_work.get()
+        if work is not None:
+            # Waiting for a nested lane is not work done under the outer lane's limit.
+            work.nested_wait += time.perf_counter() - queued_at
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    def _wake(self):
+        while self._waiters and self.active < self.limit:
+            future = self._waiters.popleft()
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+
+class LaneUpdateProcessor(BaseUpdateProcessor):
+    """Runs each update in its lane; the base limit only bounds updates admitted to the lanes."""
+
+    def __init__(self, limits=None, max_pending=LANE_MAX_PENDING, adaptive=ADAPTIVE_CONCURRENCY):
+        super().__init__(max_pending)
+        self.lanes = {name: Lane(name, limit) for name, limit in (limits or LANE_LIMITS).items()}
+        self.controllers = {name: AdaptiveLimiter(lane) for name, lane in self.lanes.items()} if adaptive else {}
+
+    async def do_process_update(self, update, coroutine) -> None:
+        lane = self.lanes[lane_for(update)]
+        queued_at = time.perf_counter()
+        try:
+            await lane.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+        started_at = time.perf_counter()
+        LANE_WAIT.labels(lane.name).observe(started_at - queued_at)
+        work = _Work()
+        token = _current_work.set(work)
+        try:
+            await coroutine
+        except BaseException:
+            work.failed = True
+            raise
+        finally:
+            _current_work.reset(token)
+            lane.release()
+            controller = self.controllers.get(lane.name)
+            if controller is not None:
+                controller.observe(time.perf_counter() - started_at - work.nested_wait, work.failed)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
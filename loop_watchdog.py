@@ -0,0 +1,101 @@
+"""
+Event-loop lag watchdog (`LOOP_WATCHDOG`, on by default).
+
+A heartbeat scheduled on the event loop every `LOOP_WATCHDOG_INTERVAL_MS` (default 50)
+records how late it ran in `telegram_bot_event_loop_lag_seconds`. A watchdog thread
+checks the heartbeat; once the loop has been stuck for more than `LOOP_LAG_THRESHOLD_MS`
+(default 200) it captures the stack the loop thread is executing, logs it and counts it
+in `telegram_bot_event_loop_blocked_total` by blocking site (the innermost frame in this
+code base, e.g. `bot_core.py:get_query_response`). When the loop recovers, the total
+stall is logged as well.
+
+Any blocking call on the loop (a synchronous HTTP or Redis call, heavy CPU work) that
+exceeds the threshold is reported with the line it was blocked on, so new ones are caught
+in staging before they stall every concurrent user in production.
+"""
+import os
+import sys
+import threading
+import time
+import traceback
+
+from logger import logger
+from metrics import EVENT_LOOP_BLOCKED, EVENT_LOOP_LAG
+
+LOOP_WATCHDOG = os.getenv("LOOP_WATCHDOG", "true").lower() == "true"
+LOOP_WATCHDOG_INTERVAL_MS = float(os.getenv("LOOP_WATCHDOG_INTERVAL_MS", "50"))
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "200"))
+STACK_LIMIT = 20
+CODE_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def blocking_site(frame) -> str:
+    """The innermost frame of our own code on the stack, e.g. `bot_core.py:query_handler`."""
+    innermost = frame
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(CODE_ROOT) and "site-packages" not in filename:
+            return f"{os.path.relpath(filename, CODE_ROOT)}:{frame.f_code.co_name}"
+        frame = frame.f_back
+    return f"{os.path.basename(innermost.f_code.co_filename)}:{innermost.f_code.co_name}"
+
+
+class LoopWatchdog:
+    """Measures the lag of one event loop and reports the stack whenever it is blocked."""
+
+    def __init__(self, loop, interval_ms=LOOP_WATCHDOG_INTERVAL_MS, threshold_ms=LOOP_LAG_THRESHOLD_MS):
+        self.loop = loop
+        self.interval = interval_ms / 1000.0
+        self.threshold = threshold_ms / 1000.0
+        self.loop_thread_id = None
+        self._last_beat = time.monotonic()
+        self._reported_beat = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start watching; must be called from the loop's own thread."""
+        self.loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self.loop.call_soon(self._beat, self._last_beat)
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _beat(self, scheduled_at: float):
+        now = time.monotonic()
+        lag = max(0.0, now - scheduled_at)
+        EVENT_LOOP_LAG.observe(lag)
+        if self._reported_beat is not None and self._reported_beat == self._last_beat:
+            logger.warning({"event_loop_unblocked_after_ms": round(lag * 1000, 1)})
+        self._last_beat = now
+        if not self._stopped.is_set():
+            self.loop.call_later(self.interval, self._beat, now + self.interval)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._last_beat
+            blocked_for = time.monotonic() - beat - self.interval
+            if blocked_for <= self.threshold or self._reported_beat == beat:
+                continue
+            # Report each stall once, with the stack the loop is stuck in right now.
+            self._reported_beat = beat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            site = blocking_site(frame)
+            EVENT_LOOP_BLOCKED.labels(site).inc()
+            logger.warning({
+                "event_loop_blocked_ms": round(blocked_for * 1000, 1),
+                "site": site,
+                "stack": "".join(traceback.format_stack(frame, limit=STACK_LIMIT)),
+            })
+
+
+def start_loop_watchdog(loop):
+    """Start a watchdog for `loop` when `LOOP_WATCHDOG` is enabled; returns it or None."""
+    if not LOOP_WATCHDOG:
+        return None
+    watchdog = LoopWatchdog(loop)
+    watchdog.start()
+    return watchdog
@@ -0,0 +1,167 @@
+"""
+Prometheus metrics for the Telegram bot.
+
+All series live in the default `prometheus_client` registry and are rendered by the
+`/metrics` route of the webhook service. Observations are a few dict lookups and
+atomic adds, so the instrumentation is meant to stay enabled in production.
+"""
+import time
+from functools import wraps
+from urllib.parse import urlparse
+
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+from telegram.request import HTTPXRequest
+
+from tracing import span
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HANDLER_LATENCY = Histogram(
+    "telegram_bot_handler_latency_seconds",
+    "Time spent in a registered update handler.",
+    ["handler"],
+    buckets=LATENCY_BUCKETS,
+)
+BACKEND_LATENCY = Histogram(
+    "telegram_bot_backend_latency_seconds",
+    "Latency of story/activity backend calls.",
+    ["endpoint", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REDIS_LATENCY = Histogram(
+    "telegram_bot_redis_latency_seconds",
+    "Latency of Redis session store calls.",
+    ["command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+TELEGRAM_REQUESTS = Counter(
+    "telegram_bot_api_requests_total",
+    "Outbound Telegram Bot API calls.",
+    ["method", "status"],
+)
+TELEGRAM_RATE_LIMITED = Counter(
+    "telegram_bot_api_rate_limited_total",
+    "Outbound Telegram Bot API calls rejected with HTTP 429.",
+    ["method"],
+)
+UPDATE_QUEUE_DEPTH = Gauge(
+    "telegram_bot_update_queue_depth",
+    "Updates waiting in the application update_queue.",
+)
+UPDATES_IN_FLIGHT = Gauge(
+    "telegram_bot_updates_in_flight",
+    "Updates currently being handled.",
+)
+TELEMETRY_BUFFER_SIZE = Gauge(
+    "telegram_bot_telemetry_buffer_size",
+    "Telemetry events buffered and not yet sent.",
+)
+LANE_IN_FLIGHT = Gauge(
+    "telegram_bot_lane_in_flight",
+    "Work running in a lane (update execution lanes and backend calls).",
+    ["lane"],
+)
+LANE_QUEUED = Gauge(
+    "telegram_bot_lane_queued",
+    "Work waiting for a slot in a lane.",
+    ["lane"],
+)
+LANE_LIMIT = Gauge(
+    "telegram_bot_lane_limit",
+    "Current concurrency limit of a lane.",
+    ["lane"],
+)
+ADAPTIVE_DECISIONS = Counter(
+    "telegram_bot_adaptive_decisions_total",
+    "Decisions of the adaptive concurrency controller.",
+    ["lane", "action"],
+)
+STREAM_ENTRIES = Counter(
+    "telegram_bot_update_stream_entries_total",
+    "Update stream entries by outcome (appended, processed, recovered, claimed, dropped, failed).",
+    ["outcome"],
+)
+BACKEND_OUTSTANDING = Gauge(
+    "telegram_bot_backend_outstanding_requests",
+    "Backend requests in flight per replica.",
+    ["replica"],
+)
+BACKEND_EJECTIONS = Counter(
+    "telegram_bot_backend_ejections_total",
+    "Times a backend replica was ejected after consecutive failures.",
+    ["replica"],
+)
+RATE_LIMIT_DECISIONS = Counter(
+    "telegram_bot_rate_limit_decisions_total",
+    "Per-chat query rate limit decisions (local, allowed, throttled, error).",
+    ["decision"],
+)
+EVENT_LOOP_LAG = Histogram(
+    "telegram_bot_event_loop_lag_seconds",
+    "How late the event loop ran a heartbeat scheduled on it.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+EVENT_LOOP_BLOCKED = Counter(
+    "telegram_bot_event_loop_blocked_total",
+    "Event loop stalls longer than LOOP_LAG_THRESHOLD_MS, by blocking site.",
+    ["site"],
+)
+DEFERRED_QUERIES = Counter(
+    "telegram_bot_deferred_queries_total",
+    "Queries deferred during backend failures, by outcome (deferred, answered, retried, expired).",
+    ["outcome"],
+)
+LANE_WAIT = Histogram(
+    "telegram_bot_lane_wait_seconds",
+    "Time spent waiting for a slot in a lane.",
+    ["lane"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def observe_handler(callback, name=None):
+    """Wrap a PTB handler callback to record its latency and the in-flight update count."""
+    histogram = HANDLER_LATENCY.labels(name or callback.__name__)
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        UPDATES_IN_FLIGHT.inc()
+        start_time = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            histogram.observe(time.perf_counter() - start_time)
+            UPDATES_IN_FLIGHT.dec()
+
+    return wrapper
+
+
+def observe_backend_call(url: str, status, duration: float) -> None:
+    """Record one backend call. `status` is the HTTP status code or an error class name."""
+    BACKEND_LATENCY.labels(urlparse(url).path, str(status)).observe(duration)
+
+
+def render_metrics():
+    """Return the exposition payload and its content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest that counts outbound Bot API calls per method and status code and traces each send."""
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        try:
+            with span(f"telegram.{api_method}"):
+                status_code, payload = await super().do_request(
+                    url, method, request_data=request_data, read_timeout=read_timeout,
+                    write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+                )
+        except Exception as e:
+            TELEGRAM_REQUESTS.labels(api_method, type(e).__name__).inc()
+            raise
+        TELEGRAM_REQUESTS.labels(api_method, str(status_code)).inc()
+        if status_code == 429:
+            TELEGRAM_RATE_LIMITED.labels(api_method).inc()
+        return status_code, payload
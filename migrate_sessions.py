@@ -0,0 +1,101 @@
+"""
+Online migration of per-user session keys to the compact layout of `session_store.py`.
+
+Walks the keyspace with SCAN for legacy `{chat_id}_language` / `{chat_id}_bot` keys and
+copies each user into its session bucket with HSETNX, so values the running bot already
+wrote in the new layout are never overwritten. Safe to run while the bot serves traffic
+and to re-run after an interruption.
+
+Sessions are written to the store configured by `REDIS_MODE` (see `redis_clients.py`).
+When moving to a cluster or sharded deployment, point `--source` at the old single node
+to read the legacy keys from there.
+
+Usage:
+    python migrate_sessions.py [--source host:port] [--batch-size 1000] [--delete-legacy] [--dry-run]
+"""
+import argparse
+
+import redis
+
+from redis_clients import create_redis_client, parse_nodes
+from session_store import BOT_CODES, LANGUAGE_CODES, SESSION_TTL, bucket_field, bucket_key, pack
+
+LEGACY_SUFFIXES = ("_language", "_bot")
+
+
+def legacy_chat_ids(redis_client, batch_size):
+    """Yield chat ids that still have at least one legacy key, each once per suffix found."""
+    for suffix in LEGACY_SUFFIXES:
+        for key in redis_client.scan_iter(match=f"*{suffix}", count=batch_size):
+            chat_id = key.decode("utf-8")[:-len(suffix)]
+            if chat_id.lstrip("-").isdigit():
+                yield int(chat_id)
+
+
+def migrate_batch(source, target, chat_ids, ttl, delete_legacy, dry_run):
+    keys = [f"{chat_id}{suffix}" for chat_id in chat_ids for suffix in LEGACY_SUFFIXES]
+    reads = source.pipeline(transaction=False)
+    for key in keys:
+        reads.get(key)
+    values = reads.execute()
+    migrated = 0
+    copied = []
+    pipeline = target.pipeline(transaction=False)
+    for index, chat_id in enumerate(chat_ids):
+        language = values[2 * index].decode("utf-8") if values[2 * index] else None
+        bot = values[2 * index + 1].decode("utf-8") if values[2 * index + 1] else None
+        packed = pack(language, bot)
+        if packed:
+            migrated += 1
+            # Only keys whose value made it into the copy may go; pack() drops unknown values.
+            if language in LANGUAGE_CODES:
+                copied.append(keys[2 * index])
+            if bot in BOT_CODES:
+                copied.append(keys[2 * index + 1])
+            pipeline.hsetnx(bucket_key(chat_id), bucket_field(chat_id), packed)
+            if ttl:
+                pipeline.expire(bucket_key(chat_id), ttl)
+    if not dry_run:
+        pipeline.execute()
+        if delete_legacy:
+            deletes = source.pipeline(transaction=False)
+            for key in copied:
+                deletes.delete(key)
+            deletes.execute()
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="host:port of the node holding the legacy keys (default: the session store)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="SCAN count and users per pipeline")
+    parser.add_argument("--delete-legacy", action="store_true", help="delete legacy keys once copied; values with no session code are kept")
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be migrated")
+    args = parser.parse_args()
+
+    target = create_redis_client()
+    if args.source:
+        (host, port), = parse_nodes(args.source)
+        source = redis.Redis(host=host, port=port)
+    else:
+        source = target
+    seen, batch = set(), []
+    scanned = migrated = 0
+    for chat_id in legacy_chat_ids(source, args.batch_size):
+        if chat_id in seen:
+            continue
+        seen.add(chat_id)
+        batch.append(chat_id)
+        if len(batch) >= args.batch_size:
+            migrated += migrate_batch(source, target, batch, SESSION_TTL, args.delete_legacy, args.dry_run)
+            scanned += len(batch)
+            batch = []
+            print(f"users scanned {scanned}  migrated {migrated}", flush=True)
+    if batch:
+        migrated += migrate_batch(source, target, batch, SESSION_TTL, args.delete_legacy, args.dry_run)
+        scanned += len(batch)
+    print(f"done: users scanned {scanned}  migrated {migrated}{'  (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+On-demand sampling profiler for a live worker, served by the webhook's `/debug/profile`.
+
+The route is disabled unless `DEBUG_TOKEN` is set, and requires `Authorization: Bearer
+<DEBUG_TOKEN>`. One profile runs at a time, for at most `DEBUG_PROFILE_MAX_SECONDS`.
+
+    GET /debug/profile?seconds=10&hz=100             CPU samples of the event loop thread
+    GET /debug/profile?seconds=10&mode=wall          wall-clock samples, idle time included
+    GET /debug/profile?seconds=10&mode=alloc         allocations made during the window
+
+All modes return folded stacks (`outer;...;inner count` per line), the input format of
+flamegraph.pl, speedscope and inferno.
+
+CPU and wall modes use an interval timer signal (`SIGPROF` / `SIGALRM`) whose handler
+records the stack the event loop thread is executing, so samples land wherever the loop
+is, not only where it releases the GIL, and the profiled code runs unmodified. The cost
+is one stack walk per sample (~100 per second by default). `SIGPROF` fires per CPU time
+of the whole process, so CPU burnt in the background threads (trace exporter, traffic
+capture, SQLite session writer) shows up as samples in the loop's `select`. Allocation mode traces allocations with `tracemalloc` for the window
+(noticeably slower while it runs) and reports the bytes still alive at its end by
+allocating stack.
+"""
+import asyncio
+import hmac
+import os
+import signal
+import tracemalloc
+from collections import Counter
+
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+DEBUG_PROFILE_MAX_SECONDS = float(os.getenv("DEBUG_PROFILE_MAX_SECONDS", "60"))
+MAX_HZ = 1000
+ALLOC_TRACE_FRAMES = 32
+PROFILE_MODES = ("cpu", "wall", "alloc")
+
+_running = asyncio.Lock()
+
+
+def is_authorized(authorization_header: str) -> bool:
+    if not DEBUG_TOKEN:
+        return False
+    return hmac.compare_digest(authorization_header or "", f"Bearer {DEBUG_TOKEN}")
+
+
+async def sample_stacks(seconds: float, hz: float, wall_clock=False) -> Counter:
+    """Sample the stack of this (the main) thread; returns folded stack -> samples."""
+    timer, signum = (signal.ITIMER_REAL, signal.SIGALRM) if wall_clock else (signal.ITIMER_PROF, signal.SIGPROF)
+    labels = {}
+    folded = Counter()
+
+    def on_sample(_, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            stack.append(label)
+            frame = frame.f_back
+        folded[";".join(reversed(stack))] += 1
+
+    previous_handler = signal.signal(signum, on_sample)
+    signal.setitimer(timer, 1.0 / hz, 1.0 / hz)
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        signal.setitimer(timer, 0)
+        signal.signal(signum, previous_handler)
+    return folded
+
+
+async def trace_allocations(seconds: float) -> Counter:
+    """Trace allocations for `seconds`; returns folded stack -> bytes still allocated at the end."""
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start(ALLOC_TRACE_FRAMES)
+    try:
+        await asyncio.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if not already_tracing:
+            tracemalloc.stop()
+    folded = Counter()
+    for trace in snapshot.traces:
+        # tracemalloc lists the most recent frame first.
+        frames = [f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in reversed(trace.traceback)]
+        folded[";".join(frames)] += trace.size
+    return folded
+
+
+def render_folded(folded: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in folded.most_common())
+
+
+async def profile(seconds: float, hz: float = 100, mode="cpu") -> str:
+    """Profile this process for `seconds` while it keeps serving; returns folded stacks."""
+    if _running.locked():
+        raise RuntimeError("A profile is already running")
+    seconds = min(max(seconds, 0.1), DEBUG_PROFILE_MAX_SECONDS)
+    async with _running:
+        if mode == "alloc":
+            folded = await trace_allocations(seconds)
+        else:
+            folded = await sample_stacks(seconds, min(max(hz, 1), MAX_HZ), wall_clock=mode == "wall")
+    return render_folded(folded)
@@ -0,0 +1,115 @@
+"""
+Per-chat query rate limiting (`QUERY_RATE_LIMIT_PER_MINUTE`, 0 disables it).
+
+Each chat has a token bucket of `QUERY_RATE_LIMIT_BURST` queries that refills at
+`QUERY_RATE_LIMIT_PER_MINUTE`. The bucket lives in Redis (`ratelimit:{chat_id}`) and is
+updated by one atomic Lua script, so the limit holds across all workers and processes.
+
+Local fast path: every worker remembers the bucket level from its last script call. While
+that estimate (refilled, minus queries admitted locally since) stays at or above
+`QUERY_RATE_LIMIT_LOCAL_FRACTION` of the burst, the query is admitted without a Redis
+round trip; the locally admitted queries are charged to the bucket on the next script
+call. Only users near their limit pay for the round trip, and a worker can over-admit at
+most that fraction of a burst before it syncs.
+
+Throttled queries get the localized `RATE_LIMIT_MSG` and never reach the backend. If Redis
+is unavailable the limiter fails open and admits the query.
+"""
+import os
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+from logger import logger
+from metrics import RATE_LIMIT_DECISIONS
+from redis_clients import ShardedRedis
+from tracing import span
+
+QUERY_RATE_LIMIT_PER_MINUTE = float(os.getenv("QUERY_RATE_LIMIT_PER_MINUTE", "0"))
+QUERY_RATE_LIMIT_BURST = int(os.getenv("QUERY_RATE_LIMIT_BURST", "5"))
+QUERY_RATE_LIMIT_LOCAL_FRACTION = float(os.getenv("QUERY_RATE_LIMIT_LOCAL_FRACTION", "0.5"))
+LOCAL_STATE_SIZE = 100000
+
+# KEYS[1] bucket; ARGV: burst, tokens refilled per ms, now in ms, queries admitted locally
+# since the last call. Returns {allowed, tokens left * 1000}.
+TOKEN_BUCKET_LUA = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local spent = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil or ts == nil then
+  tokens = burst
+  ts = now
+end
+if now > ts then
+  tokens = math.min(burst, tokens + (now - ts) * rate)
+  ts = now
+end
+tokens = math.max(tokens - spent, -burst)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(ts))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1000)
+return {allowed, math.floor(tokens * 1000)}
+"""
+
+
+class QueryRateLimiter:
+    """Token bucket per chat, shared through Redis (an asyncio client), with a local fast path."""
+
+    def __init__(self, redis_client, per_minute=QUERY_RATE_LIMIT_PER_MINUTE, burst=QUERY_RATE_LIMIT_BURST,
+                 local_fraction=QUERY_RATE_LIMIT_LOCAL_FRACTION):
+        self.redis = redis_client
+        self.burst = burst
+        self.rate_per_ms = per_minute / 60000.0
+        self.local_threshold = max(1.0, burst * local_fraction)
+        self._scripts = {}
+        # chat key -> [tokens at last sync, monotonic ms of last sync, queries admitted locally since]
+        self._local = OrderedDict()
+
+    async def allow(self, chat_id: int, namespace="") -> bool:
+        """Charge one query to the chat's bucket; False means the chat is over its limit."""
+        key = f"ratelimit:{namespace}:{{{chat_id}}}" if namespace else f"ratelimit:{{{chat_id}}}"
+        now_ms = time.monotonic() * 1000
+        state = self._local.get(key)
+        if state is not None:
+            tokens, synced_ms, spent = state
+            estimate = min(self.burst, tokens + (now_ms - synced_ms) * self.rate_per_ms) - spent
+            if estimate >= self.local_threshold:
+                state[2] += 1
+                RATE_LIMIT_DECISIONS.labels("local").inc()
+                return True
+        spent = state[2] if state is not None else 0
+        try:
+            with span("rate_limit", key=key):
+                allowed, tokens = await self._script_for(key)(
+                    keys=[key], args=[self.burst, self.rate_per_ms, int(time.time() * 1000), spent],
+                )
+        except RedisError as e:
+            logger.warning(f"Rate limiter unavailable, admitting query: {e}")
+            RATE_LIMIT_DECISIONS.labels("error").inc()
+            return True
+        # Queries admitted locally while the script ran are still to be charged.
+        state = self._local.get(key)
+        still_unsent = state[2] - spent if state is not None else 0
+        self._local[key] = [tokens / 1000.0, now_ms, max(0, still_unsent)]
+        self._local.move_to_end(key)
+        if len(self._local) > LOCAL_STATE_SIZE:
+            self._local.popitem(last=False)
+        RATE_LIMIT_DECISIONS.labels("allowed" if allowed else "throttled").inc()
+        return bool(allowed)
+
+    def _script_for(self, key):
+        # A sharded client routes by key, so the script is registered with the node owning it.
+        client = self.redis.client_for(key) if isinstance(self.redis, ShardedRedis) else self.redis
+        script = self._scripts.get(id(client))
+        if script is None:
+            script = self._scripts[id(client)] = client.register_script(TOKEN_BUCKET_LUA)
+        return script
@@ -0,0 +1,193 @@
+"""
+Redis client factory for the session store and `user_data` persistence.
+
+`REDIS_MODE` selects the topology:
+
+- `single` (default): one node at `REDIS_HOST`:`REDIS_PORT`, database `REDIS_DB`.
+
+`REDIS_DB` defaults to 0, the database every deployment has been using: the older
+`REDIS_INDEX` setting was never applied and is still ignored, so setting it cannot move a
+deployment away from its data. Only set `REDIS_DB` after copying the data to that database.
+- `cluster`: Redis Cluster, bootstrapped from `REDIS_NODES` (`host:port,host:port,...`).
+  Slot routing, per-node connection pools and failover are handled by redis-py.
+- `sharded`: independent nodes listed in `REDIS_NODES`, with keys spread by client-side
+  consistent hashing. Each node has its own connection pool, and adding a node only moves
+  the keys of its arcs of the ring.
+
+Both multi-node modes honour Redis hash tags: only the part of a key between the first `{`
+and the following `}` is hashed, so keys sharing a tag (e.g. one session bucket,
+`session:{1234}`) always live on the same node.
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import os
+
+import redis
+import redis.asyncio
+
+redis_host = os.getenv("REDIS_HOST", "172.17.0.1")
+redis_port = int(os.getenv("REDIS_PORT", "6379"))
+redis_db = int(os.getenv("REDIS_DB", "0"))
+REDIS_MODE = os.getenv("REDIS_MODE", "single")
+REDIS_NODES = os.getenv("REDIS_NODES", "")
+REDIS_MAX_CONNECTIONS = os.getenv("REDIS_MAX_CONNECTIONS", "")
+REDIS_RING_REPLICAS = int(os.getenv("REDIS_RING_REPLICAS", "160"))
+
+
+def parse_nodes(spec: str):
+    """Parse `host:port,host:port` into `[(host, port), ...]`."""
+    nodes = []
+    for node in filter(None, (part.strip() for part in spec.split(","))):
+        host, _, port = node.rpartition(":")
+        nodes.append((host, int(port)))
+    return nodes
+
+
+def hash_tag(key) -> bytes:
+    """Return the part of `key` that decides its shard, following Redis Cluster's hash-tag rule."""
+    key = key.encode("utf-8") if isinstance(key, str) else bytes(key)
+    start = key.find(b"{")
+    if start != -1:
+        end = key.find(b"}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class HashRing:
+    """Consistent-hash ring with `replicas` virtual points per node."""
+
+    def __init__(self, nodes, replicas=REDIS_RING_REPLICAS):
+        points = sorted(
+            (self._hash(f"{node}#{replica}".encode("utf-8")), node)
+            for node in nodes for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value: bytes) -> int:
+        return int.from_bytes(hashlib.md5(value).digest()[:8], "big")
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, self._hash(hash_tag(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+class ShardedRedis:
+    """
+    Routes commands over independent Redis nodes by consistent hashing of the key.
+
+    Single-key commands are forwarded to the owning node's client as is, so this works with
+    both `redis.Redis` and `redis.asyncio.Redis` clients (`is_async` must match).
+    """
+
+    def __init__(self, clients: dict, is_async=False):
+        self.clients = clients
+        self.is_async = is_async
+        self.ring = HashRing(list(clients))
+
+    def client_for(self, key):
+        return self.clients[self.ring.node_for(key)]
+
+    def __getattr__(self, name):
+        def command(key, *args, **kwargs):
+            return getattr(self.client_for(key), name)(key, *args, **kwargs)
+        return command
+
+    def mget(self, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys, *args]
+        pipeline = self.pipeline()
+        for key in keys:
+            pipeline.get(key)
+        return pipeline.execute()
+
+    def delete(self, *keys):
+        pipeline = self.pipeline()
+        for key in keys:
+            pipeline.delete(key)
+        result = pipeline.execute()
+        if self.is_async:
+            async def total():
+                return sum(await result)
+            return total()
+        return sum(result)
+
+    def scan_iter(self, **kwargs):
+        iterators = [client.scan_iter(**kwargs) for client in self.clients.values()]
+        if self.is_async:
+            async def chained():
+                for iterator in iterators:
+                    async for key in iterator:
+                        yield key
+            return chained()
+        return itertools.chain.from_iterable(iterators)
+
+    def pipeline(self, transaction=False):
+        return ShardedPipeline(self)
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+
+    async def aclose(self):
+        await asyncio.gather(*(client.aclose() for client in self.clients.values()))
+
+
+class ShardedPipeline:
+    """Buffers commands, runs one pipeline per node and returns results in call order."""
+
+    def __init__(self, sharded: ShardedRedis):
+        self.sharded = sharded
+        self.calls = []
+
+    def __getattr__(self, name):
+        def command(key, *args, **kwargs):
+            self.calls.append((self.sharded.ring.node_for(key), name, (key, *args), kwargs))
+            return self
+        return command
+
+    def _node_pipelines(self):
+        calls, self.calls = self.calls, []
+        by_node = {}
+        for position, (node, name, args, kwargs) in enumerate(calls):
+            pipeline, positions = by_node.setdefault(node, (self.sharded.clients[node].pipeline(transaction=False), []))
+            getattr(pipeline, name)(*args, **kwargs)
+            positions.append(position)
+        return len(calls), list(by_node.values())
+
+    @staticmethod
+    def _merge(count, node_pipelines, node_results):
+        results = [None] * count
+        for (_, positions), values in zip(node_pipelines, node_results):
+            for position, value in zip(positions, values):
+                results[position] = value
+        return results
+
+    def execute(self):
+        count, node_pipelines = self._node_pipelines()
+        if self.sharded.is_async:
+            async def execute_all():
+                node_results = await asyncio.gather(*(pipeline.execute() for pipeline, _ in node_pipelines))
+                return self._merge(count, node_pipelines, node_results)
+            return execute_all()
+        return self._merge(count, node_pipelines, [pipeline.execute() for pipeline, _ in node_pipelines])
+
+
+def create_redis_client(use_asyncio=False):
+    """Build a Redis client for the configured `REDIS_MODE`."""
+    module = redis.asyncio if use_asyncio else redis
+    pool_options = {"max_connections": int(REDIS_MAX_CONNECTIONS)} if REDIS_MAX_CONNECTIONS else {}
+    nodes = parse_nodes(REDIS_NODES) or [(redis_host, redis_port)]
+    if REDIS_MODE == "cluster":
+        cluster_node = redis.asyncio.cluster.ClusterNode if use_asyncio else redis.cluster.ClusterNode
+        return module.RedisCluster(startup_nodes=[cluster_node(host, port) for host, port in nodes], **pool_options)
+    if REDIS_MODE == "sharded":
+        clients = {f"{host}:{port}": module.Redis(host=host, port=port, db=redis_db, **pool_options)
+                   for host, port in nodes}
+        return ShardedRedis(clients, is_async=use_asyncio)
+    if REDIS_MODE != "single":
+        raise ValueError(f"Unknown REDIS_MODE {REDIS_MODE!r}, expected single, cluster or sharded")
+    return module.Redis(host=redis_host, port=redis_port, db=redis_db, **pool_options)
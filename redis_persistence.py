@@ -0,0 +1,159 @@
+"""
+Redis-backed `BasePersistence` for PTB `user_data`.
+
+- User data is loaded lazily in `refresh_user_data`, right before a handler runs, so start-up
+  does not read every user and memory only holds users that are actually active.
+- Writes are write-behind: PTB already calls `update_user_data` at most once per user every
+  `update_interval` seconds, which coalesces repeated writes within that window, and all
+  calls of one persistence round are sent as pipelined batches of `write_batch_size`.
+- At most `max_cached_users` users are kept in memory. Least recently used users whose data
+  has been written are evicted through `on_evict` (set to `Application.drop_user_data`); the
+  resulting `drop_user_data` call is recognised and does not delete the user from Redis.
+"""
+import asyncio
+import json
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from logger import logger
+from metrics import REDIS_LATENCY
+
+
+class RedisPersistence(BasePersistence):
+    """Stores each user's `user_data` as a JSON string under `{key_prefix}{user_id}`."""
+
+    def __init__(self, redis_client, key_prefix="ptb:user_data:", max_cached_users=100000, write_batch_size=500,
+                 update_interval=5, ttl=None, on_evict=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.redis = redis_client
+        self.key_prefix = key_prefix
+        self.max_cached_users = max_cached_users
+        self.write_batch_size = write_batch_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        # Last known data per user in LRU order, and users whose handlers ran since their last write.
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._evicted = set()
+        self._pending = {}
+        self._flush_task = None
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.key_prefix}{user_id}"
+
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._dirty.add(user_id)
+        if user_id in self._cache:
+            self._cache.move_to_end(user_id)
+            if not user_data:
+                user_data.update(self._cache[user_id])
+            return
+        if not user_data:
+            with REDIS_LATENCY.labels("get").time():
+                raw = await self.redis.get(self._key(user_id))
+            if raw is not None:
+                user_data.update(json.loads(raw))
+        self._cache[user_id] = dict(user_data)
+        self._evict_if_needed()
+
+    async def update_user_data(self, user_id, data):
+        self._cache[user_id] = data
+        self._cache.move_to_end(user_id)
+        self._dirty.discard(user_id)
+        self._pending[user_id] = data
+        self._evict_if_needed()
+        await self._flush_soon()
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._evicted:
+            self._evicted.discard(user_id)
+            return
+        self._cache.pop(user_id, None)
+        self._dirty.discard(user_id)
+        self._pending[user_id] = None
+        await self._flush_soon()
+
+    async def flush(self):
+        await self._write_pending()
+
+    def _evict_if_needed(self):
+        if len(self._cache) <= self.max_cached_users:
+            return
+        for user_id in list(self._cache):
+            if len(self._cache) <= self.max_cached_users:
+                break
+            # Users with unwritten changes stay until PTB hands us their data.
+            if user_id in self._dirty or user_id in self._pending:
+                continue
+            del self._cache[user_id]
+            if self.on_evict is not None:
+                self._evicted.add(user_id)
+                self.on_evict(user_id)
+
+    async def _flush_soon(self):
+        # PTB issues all update_* calls of a persistence round concurrently; the first one
+        # schedules a single write and every call of the round waits for it.
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._write_pending())
+        await asyncio.shield(self._flush_task)
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        for start in range(0, len(items), self.write_batch_size):
+            pipeline = self.redis.pipeline(transaction=False)
+            for user_id, data in items[start:start + self.write_batch_size]:
+                if data is None:
+                    pipeline.delete(self._key(user_id))
+                else:
+                    pipeline.set(self._key(user_id), json.dumps(data, separators=(",", ":")), ex=self.ttl)
+            try:
+                with REDIS_LATENCY.labels("pipeline").time():
+                    await pipeline.execute()
+            except Exception as e:
+                logger.error(f"Error persisting user_data: {e}", exc_info=True)
+                # Keep the batch for the next round unless newer data arrived meanwhile.
+                for user_id, data in items[start:]:
+                    self._pending.setdefault(user_id, data)
+                raise
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
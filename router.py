@@ -0,0 +1,111 @@
+"""
+Table-driven update routing.
+
+`UpdateRouter` is a single PTB handler that replaces the chain of `CommandHandler`,
+`CallbackQueryHandler` and `MessageHandler` instances. Each update is routed by its type
+and a dictionary lookup instead of being tested against every handler in turn:
+
+- commands by name (`/start`, `/select_bot@my_bot`),
+- callback queries by the prefix of their `callback_data` up to and including the first
+  `_` or `-` (`lang_hi` -> `lang_`, `message-liked__11` -> `message-`),
+- text and voice messages to the message route.
+
+The callback receives the fields already parsed in `context.args`: the command arguments,
+or whatever the route's parser made of the rest of the `callback_data`. Adding a command
+or a callback prefix adds a table entry, so dispatch cost does not grow with the number of
+routes.
+"""
+from typing import Callable, Dict, Optional, Tuple
+
+from telegram import MessageEntity, Update
+from telegram.ext import BaseHandler
+
+from lanes import mark_failed
+
+CALLBACK_SEPARATORS = ("_", "-")
+
+
+def callback_prefix(data: str) -> Tuple[str, str]:
+    """Split `callback_data` after its first `_` or `-`: `lang_hi` -> (`lang_`, `hi`)."""
+    end = len(data)
+    for separator in CALLBACK_SEPARATORS:
+        position = data.find(separator)
+        if 0 <= position < end:
+            end = position
+    return data[:end + 1], data[end + 1:]
+
+
+def _message_of(update: Update):
+    # The updates the message filters accept; a callback query's message is not one of them.
+    return (update.message or update.edited_message or update.channel_post or update.edited_channel_post
+            or update.business_message or update.edited_business_message)
+
+
+class UpdateRouter(BaseHandler[Update, object, None]):
+    """Routes updates to callbacks through precomputed lookup tables."""
+
+    __slots__ = ("commands", "callback_queries", "message_callback")
+
+    def __init__(self, block=True):
+        super().__init__(self._unrouted, block=block)
+        self.commands: Dict[str, Callable] = {}
+        self.callback_queries: Dict[str, Tuple[Callable, Optional[Callable]]] = {}
+        self.message_callback: Optional[Callable] = None
+
+    @staticmethod
+    async def _unrouted(update, context):
+        return None
+
+    def command(self, name: str, callback: Callable) -> None:
+        self.commands[name.lower()] = callback
+
+    def callback_query(self, prefix: str, callback: Callable, parse: Optional[Callable] = None) -> None:
+        """Route callback queries whose data starts with `prefix`, which must end in `_` or `-`.
+
+        `parse` turns the rest of the data into the list passed as `context.args`; by default
+        it is the rest itself.
+        """
+        if callback_prefix(prefix) != (prefix, ""):
+            raise ValueError(f"Callback prefix {prefix!r} must end at its first '_' or '-'")
+        self.callback_queries[prefix] = (callback, parse)
+
+    def message(self, callback: Callable) -> None:
+        """Route text and voice messages that are not a known command."""
+        self.message_callback = callback
+
+    def check_update(self, update: object):
+        """Return `(callback, args)` for the update's route, or None when it has none."""
+        if not isinstance(update, Update):
+            return None
+        callback_query = update.callback_query
+        if callback_query is not None:
+            if not callback_query.data:
+                return None
+            prefix, rest = callback_prefix(callback_query.data)
+            route = self.callback_queries.get(prefix)
+            if route is None:
+                return None
+            callback, parse = route
+            return callback, parse(rest) if parse else [rest]
+        message = _message_of(update)
+        if message is None:
+            return None
+        if message.text and message.entities:
+            entity = message.entities[0]
+            if entity.type == MessageEntity.BOT_COMMAND and entity.offset == 0:
+                name, _, username = message.text[1:entity.length].partition("@")
+                callback = self.commands.get(name.lower())
+                if callback is not None and (not username or username.lower() == message.get_bot().username.lower()):
+                    return callback, message.text.split()[1:]
+        if self.message_callback is not None and (message.text or message.voice):
+            return self.message_callback, []
+        return None
+
+    async def handle_update(self, update, application, check_result, context):
+        callback, context.args = check_result
+        try:
+            return await callback(update, context)
+        except Exception:
+            # PTB passes the exception to the error handlers; the lane only learns of it here.
+            mark_failed()
+            raise
@@ -0,0 +1,367 @@
+"""
+Per-user session data (selected language and bot), in Redis or in a local SQLite file.
+
+`SESSION_BACKEND` selects the store:
+
+- `redis` (default): `RedisSessionStore`, the compact layout below, shared by every host.
+- `sqlite`: `SqliteSessionStore`, a database file at `SESSION_SQLITE_PATH` (default
+  `sessions.db`) in WAL mode, for single-host deployments. The worker processes of the
+  host share the file; lookups are local reads without a network round trip. Writes, which
+  may wait for a sibling process' write lock, run on a writer thread of their own, off the
+  event loop.
+
+Both keep a profile as one packed integer (`pack`/`unpack`) and forget it after
+`SESSION_TTL` seconds without access.
+
+Redis layout: instead of two string keys per user (`{chat_id}_language`, `{chat_id}_bot`), users are
+bucketed into small hashes:
+
+    key   session:{chat_id // SESSION_BUCKET_SIZE}
+    field chat_id % SESSION_BUCKET_SIZE
+    value language_index * 16 + bot_code   (0 means "not selected")
+
+Language indexes come from `config.LANGUAGES` and bot codes from `config.BOT_CODES`. With
+`SESSION_BUCKET_SIZE` at or below Redis' `hash-max-listpack-entries` (128 by default) each
+bucket stays listpack-encoded, costing a few bytes per user instead of ~100+ bytes of
+per-key overhead. Buckets expire after `SESSION_TTL` seconds without any access to one of
+their users.
+
+Bots hosted in the same process (`tenants.py`) keep separate sessions under
+`session:{namespace}:{bucket}`; the hash tag stays on the bucket.
+
+While existing deployments are migrated (`migrate_sessions.py`), reads of users missing
+from the compact layout fall back to the legacy keys and copy them over
+(`SESSION_LEGACY_FALLBACK`, on by default).
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import LANGUAGES, BOT_CODES
+from logger import logger
+from metrics import REDIS_LATENCY
+from redis_clients import ShardedRedis
+from tracing import span
+
+SESSION_BUCKET_SIZE = int(os.getenv("SESSION_BUCKET_SIZE", "100"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(180 * 24 * 3600)))
+SESSION_LEGACY_FALLBACK = os.getenv("SESSION_LEGACY_FALLBACK", "true").lower() == "true"
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "redis").lower()
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.db")
+SQLITE_BUSY_TIMEOUT_MS = 5000
+# Reads on the event loop only wait this long for a lock (rare in WAL mode) before they are
+# retried on the writer thread.
+SQLITE_READ_BUSY_TIMEOUT_MS = 50
+# SQLite refreshes a profile's access time at most this often, so reads stay reads.
+SQLITE_TOUCH_SECONDS = 24 * 3600
+
+if SESSION_BACKEND not in ("redis", "sqlite"):
+    raise ValueError(f"Unknown SESSION_BACKEND {SESSION_BACKEND!r}, expected redis or sqlite")
+
+# KEYS[1] bucket; ARGV: field, language index, bot code, TTL in seconds (0 for none), fill.
+# Sets parts of a packed profile and keeps the others in a single atomic step; a negative
+# language index or bot code means "keep the stored one", and with fill set to 1 only unset
+# parts are written. Returns the previous packed value.
+STORE_PROFILE_LUA = """
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+local fill = ARGV[5] == '1'
+local language = tonumber(ARGV[2])
+if language < 0 or (fill and current >= 16) then language = math.floor(current / 16) end
+local bot = tonumber(ARGV[3])
+if bot < 0 or (fill and current % 16 > 0) then bot = current % 16 end
+local packed = language * 16 + bot
+redis.call('HSET', KEYS[1], ARGV[1], packed)
+if tonumber(ARGV[4]) > 0 then redis.call('EXPIRE', KEYS[1], ARGV[4]) end
+return current
+"""
+
+LANGUAGE_CODES = {language["code"]: language["index"] for language in LANGUAGES}
+LANGUAGE_BY_CODE = {index: code for code, index in LANGUAGE_CODES.items()}
+BOT_BY_CODE = {code: name for name, code in BOT_CODES.items()}
+
+
+def bucket_key(chat_id: int, namespace: str = "") -> str:
+    prefix = f"session:{namespace}:" if namespace else "session:"
+    return f"{prefix}{{{chat_id // SESSION_BUCKET_SIZE}}}"
+
+
+def bucket_field(chat_id: int) -> str:
+    return str(chat_id % SESSION_BUCKET_SIZE)
+
+
+def pack(language, bot) -> int:
+    """Pack a language code and bot name into one small integer; unknown values are dropped."""
+    return LANGUAGE_CODES.get(language, 0) * 16 + BOT_CODES.get(bot, 0)
+
+
+def unpack(packed):
+    """Return `(language, bot)` for a packed value, with `None` for unset parts."""
+    packed = int(packed or 0)
+    return LANGUAGE_BY_CODE.get(packed // 16), BOT_BY_CODE.get(packed % 16)
+
+
+def legacy_packed(language, bot) -> int:
+    """Pack the raw values of the legacy `{chat_id}_language` and `{chat_id}_bot` keys."""
+    return pack(language.decode("utf-8") if language is not None else None,
+                bot.decode("utf-8") if bot is not None else None)
+
+
+class SessionStore:
+    """Reads and writes user profiles (language, bot)."""
+
+    def get_profile(self, chat_id: int):
+        """Return `(language, bot)` for a chat, with `None` for unset parts."""
+        raise NotImplementedError
+
+    async def load_profile(self, chat_id: int):
+        """`get_profile` for the event loop; stores with local reads answer directly."""
+        return self.get_profile(chat_id)
+
+    def set_language(self, chat_id: int, language: str):
+        if self._storable(language=language):
+            self._store(chat_id, language, None)
+
+    def set_bot(self, chat_id: int, bot: str):
+        if self._storable(bot=bot):
+            self._store(chat_id, None, bot)
+
+    async def save_language(self, chat_id: int, language: str):
+        """`set_language` for the event loop."""
+        if self._storable(language=language):
+            await self._save(chat_id, language, None)
+
+    async def save_bot(self, chat_id: int, bot: str):
+        """`set_bot` for the event loop."""
+        if self._storable(bot=bot):
+            await self._save(chat_id, None, bot)
+
+    @staticmethod
+    def _storable(language=None, bot=None) -> bool:
+        if language is not None and language not in LANGUAGE_CODES:
+            logger.warning(f"Language {language} has no session code and is not stored")
+            return False
+        if bot is not None and bot not in BOT_CODES:
+            logger.warning(f"Bot {bot} has no session code and is not stored")
+            return False
+        return True
+
+    def _store(self, chat_id: int, language, bot):
+        raise NotImplementedError
+
+    async def _save(self, chat_id: int, language, bot):
+        self._store(chat_id, language, bot)
+
+
+class RedisSessionStore(SessionStore):
+    """Reads and writes user profiles (language, bot) in the compact bucketed layout."""
+
+    def __init__(self, redis_client, namespace="", ttl=SESSION_TTL, legacy_fallback=SESSION_LEGACY_FALLBACK,
+                 async_redis=None):
+        self.redis = redis_client
+        # `load_profile` reads through the asyncio client, so profile loads never need a thread.
+        self.async_redis = async_redis
+        self.namespace = namespace
+        self.ttl = ttl
+        # Legacy keys only ever existed for the un-namespaced, single-bot layout.
+        self.legacy_fallback = legacy_fallback and not namespace
+        self._scripts = {}
+
+    def get_profile(self, chat_id: int):
+        """Return `(language, bot)` for a chat in one round trip, refreshing the bucket's idle TTL."""
+        key = bucket_key(chat_id, self.namespace)
+        with REDIS_LATENCY.labels("hget").time(), span("redis_profile_load", key=key):
+            packed = self._profile_pipeline(self.redis, chat_id).execute()[0]
+        if packed is None and self.legacy_fallback:
+            return self._migrate_legacy(chat_id)
+        return unpack(packed)
+
+    async def load_profile(self, chat_id: int):
+        if self.async_redis is None:
+            return self.get_profile(chat_id)
+        key = bucket_key(chat_id, self.namespace)
+        with REDIS_LATENCY.labels("hget").time(), span("redis_profile_load", key=key):
+            packed = (await self._profile_pipeline(self.async_redis, chat_id).execute())[0]
+        if packed is None and self.legacy_fallback:
+            with REDIS_LATENCY.labels("legacy_get").time(), span("redis_legacy_load"):
+                legacy = await self._legacy_pipeline(self.async_redis, chat_id).execute()
+            packed = legacy_packed(*legacy)
+            if packed:
+                await self._copy_pipeline(self.async_redis, chat_id, packed).execute()
+        return unpack(packed)
+
+    def _profile_pipeline(self, client, chat_id: int):
+        key = bucket_key(chat_id, self.namespace)
+        pipeline = client.pipeline(transaction=False)
+        pipeline.hget(key, bucket_field(chat_id))
+        if self.ttl:
+            pipeline.expire(key, self.ttl)
+        return pipeline
+
+    def _store(self, chat_id: int, language, bot):
+        key = bucket_key(chat_id, self.namespace)
+        with REDIS_LATENCY.labels("hset").time(), span("redis_profile_store", key=key):
+            # One script that keeps the part not being set, so concurrent writers cannot lose an update.
+            previous = self._script_for(self.redis, key)(keys=[key], args=self._store_args(chat_id, language, bot))
+        if not previous and self.legacy_fallback:
+            # A user not migrated yet: fill the part not being set from the legacy keys.
+            with REDIS_LATENCY.labels("legacy_get").time(), span("redis_legacy_load"):
+                packed = legacy_packed(*self._legacy_pipeline(self.redis, chat_id).execute())
+            if packed:
+                self._script_for(self.redis, key)(keys=[key], args=self._fill_args(chat_id, packed))
+
+    async def _save(self, chat_id: int, language, bot):
+        if self.async_redis is None:
+            return self._store(chat_id, language, bot)
+        key = bucket_key(chat_id, self.namespace)
+        with REDIS_LATENCY.labels("hset").time(), span("redis_profile_store", key=key):
+            previous = await self._script_for(self.async_redis, key)(
+                keys=[key], args=self._store_args(chat_id, language, bot))
+        if not previous and self.legacy_fallback:
+            with REDIS_LATENCY.labels("legacy_get").time(), span("redis_legacy_load"):
+                packed = legacy_packed(*await self._legacy_pipeline(self.async_redis, chat_id).execute())
+            if packed:
+                await self._script_for(self.async_redis, key)(keys=[key], args=self._fill_args(chat_id, packed))
+
+    def _store_args(self, chat_id: int, language, bot) -> list:
+        language_code = LANGUAGE_CODES[language] if language is not None else -1
+        bot_code = BOT_CODES[bot] if bot is not None else -1
+        return [bucket_field(chat_id), language_code, bot_code, self.ttl or 0, 0]
+
+    def _fill_args(self, chat_id: int, packed: int) -> list:
+        return [bucket_field(chat_id), packed // 16, packed % 16, self.ttl or 0, 1]
+
+    def _script_for(self, redis_client, key):
+        # A sharded client routes by key, so the script is registered with the node owning it.
+        client = redis_client.client_for(key) if isinstance(redis_client, ShardedRedis) else redis_client
+        script = self._scripts.get(id(client))
+        if script is None:
+            script = self._scripts[id(client)] = client.register_script(STORE_PROFILE_LUA)
+        return script
+
+    def _migrate_legacy(self, chat_id: int):
+        with REDIS_LATENCY.labels("legacy_get").time(), span("redis_legacy_load"):
+            packed = legacy_packed(*self._legacy_pipeline(self.redis, chat_id).execute())
+        if packed:
+            self._copy_pipeline(self.redis, chat_id, packed).execute()
+        return unpack(packed)
+
+    @staticmethod
+    def _legacy_pipeline(client, chat_id: int):
+        # Separate GETs rather than MGET: the two legacy keys may live on different shards.
+        pipeline = client.pipeline(transaction=False)
+        pipeline.get(f"{chat_id}_language")
+        pipeline.get(f"{chat_id}_bot")
+        return pipeline
+
+    def _copy_pipeline(self, client, chat_id: int, packed: int):
+        key = bucket_key(chat_id, self.namespace)
+        pipeline = client.pipeline(transaction=False)
+        pipeline.hsetnx(key, bucket_field(chat_id), packed)
+        if self.ttl:
+            pipeline.expire(key, self.ttl)
+        return pipeline
+
+
+class SqliteSessionStore(SessionStore):
+    """Reads and writes user profiles in a local SQLite database shared by the processes of one host."""
+
+    def __init__(self, path=SESSION_SQLITE_PATH, namespace="", ttl=SESSION_TTL):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        # sqlite3 connections must not be shared between threads; each thread opens its own.
+        self._connections = threading.local()
+        # Every write goes through this one thread, in order, so none blocks the event loop.
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-sessions",
+                                          initializer=self._mark_writer)
+        self._writer.submit(self._create).result()
+
+    def _mark_writer(self):
+        self._connections.writer = True
+
+    def _create(self):
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (namespace TEXT NOT NULL, chat_id INTEGER NOT NULL, "
+            "profile INTEGER NOT NULL, accessed INTEGER NOT NULL, PRIMARY KEY (namespace, chat_id)) WITHOUT ROWID"
+        )
+        if self.ttl:
+            connection.execute("DELETE FROM sessions WHERE namespace = ? AND accessed < ?",
+                               (self.namespace, int(time.time()) - self.ttl))
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            writer = getattr(self._connections, "writer", False)
+            timeout_ms = SQLITE_BUSY_TIMEOUT_MS if writer else SQLITE_READ_BUSY_TIMEOUT_MS
+            # Autocommit: every statement is its own short transaction.
+            connection = sqlite3.connect(self.path, timeout=timeout_ms / 1000, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._connections.connection = connection
+        return connection
+
+    def get_profile(self, chat_id: int):
+        """Return `(language, bot)` for a chat, refreshing its access time about once a day."""
+        try:
+            return self._read(chat_id)
+        except sqlite3.OperationalError:
+            # Locked (SQLITE_BUSY) beyond the short read timeout: wait on the writer thread.
+            return self._writer.submit(self._read, chat_id).result()
+
+    async def load_profile(self, chat_id: int):
+        try:
+            return self._read(chat_id)
+        except sqlite3.OperationalError:
+            return await asyncio.get_running_loop().run_in_executor(self._writer, self._read, chat_id)
+
+    def _read(self, chat_id: int):
+        with span("sqlite_profile_load"):
+            row = self._connection().execute(
+                "SELECT profile, accessed FROM sessions WHERE namespace = ? AND chat_id = ?",
+                (self.namespace, chat_id)).fetchone()
+        if row is None:
+            return None, None
+        packed, accessed = row
+        now = int(time.time())
+        if self.ttl and now - accessed > self.ttl:
+            return None, None
+        if self.ttl and now - accessed > SQLITE_TOUCH_SECONDS:
+            # Reads stay reads: the refresh is a write and is left to the writer thread.
+            self._writer.submit(self._touch, chat_id, now)
+        return unpack(packed)
+
+    def _touch(self, chat_id: int, now: int):
+        try:
+            self._connection().execute("UPDATE sessions SET accessed = ? WHERE namespace = ? AND chat_id = ?",
+                                       (now, self.namespace, chat_id))
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Could not refresh session access time: {e}")
+
+    def _store(self, chat_id: int, language, bot):
+        self._writer.submit(self._write, chat_id, language, bot).result()
+
+    async def _save(self, chat_id: int, language, bot):
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._write, chat_id, language, bot)
+
+    def _write(self, chat_id: int, language, bot):
+        # One upsert that keeps the part not being set, so concurrent writers cannot lose an update.
+        language_code = LANGUAGE_CODES[language] if language is not None else None
+        bot_code = BOT_CODES[bot] if bot is not None else None
+        with span("sqlite_profile_store"):
+            self._connection().execute(
+                "INSERT INTO sessions (namespace, chat_id, profile, accessed) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (namespace, chat_id) DO UPDATE SET "
+                "profile = coalesce(?, profile / 16) * 16 + coalesce(?, profile % 16), accessed = excluded.accessed",
+                (self.namespace, chat_id, pack(language, bot), int(time.time()), language_code, bot_code),
+            )
+
+
+def create_session_store(redis_client, namespace="", async_redis=None) -> SessionStore:
+    """The session store of one bot, on the backend selected by `SESSION_BACKEND`."""
+    if SESSION_BACKEND == "sqlite":
+        return SqliteSessionStore(SESSION_SQLITE_PATH, namespace)
+    return RedisSessionStore(redis_client, namespace, async_redis=async_redis)
@@ -0,0 +1,39 @@
+"""
+Update worker for `UPDATE_STREAM=ingress` deployments: consumes the updates the webhook
+appended to the Redis Stream and runs them through the shared handler core in
+`bot_core.py` (see `update_stream.py`).
+
+Run as many worker processes as the load needs, independently of the webhook replicas.
+Set `METRICS_PORT` to expose `/metrics`.
+"""
+import asyncio
+import os
+from prometheus_client import start_http_server
+from bot_core import botName, build_applications, drain_deferred_answers, run_applications
+from lanes import LANE_LIMITS
+from logger import logger
+from loop_watchdog import start_loop_watchdog
+from redis_clients import create_redis_client
+from update_stream import StreamConsumer, UpdateStream
+
+metrics_port = int(os.getenv('METRICS_PORT', '0'))
+
+
+async def main() -> None:
+    logger.info('################################################')
+    logger.info('# Telegram bot name %s (stream worker)', botName)
+    logger.info('################################################')
+    logger.info({"lane_limits": LANE_LIMITS})
+    start_loop_watchdog(asyncio.get_running_loop())
+
+    applications = build_applications()
+    consumer = StreamConsumer(UpdateStream(create_redis_client(use_asyncio=True)), applications)
+    if metrics_port:
+        start_http_server(metrics_port)
+
+    async with run_applications(applications):
+        await asyncio.gather(consumer.run(), drain_deferred_answers(applications))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
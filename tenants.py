@@ -0,0 +1,127 @@
+"""
+Per-bot configuration for hosting several bots in one process.
+
+Without `BOTS_CONFIG` a single bot is configured from the environment as before
+(`TELEGRAM_BOT_TOKEN`, `TELEGRAM_BOT_NAME`, `WELCOME_MESSAGE`, `SUPPORTED_BOTS`, ...).
+With `BOTS_CONFIG` pointing at a JSON file, every entry of its list is one bot:
+
+    [
+      {
+        "id": "farmpulse",                    # route /telegram/farmpulse, session namespace
+        "token_env": "FARMPULSE_BOT_TOKEN",   # or "token": "..."
+        "name": "FarmPulse",
+        "webhook_secret_env": "FARMPULSE_WEBHOOK_SECRET",
+        "welcome_message": "...",             # default: WELCOME_MESSAGE
+        "supported_languages": ["en", "hi"],  # required, at least one
+        "supported_bots": ["story"],
+        "default_bot": "story",
+        "story_api_base_url": "https://...",  # comma-separated replicas, see backends.py
+        "activity_api_base_url": "https://...",
+        "catalog": {"BOT_LODING_MSG": {"en": "..."}}   # overrides of the config.py messages
+      }
+    ]
+
+All bots share the Redis clients, HTTP connection pools, execution lanes and backend
+limits of the process; only sessions and `user_data` are kept apart per bot.
+"""
+import json
+import os
+from dataclasses import dataclass, field
+
+import config
+from backends import backend_pool
+
+BOTS_CONFIG = os.getenv("BOTS_CONFIG", "")
+WELCOME_MESSAGE = os.getenv('WELCOME_MESSAGE', "Namaste 🙏\nWelcome to *e-Jaadui Pitara*\n_(Powered by Bhashini)_")
+CATALOG_NAMES = ("LANGUAGE_SELCTION", "BOT_NAME", "BOT_SELECTION", "BOT_LODING_MSG", "API_ERROR_MSG", "RATE_LIMIT_MSG",
+                 "DEFERRED_ANSWER_MSG")
+
+
+@dataclass
+class BotTenant:
+    """Configuration of one hosted bot."""
+    bot_id: str
+    token: str
+    name: str
+    welcome_message: str
+    supported_languages: list
+    supported_bots: list
+    default_bot: str
+    story_api_base_url: str
+    activity_api_base_url: str
+    webhook_secret: str = ""
+    session_namespace: str = ""
+    catalog: dict = field(default_factory=dict)
+
+    def backend_for(self, selected_bot: str):
+        """Return the replica pool and query path serving `selected_bot`."""
+        if selected_bot == "story":
+            return backend_pool(self.story_api_base_url), '/v1/query_rstory'
+        return backend_pool(self.activity_api_base_url), '/v1/query'
+
+
+def default_catalog(overrides=None) -> dict:
+    """The message catalogs of `config.py`, with per-language overrides applied."""
+    catalog = {name: dict(getattr(config, name)) for name in CATALOG_NAMES}
+    for name, messages in (overrides or {}).items():
+        if name not in catalog:
+            raise ValueError(f"Unknown catalog {name}, expected one of {', '.join(CATALOG_NAMES)}")
+        catalog[name].update(messages)
+    return catalog
+
+
+def tenant_from_env() -> BotTenant:
+    return BotTenant(
+        bot_id=os.getenv("BOT_ID", "default"),
+        token=os.environ["TELEGRAM_BOT_TOKEN"],
+        name=os.environ["TELEGRAM_BOT_NAME"],
+        welcome_message=WELCOME_MESSAGE,
+        supported_languages=os.getenv('SUPPORTED_LANGUAGES', "").split(","),
+        supported_bots=os.getenv('SUPPORTED_BOTS', "story,teacher,parent").split(","),
+        default_bot=os.getenv("DEFAULT_BOT", "story"),
+        story_api_base_url=os.getenv("STORY_API_BASE_URL", ""),
+        activity_api_base_url=os.getenv("ACTIVITY_API_BASE_URL", ""),
+        webhook_secret=os.getenv("WEBHOOK_SECRET", ""),
+        catalog=default_catalog(),
+    )
+
+
+def tenant_from_entry(entry: dict) -> BotTenant:
+    bot_id = entry["id"]
+    token = entry.get("token") or os.environ[entry["token_env"]]
+    webhook_secret = entry.get("webhook_secret") or os.getenv(entry.get("webhook_secret_env", ""), "")
+    supported_bots = entry.get("supported_bots", ["story", "teacher", "parent"])
+    supported_languages = entry.get("supported_languages")
+    if not supported_languages:
+        raise ValueError(f"Bot {bot_id} in BOTS_CONFIG has no supported_languages")
+    return BotTenant(
+        bot_id=bot_id,
+        token=token,
+        name=entry.get("name", bot_id),
+        # Telegram rejects empty messages, so /start needs some welcome text.
+        welcome_message=entry.get("welcome_message") or WELCOME_MESSAGE,
+        supported_languages=supported_languages,
+        supported_bots=supported_bots,
+        default_bot=entry.get("default_bot", supported_bots[0]),
+        story_api_base_url=entry.get("story_api_base_url", os.getenv("STORY_API_BASE_URL", "")),
+        activity_api_base_url=entry.get("activity_api_base_url", os.getenv("ACTIVITY_API_BASE_URL", "")),
+        webhook_secret=webhook_secret,
+        session_namespace=entry.get("session_namespace", bot_id),
+        catalog=default_catalog(entry.get("catalog")),
+    )
+
+
+def load_tenants(path=BOTS_CONFIG) -> dict:
+    """Return the configured bots keyed by bot id, in configuration order."""
+    if not path:
+        tenant = tenant_from_env()
+        return {tenant.bot_id: tenant}
+    with open(path, encoding="utf-8") as config_file:
+        entries = json.load(config_file)
+    tenants = {}
+    for entry in entries:
+        tenant = tenant_from_entry(entry)
+        if tenant.bot_id in tenants:
+            raise ValueError(f"Duplicate bot id {tenant.bot_id} in {path}")
+        tenants[tenant.bot_id] = tenant
+    return tenants
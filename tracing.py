@@ -0,0 +1,240 @@
+"""
+Per-update latency tracing.
+
+Every handled update gets a trace keyed by its `update_id` and, for messages, the
+`x-request-id` sent to the backend (the Telegram message id). Spans are recorded for
+webhook receipt, queue wait and any block wrapped in `span(...)`. Finished traces go
+through a tail sampler that keeps only the slowest `TRACE_KEEP_SLOWEST_PERCENT` of a
+rolling window and are exported from a background thread, either as JSON lines to
+`TRACE_FILE` or as OTLP/HTTP JSON to `TRACE_OTLP_ENDPOINT`.
+
+Tracing is off unless `TRACE_EXPORT` is set to `file` or `otlp`.
+"""
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+
+import requests
+
+from logger import logger
+
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", os.getenv("TELEGRAM_BOT_NAME", "telegram-bot"))
+TRACE_KEEP_SLOWEST_PERCENT = float(os.getenv("TRACE_KEEP_SLOWEST_PERCENT", "5"))
+TRACE_SAMPLE_WINDOW = int(os.getenv("TRACE_SAMPLE_WINDOW", "1000"))
+TRACE_EXPORT_BATCH_SIZE = int(os.getenv("TRACE_EXPORT_BATCH_SIZE", "50"))
+
+TRACING_ENABLED = TRACE_EXPORT in ("file", "otlp")
+
+_current_trace: ContextVar = ContextVar("current_trace", default=None)
+_NO_SPAN = nullcontext()
+
+
+class Trace:
+    """Spans recorded for one update."""
+
+    __slots__ = ("trace_id", "update_id", "request_id", "name", "start_ns", "end_ns", "spans")
+
+    def __init__(self, name: str, update_id, request_id=None):
+        self.trace_id = uuid.uuid4().hex
+        self.update_id = update_id
+        self.request_id = request_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.spans = []
+
+    def add_span(self, name: str, start_ns: int, end_ns: int, **attributes):
+        self.spans.append((name, start_ns, end_ns, attributes))
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "update_id": self.update_id,
+            "request_id": self.request_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "spans": [
+                {"name": name, "offset_ms": round((start - self.start_ns) / 1e6, 3),
+                 "duration_ms": round((end - start) / 1e6, 3), **attributes}
+                for name, start, end, attributes in self.spans
+            ],
+        }
+
+
+class TailSampler:
+    """Keeps traces whose duration is within the slowest `keep_percent` of a rolling window."""
+
+    def __init__(self, keep_percent=TRACE_KEEP_SLOWEST_PERCENT, window=TRACE_SAMPLE_WINDOW):
+        self.keep_percent = keep_percent
+        self.durations = deque(maxlen=window)
+        self.threshold_ms = 0.0
+        self._since_recompute = 0
+
+    def should_keep(self, duration_ms: float) -> bool:
+        self.durations.append(duration_ms)
+        self._since_recompute += 1
+        # Re-sorting the window on every trace would dominate the cost; the threshold only
+        # needs to track the distribution, so refresh it every 5% of the window.
+        if self._since_recompute >= max(1, self.durations.maxlen // 20):
+            ordered = sorted(self.durations)
+            index = int(len(ordered) * (1 - self.keep_percent / 100.0))
+            self.threshold_ms = ordered[min(index, len(ordered) - 1)]
+            self._since_recompute = 0
+        return duration_ms >= self.threshold_ms
+
+
+class TraceExporter:
+    """Writes sampled traces from a daemon thread so exporting never blocks the event loop."""
+
+    def __init__(self, mode=TRACE_EXPORT, path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT):
+        self.mode = mode
+        self.path = path
+        self.endpoint = endpoint
+        self.queue = queue.Queue(maxsize=10000)
+        self.thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self.thread.start()
+
+    def export(self, trace: Trace):
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            logger.warning("Trace export queue is full, dropping trace %s", trace.trace_id)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < TRACE_EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self.mode == "otlp":
+                    self._send_otlp(batch)
+                else:
+                    self._write_file(batch)
+            except Exception as e:
+                logger.error(f"Error exporting traces: {e}", exc_info=True)
+
+    def _write_file(self, batch):
+        with open(self.path, "a", encoding="utf-8") as trace_file:
+            for trace in batch:
+                trace_file.write(json.dumps(trace.to_dict(), default=str) + "\n")
+
+    def _send_otlp(self, batch):
+        spans = []
+        for trace in batch:
+            root_span_id = uuid.uuid4().hex[:16]
+            spans.append(_otlp_span(trace.trace_id, root_span_id, None, trace.name, trace.start_ns, trace.end_ns,
+                                    {"update_id": trace.update_id, "request_id": trace.request_id}))
+            for name, start, end, attributes in trace.spans:
+                spans.append(_otlp_span(trace.trace_id, uuid.uuid4().hex[:16], root_span_id, name, start, end,
+                                        attributes))
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", TRACE_SERVICE_NAME)]},
+                "scopeSpans": [{"scope": {"name": "telegram-bot"}, "spans": spans}],
+            }]
+        }
+        response = requests.post(self.endpoint, json=payload, timeout=10)
+        response.raise_for_status()
+
+
+def _otlp_attribute(key, value):
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _otlp_span(trace_id, span_id, parent_span_id, name, start_ns, end_ns, attributes):
+    span = {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "name": name,
+        "kind": 1,
+        "startTimeUnixNano": str(start_ns),
+        "endTimeUnixNano": str(end_ns),
+        "attributes": [_otlp_attribute(k, v) for k, v in attributes.items() if v is not None],
+    }
+    if parent_span_id:
+        span["parentSpanId"] = parent_span_id
+    return span
+
+
+_sampler = TailSampler()
+_exporter = TraceExporter() if TRACING_ENABLED else None
+# Webhook receipt spans keyed by (bot_id, update_id), as update ids are only unique per bot,
+# consumed when the handler starts. Updates that no handler picks up never claim their
+# entry, hence the bound.
+_receipts = OrderedDict()
+_MAX_PENDING_RECEIPTS = 10000
+
+
+def record_receipt(bot_id: str, update_id, start_ns: int, end_ns: int):
+    """Remember when the webhook received and enqueued an update for bot `bot_id`."""
+    if not TRACING_ENABLED:
+        return
+    _receipts[(bot_id, update_id)] = (start_ns, end_ns)
+    if len(_receipts) > _MAX_PENDING_RECEIPTS:
+        _receipts.popitem(last=False)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def _span(trace: Trace, name: str, attributes: dict):
+    start_ns = time.time_ns()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start_ns, time.time_ns(), **attributes)
+
+
+def span(name: str, **attributes):
+    """Context manager recording a span on the current update's trace, a no-op outside one."""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NO_SPAN
+    return _span(trace, name, attributes)
+
+
+def trace_handler(callback, name=None):
+    """Wrap a PTB handler callback so each update it handles is traced end to end."""
+    if not TRACING_ENABLED:
+        return callback
+    trace_name = name or callback.__name__
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        message = getattr(update, "effective_message", None)
+        trace = Trace(trace_name, update.update_id, message.message_id if message else None)
+        receipt = _receipts.pop((context.tenant.bot_id, update.update_id), None)
+        if receipt:
+            trace.start_ns = receipt[0]
+            trace.add_span("webhook_receipt", receipt[0], receipt[1])
+            trace.add_span("queue_wait", receipt[1], time.time_ns())
+        token = _current_trace.set(trace)
+        try:
+            return await callback(update, context)
+        finally:
+            _current_trace.reset(token)
+            trace.end_ns = time.time_ns()
+            if _sampler.should_keep(trace.duration_ms):
+                _exporter.export(trace)
+
+    return wrapper
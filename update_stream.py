@@ -0,0 +1,192 @@
+"""
+Durable Redis Streams queue between webhook ingress and update processing.
+
+With `UPDATE_STREAM=ingress` the `/telegram` routes only append the raw update bytes to a
+Redis Stream and return; `stream_worker.py` processes run the handlers. Workers read the
+stream as one consumer group, so each update is handled by one worker, and acknowledge an
+entry once its handlers have finished. Ingress and workers scale independently, and
+updates survive restarts and redeploys of either side:
+
+- a worker restarting under the same consumer name first re-reads the entries it had read
+  but not acknowledged. Names must be unique among live processes, or a restarting worker
+  would re-run entries a sibling is still handling. `UPDATE_STREAM_CONSUMER` sets it
+  explicitly; otherwise it is `{hostname}-{UPDATE_STREAM_WORKER_INDEX}` when the
+  deployment numbers its worker processes (stable across restarts), and `{hostname}-{pid}`
+  when it does not, in which case a restarted worker's entries are recovered below;
+- entries left pending by a worker that never came back are taken over with XAUTOCLAIM
+  once idle for `UPDATE_STREAM_CLAIM_IDLE_MS` (default 300000; keep it above the slowest
+  handler run, or a slow update is handled twice).
+
+`UPDATE_STREAM=inline` appends in the webhook and also consumes in the same process, for
+durability without a separate worker deployment. `UPDATE_STREAM=off` (default) keeps the
+in-memory `application.update_queue`.
+
+    key      UPDATE_STREAM_KEY (default telegram:updates), trimmed to ~UPDATE_STREAM_MAXLEN
+    group    UPDATE_STREAM_GROUP (default bot-workers)
+    entry    {"bot": bot id, "update": raw JSON bytes, "received_ns": webhook receive time}
+"""
+import asyncio
+import json
+import os
+import socket
+import time
+
+from redis.exceptions import ResponseError
+from telegram import Update
+
+from lanes import LANE_MAX_PENDING
+from logger import logger
+from metrics import STREAM_ENTRIES
+from redis_clients import ShardedRedis
+from tracing import record_receipt
+
+UPDATE_STREAM = os.getenv("UPDATE_STREAM", "off").lower()
+UPDATE_STREAM_KEY = os.getenv("UPDATE_STREAM_KEY", "telegram:updates")
+UPDATE_STREAM_GROUP = os.getenv("UPDATE_STREAM_GROUP", "bot-workers")
+UPDATE_STREAM_WORKER_INDEX = os.getenv("UPDATE_STREAM_WORKER_INDEX", "")
+UPDATE_STREAM_CONSUMER = os.getenv(
+    "UPDATE_STREAM_CONSUMER", f"{socket.gethostname()}-{UPDATE_STREAM_WORKER_INDEX or os.getpid()}"
+)
+UPDATE_STREAM_MAXLEN = int(os.getenv("UPDATE_STREAM_MAXLEN", "1000000"))
+UPDATE_STREAM_READ_COUNT = int(os.getenv("UPDATE_STREAM_READ_COUNT", "100"))
+UPDATE_STREAM_BLOCK_MS = int(os.getenv("UPDATE_STREAM_BLOCK_MS", "5000"))
+UPDATE_STREAM_CLAIM_IDLE_MS = int(os.getenv("UPDATE_STREAM_CLAIM_IDLE_MS", "300000"))
+UPDATE_STREAM_MAX_IN_FLIGHT = int(os.getenv("UPDATE_STREAM_MAX_IN_FLIGHT", str(LANE_MAX_PENDING)))
+
+if UPDATE_STREAM not in ("off", "ingress", "inline"):
+    raise ValueError(f"Unknown UPDATE_STREAM {UPDATE_STREAM!r}, expected off, ingress or inline")
+
+
+class UpdateStream:
+    """The Redis Stream updates are appended to, with its consumer group."""
+
+    def __init__(self, redis_client, key=UPDATE_STREAM_KEY, group=UPDATE_STREAM_GROUP, maxlen=UPDATE_STREAM_MAXLEN):
+        # The stream is a single key; XREADGROUP does not take the key first, so route it here.
+        self.redis = redis_client.client_for(key) if isinstance(redis_client, ShardedRedis) else redis_client
+        self.key = key
+        self.group = group
+        self.maxlen = maxlen
+
+    async def ensure_group(self):
+        try:
+            await self.redis.xgroup_create(self.key, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def append(self, bot_id: str, body: bytes, received_ns: int):
+        await self.redis.xadd(self.key, {"bot": bot_id, "update": body, "received_ns": received_ns},
+                              maxlen=self.maxlen, approximate=True)
+        STREAM_ENTRIES.labels("appended").inc()
+
+
+class StreamConsumer:
+    """Reads updates from the stream as one consumer of the group and runs them through the bots."""
+
+    def __init__(self, stream: UpdateStream, applications: dict, consumer=UPDATE_STREAM_CONSUMER,
+                 read_count=UPDATE_STREAM_READ_COUNT, block_ms=UPDATE_STREAM_BLOCK_MS,
+                 claim_idle_ms=UPDATE_STREAM_CLAIM_IDLE_MS, max_in_flight=UPDATE_STREAM_MAX_IN_FLIGHT):
+        self.stream = stream
+        self.applications = applications
+        self.consumer = consumer
+        self.read_count = read_count
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_in_flight = max_in_flight
+        self._tasks = {}
+        self._next_claim = 0.0
+
+    async def run(self):
+        await self.stream.ensure_group()
+        logger.info({"update_stream": self.stream.key, "group": self.stream.group, "consumer": self.consumer})
+        try:
+            await self._recover_own_pending()
+            while True:
+                if time.monotonic() >= self._next_claim:
+                    await self._claim_abandoned()
+                await self._wait_for_capacity()
+                reply = await self.stream.redis.xreadgroup(
+                    self.stream.group, self.consumer, {self.stream.key: ">"},
+                    count=min(self.read_count, self.max_in_flight - len(self._tasks)), block=self.block_ms,
+                )
+                for _, entries in reply or []:
+                    for entry_id, fields in entries:
+                        self._dispatch(entry_id, fields, "processed")
+        finally:
+            await self.drain()
+
+    async def drain(self):
+        """Let the updates already read finish, so they are acknowledged rather than re-delivered."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def _recover_own_pending(self):
+        start_id = "0"
+        while True:
+            reply = await self.stream.redis.xreadgroup(
+                self.stream.group, self.consumer, {self.stream.key: start_id}, count=self.read_count
+            )
+            entries = reply[0][1] if reply else []
+            if not entries:
+                return
+            await self._wait_for_capacity()
+            for entry_id, fields in entries:
+                self._dispatch(entry_id, fields, "recovered")
+            start_id = entries[-1][0]
+
+    async def _claim_abandoned(self):
+        self._next_claim = time.monotonic() + self.claim_idle_ms / 2000
+        start_id = "0-0"
+        while True:
+            await self._wait_for_capacity()
+            next_id, entries, *_ = await self.stream.redis.xautoclaim(
+                self.stream.key, self.stream.group, self.consumer, self.claim_idle_ms, start_id=start_id,
+                count=self.read_count,
+            )
+            for entry_id, fields in entries:
+                self._dispatch(entry_id, fields, "claimed")
+            if next_id in (b"0-0", "0-0"):
+                return
+            start_id = next_id
+
+    async def _wait_for_capacity(self):
+        while len(self._tasks) >= self.max_in_flight:
+            await asyncio.wait(list(self._tasks.values()), return_when=asyncio.FIRST_COMPLETED)
+
+    def _dispatch(self, entry_id, fields, outcome):
+        if entry_id in self._tasks:
+            # Still running here; an XAUTOCLAIM of our own slow entry must not start it twice.
+            return
+        self._tasks[entry_id] = asyncio.ensure_future(self._process(entry_id, fields, outcome))
+
+    async def _process(self, entry_id, fields, outcome):
+        try:
+            outcome = await self._handle(entry_id, fields, outcome)
+        except asyncio.CancelledError:
+            # Not acknowledged: the entry is delivered again after a restart.
+            self._tasks.pop(entry_id, None)
+            raise
+        try:
+            await self.stream.redis.xack(self.stream.key, self.stream.group, entry_id)
+            STREAM_ENTRIES.labels(outcome).inc()
+        finally:
+            self._tasks.pop(entry_id, None)
+
+    async def _handle(self, entry_id, fields, outcome) -> str:
+        try:
+            bot_id = fields[b"bot"].decode("utf-8")
+            application = self.applications.get(bot_id)
+            if application is None:
+                logger.error(f"Dropping stream entry {entry_id} for unknown bot {fields[b'bot']}")
+                return "dropped"
+            update = Update.de_json(data=json.loads(fields[b"update"]), bot=application.bot)
+            record_receipt(bot_id, update.update_id, int(fields[b"received_ns"]), time.time_ns())
+            await application.update_processor.process_update(update, application.process_update(update))
+        except (KeyError, ValueError) as e:
+            logger.error(f"Dropping malformed stream entry {entry_id}: {e}")
+            return "dropped"
+        except Exception as e:
+            # Handler errors are reported by PTB; anything escaping it is not retried either.
+            logger.error(f"Error processing stream entry {entry_id}: {e}", exc_info=True)
+            return "failed"
+        return outcome